@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Benchmarks creating commands: how many commands are created per second, and
+how much memory each one takes (measured from the process's resident set
+size, so it includes the strings, sets and dicts that a command holds).
+The pipeline resembles atlas construction: each subject is warped to the
+atlas, and the warped image is masked and blurred.
+
+    python benchmarks/commands.py [--subjects 50000]
+"""
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pipebuilder as pb
+
+def get_rss():
+    """ Returns this process's resident set size in bytes (Linux only) """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def build(pipeline, n_subjects, base='/data/atlas'):
+    atlas = os.path.join(base, 'atlas.nii.gz')
+    mask = os.path.join(base, 'atlas_mask.nii.gz')
+    for i in xrange(n_subjects):
+        folder = os.path.join(base, 'subj%06d' % i)
+        image = os.path.join(folder, 'flair.nii.gz')
+        affine = os.path.join(folder, 'flair_to_atlas_Affine.txt')
+        warp = os.path.join(folder, 'flair_to_atlas_Warp.nii.gz')
+        warped = pb.ANTSWarpCommand('Warp subject %d to atlas' % i,
+                moving=image, reference=atlas,
+                output=os.path.join(folder, 'flair_IN_atlas.nii.gz'),
+                transforms=' %s %s ' % (warp, affine))
+        masked = pb.NiiToolsMaskCommand('Mask subject %d' % i,
+                input=warped.outfiles[0], mask=mask,
+                output=os.path.join(folder, 'flair_IN_atlas_masked.nii.gz'))
+        pb.NiiToolsGaussianBlurCommand('Blur subject %d' % i,
+                input=masked.outfiles[0], sigma=2.0,
+                output=os.path.join(folder, 'flair_IN_atlas_blurred.nii.gz'))
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--subjects', type=int, default=50000)
+    args = parser.parse_args(argv[1:])
+
+    gc.collect()
+    start_rss = get_rss()
+    start = time.time()
+    with pb.Pipeline('atlas') as pipeline:
+        build(pipeline, args.subjects)
+    elapsed = time.time() - start
+    gc.collect()
+    n_commands = len(pipeline.commands)
+    print('%d commands in %.2fs: %.0f commands/s, %.0f bytes/command' %
+            (n_commands, elapsed, n_commands / elapsed,
+             (get_rss() - start_rss) / n_commands))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Benchmarks Tracker.compute_stages and compute_stages_bottomup on large
+random pipelines, against the previous implementation (which checked every
+parent of a command each time one of them finished), and checks that both
+give the same stages.
+
+    python benchmarks/stages.py [--nodes 50000] [--max-inputs 4]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pipebuilder import tracking
+
+class FakeCommand(object):
+    """ Stands in for a Command: only inputs and outputs matter here """
+    descr = 'fake'
+    def __init__(self, inputs, outfiles):
+        self.inputs = inputs
+        self.outfiles = outfiles
+
+def make_commands(n_nodes, max_inputs, seed=0):
+    """
+    Makes a random pipeline where each command reads the outputs of up to
+    max_inputs earlier commands (mostly recent ones, like real pipelines).
+    """
+    rng = random.Random(seed)
+    commands = []
+    for i in xrange(n_nodes):
+        n_inputs = rng.randint(0, max_inputs) if i > 0 else 0
+        parents = set(max(0, i - 1 - int(rng.expovariate(0.01))) for _ in xrange(n_inputs))
+        commands.append(FakeCommand(['/data/out%d.nii.gz' % p for p in parents],
+                                    ['/data/out%d.nii.gz' % i]))
+    return commands
+
+def old_compute_stages(dependency_graph, n_nodes, bottom_up=False):
+    """ The previous implementation of compute_stages(_bottomup) """
+    if bottom_up:
+        (forward, backward) = (dependency_graph.parents, dependency_graph.children)
+    else:
+        (forward, backward) = (dependency_graph.children, dependency_graph.parents)
+    all_stages = []
+    this_stage_nodes = [i for i in xrange(n_nodes) if len(backward(i)) == 0]
+    completed_nodes = set()
+    while True:
+        next_stage_nodes = []
+        for node in this_stage_nodes:
+            completed_nodes.add(node)
+            for child in forward(node):
+                if child not in completed_nodes:
+                    if set(backward(child)).issubset(completed_nodes):
+                        next_stage_nodes.append(int(child))
+        all_stages.append(this_stage_nodes)
+        if next_stage_nodes == []:
+            break
+        this_stage_nodes = next_stage_nodes
+    if bottom_up:
+        all_stages.reverse()
+    return all_stages
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    out = func(*args, **kwargs)
+    return (out, time.time() - start)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--nodes', type=int, default=50000)
+    parser.add_argument('--max-inputs', type=int, default=4)
+    args = parser.parse_args(argv[1:])
+
+    commands = make_commands(args.nodes, args.max_inputs)
+    tracker = tracking.Tracker(commands, [])
+    (_, build_time) = timed(tracker.compute_dependencies)
+    print('%d commands, %d dependencies (graph built in %.2fs)' %
+            (args.nodes, tracker.dependency_graph.n_edges, build_time))
+
+    for (name, bottom_up) in [('compute_stages', False), ('compute_stages_bottomup', True)]:
+        method = getattr(tracker, name)
+        (new, new_time) = timed(method)
+        (old, old_time) = timed(old_compute_stages, tracker.dependency_graph,
+                args.nodes, bottom_up)
+        assert new == old, name + ' gave different stages'
+        print('%s: %d stages in %.3fs (previously %.3fs, %.1fx faster)' %
+                (name, len(new), new_time, old_time, old_time / new_time))
+
+if __name__ == '__main__':
+    main(sys.argv)
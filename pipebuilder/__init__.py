@@ -6,3 +6,5 @@ from mcc import *
 from niitools import *
 from scripts import *
 
+from executor import execute
+
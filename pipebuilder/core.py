@@ -7,28 +7,40 @@ from __future__ import print_function
 import os
 import re
 import time
-import errno
 import base64
 import string
 import hashlib
 import datetime
 import warnings
+import functools
 import subprocess
+import multiprocessing
 
 import parse
 
 from . import util
+from . import fingerprint
+from . import statcache
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 
 # Script to generate a file for submitting with SGE QSUB
 QSUB_RUN =        os.path.join(THIS_DIR, '..', 'scripts', 'qsub-run')
+# Wrapper that runs a command and stores its output/metadata
+WRAP_SIMPLE =     os.path.join(THIS_DIR, '..', 'scripts', 'wrap_simple.py')
 # Requires SGE to run in batch mode
 QSUB = 'qsub'
 
+# Shared cache of file existence/modification times for Dataset and Command
+stat_cache = statcache.StatCache()
+
 ################################################################################
 ### Utility I/O stuff (handles all file naming conventions: adjust to taste) ###
 ################################################################################
+# Which template a file comes from (see Dataset.classify)
+ORIGINAL = 'original'
+PROCESSING = 'processing'
+
 class Dataset(object):
     """
     Class representing your data. Has a range of features from simple to
@@ -74,7 +86,20 @@ class Dataset(object):
         else:
             self.log_template = os.path.join(base_dir, log_template)
 
+        # Templates are compiled once here, since parsing is done for every
+        # input of every command when tracking
+        self.original_parser = parse.compile(self.original_template)
+        if self.processing_template is None:
+            self.processing_parser = None
+        else:
+            self.processing_parser = parse.compile(self.processing_template)
+
+        # Reverse index from filenames to the field values that produced them
         self.filenames_to_field_values = {}
+        # Same, for filenames that were parsed rather than produced
+        self.parsed_field_values = {}
+        # Memoized results of classify()
+        self.classifications = {}
         self.mandatory_files = set()
         self.invalid_files = set()
 
@@ -111,27 +136,48 @@ class Dataset(object):
         raise NotImplementedError
     def get_fields(self, filename):
         """
-        Given a filename *that was already produced by this dataset*,
-        returns the corresponding fields that were used to produce it.
+        Given a filename, returns the corresponding fields that were used to
+        produce it (or that would produce it, for files that weren't produced
+        with get/get_original), or None if it doesn't match either template.
 
         e.g., if you called mydataset.get(foo='a', bar='b') to produce
         /path/to/a/b.txt,
         calling mydataset.get_fields('/path/to/a/b.txt') would return
-        {'foo': 'a', 'bar': 'b'}. However, making the second call *without*
-        having called the first would return None.
+        {'foo': 'a', 'bar': 'b'} (plus the extension).
         """
         if filename in self.filenames_to_field_values:
             return self.filenames_to_field_values[filename]
-        else:
-            return None
+        self.classify(filename)
+        return self.parsed_field_values.get(filename)
+
+    def classify(self, filename):
+        """
+        Determines which template a filename could have been produced by:
+        returns ORIGINAL, PROCESSING, or None if it matches neither (the
+        original template is checked first). Results are memoized, and the
+        parsed field values are added to the reverse index used by get_fields.
+        """
+        if filename in self.classifications:
+            return self.classifications[filename]
+        classification = None
+        for (parser, kind) in [(self.original_parser, ORIGINAL),
+                               (self.processing_parser, PROCESSING)]:
+            if parser is None:
+                continue
+            result = parser.parse(filename)
+            if result is not None:
+                classification = kind
+                self.parsed_field_values[filename] = result.named
+                break
+        self.classifications[filename] = classification
+        return classification
 
     def is_original_file(self, filename):
         """
         Determines whether the filename could have been produced by the original
         template.
         """
-        parsing = parse.parse(self.original_template, filename) is not None
-        return parsing != None
+        return self.classify(filename) == ORIGINAL
 
     def get_folder(self, **partial_format):
         """
@@ -164,7 +210,7 @@ class Dataset(object):
         "Returns an original file using the template and the provided fields"
         format.setdefault('extension', self.default_extension)
         filename = self.original_template.format(**format)
-        if not os.path.exists(filename):
+        if not stat_cache.exists(filename):
             if self.is_mandatory(format):
                 raise IOError("Missing mandatory file: " + filename)
             else:
@@ -184,6 +230,7 @@ class Dataset(object):
             raise ValueError("Can't get a file if you didn't specify a template")
         format.setdefault('extension', self.default_extension)
         filename = self.processing_template.format(**format)
+        self.filenames_to_field_values.setdefault(filename, format)
         return filename
 
     def parse(self):
@@ -255,34 +302,138 @@ class Command(object):
 
     If your command produces any outputs not given by the output keyword
     argument, you should set outfiles within your command.
+
+    Commands are kept small, since pipelines can have millions of them: the
+    attributes every command has are slots, and the paths they hold are
+    interned so that a file used by many commands is only stored once.
+    Subclasses can still set other attributes.
     """
+    __slots__ = ('comment', 'parameters', 'cmd', 'outfiles', 'inputs',
+            'clobber', 'skip', 'shared', 'command_id', '__dict__', '__weakref__')
     descr = ''
+    # Names of the keyword arguments that hold input files (strings with one
+    # or more space-separated paths, or lists of paths). If None, every
+    # keyword argument is searched for paths.
+    input_params = None
     all_commands = [] # Static list of all command objects
+    all_indexes = {} # Static indexes of commands (see get_active_index)
 
     @classmethod
     def clear(cls):
         cls.all_commands = []
+        cls.all_indexes = {}
 
     @classmethod
     def reset(cls):
         cls.all_commands = []
+        cls.all_indexes = {}
+
+    @classmethod
+    def get_active_commands(cls):
+        """
+        Returns the list that new commands are added to: the active Pipeline's
+        commands if there is one, or all_commands otherwise.
+        """
+        if Pipeline.active is not None:
+            return Pipeline.active.commands
+        else:
+            return cls.all_commands
+
+    @classmethod
+    def get_active_index(cls, name, factory):
+        """
+        Returns an index that command classes can keep about the commands
+        they create (e.g. registration.WarpIndex): the active Pipeline's
+        index with the given name if there is one, or a global one otherwise.
+        The index is created by calling factory() the first time.
+        """
+        if Pipeline.active is not None:
+            indexes = Pipeline.active.indexes
+        else:
+            indexes = cls.all_indexes
+        if name not in indexes:
+            indexes[name] = factory()
+        return indexes[name]
 
     @classmethod
     def generate_code_from_datasets(cls, datasets, log_folder, short_id='',
-            tracker=None, clobber_existing_outputs=False, sge=False, wait_time=0):
+            tracker=None, clobber_existing_outputs=False, sge=False, wait_time=0,
+            sge_jobs='script', rebuild_stale_outputs=False, compare_digests=False,
+            commands=None, merge_duplicates=False, shared_folder=None,
+            compact_json=False):
+        """
+        Writes a script with all created commands (see generate_code) to
+        log_folder, and optionally submits it to SGE.
+
+        commands : the commands to write (defaults to all created commands, or
+                   the active Pipeline's commands)
+
+        sge : whether or not to submit to SGE
+        sge_jobs : how to split the commands into SGE jobs: 'script' submits
+                   the whole script as one job, 'command' submits each command
+                   as a separate job, and 'chain' submits each linear chain of
+                   commands as a job. With 'command' and 'chain', jobs wait
+                   (-hold_jid) for the jobs that produce their inputs,
+                   and no script with every command is written.
+        rebuild_stale_outputs, compare_digests : see generate_code
+        merge_duplicates : whether to leave out commands that duplicate
+                           earlier ones (see merge_duplicate_commands). The
+                           commands list (and the tracker's) isn't changed:
+                           the script and the tracker's graph are written for
+                           a merged copy.
+        shared_folder : see generate_code
+        compact_json : whether to write the tracker's pipeline graph in the
+                       compact (gzipped) form (see graphjson)
+
+        Returns the filename of the script, or with sge_jobs 'command' or
+        'chain', the folder with the job scripts.
+        """
+        if commands is None:
+            commands = cls.get_active_commands()
         timestamp = datetime.datetime.now().strftime('%y%m%d-%H%M%S-%f')
         out_script = os.path.join(log_folder, 'pb_%s.%s.sh' % (short_id, timestamp))
+        if merge_duplicates:
+            (unique, merged_into) = merge_duplicate_commands(commands)
+            duplicates = get_duplicates(commands, unique, merged_into)
+            if tracker is not None:
+                from . import tracking
+                if tracker.commands is not commands:
+                    (tracker_unique, _) = merge_duplicate_commands(tracker.commands)
+                else:
+                    tracker_unique = unique
+                tracker = tracking.Tracker(tracker_unique, tracker.datasets)
+            commands = unique
+            if len(duplicates) > 0:
+                print(describe_duplicates(duplicates,
+                    os.path.join(log_folder, 'pb_metadata')))
         if tracker is not None:
             # TODO clean up multiple places where pb_metadata path is constructed
-            json_filename = out_script[:-3] + '.json'
+            json_filename = out_script[:-3] + ('.json.gz' if compact_json else '.json')
             (cmd_file_path, file_prefix) = os.path.split(out_script[:-3])
             metadata_path = os.path.join(cmd_file_path, 'pb_metadata')
             tracker.write_pipeline_to_json(json_filename, metadata_path)
             json_list = os.path.join(log_folder, 'pb_json_list.txt')
-            with open(json_list, 'a') as f:
-                f.write(json_filename + '\n')
-            pass
-        cls.generate_code(out_script, log_folder, datasets, clobber_existing_outputs)
+            # (locked, since other processes may be writing to the same list)
+            util.append_line(json_list, json_filename)
+        if sge and sge_jobs != 'script':
+            # (each job gets its own script, so there's no need for one with
+            # every command)
+            from . import sge as sge_submission
+            if tracker is None:
+                from . import tracking
+                tracker = tracking.Tracker(commands, datasets)
+            job_folder = sge_submission.submit_commands(tracker, datasets,
+                    log_folder, short_id, clobber_existing_outputs,
+                    group_chains=(sge_jobs == 'chain'), wait_time=wait_time,
+                    shared_folder=shared_folder, digest=compare_digests,
+                    file_prefix=os.path.basename(out_script[:-3]))[0]
+            print(job_folder)
+            return job_folder
+        cls.generate_code(out_script, log_folder, datasets, tracker=tracker,
+                clobber_existing_outputs=clobber_existing_outputs,
+                rebuild_stale_outputs=rebuild_stale_outputs,
+                compare_digests=compare_digests, commands=commands,
+                shared_folder=shared_folder)
         print(out_script)
         if sge:
             out_qsub = out_script + '.qsub'
@@ -300,7 +451,8 @@ class Command(object):
     @classmethod
     def generate_code(cls, command_file, log_folder, datasets,
                       tracker=None, clobber_existing_outputs=False,
-                      json_file=None):
+                      json_file=None, rebuild_stale_outputs=False,
+                      compare_digests=False, commands=None, shared_folder=None):
         """
         Writes code to perform all created commands. Commands are run in the
         order they were created; there are no dependency-based reorderings.
@@ -310,61 +462,69 @@ class Command(object):
         tracker : a tracking.Tracker that tracks this dataset/these commands
         clobber_existing_outputs : whether or not to rerun commands whose
         outputs already exist
+        rebuild_stale_outputs : whether or not to rerun commands whose outputs
+        exist but are stale: i.e., their inputs changed since they last ran
+        (or are newer than the outputs), or a command they depend on is rerun.
+        Commands record what their inputs were when they finish (see
+        fingerprint.py).
+        compare_digests : when checking for stale outputs, also compare
+        digests of the inputs' contents, so inputs that were rewritten with
+        the same contents don't trigger reruns
+        commands : the commands to write (defaults to all created commands, or
+        the active Pipeline's commands)
+        shared_folder : a cohort-level folder for sharing the results of
+        commands created with shared=True (e.g. atlas preprocessing) between
+        pipelines: each one only runs once, and pipelines running at the same
+        time wait for it (see shared.py)
         """
         assert command_file.endswith('.sh'), "Command files must end with .sh for now"
+        if commands is None:
+            commands = cls.get_active_commands()
         # TODO incorporate dependencies
         # if tracker is not None:
         #     task_json_prefix = command_file.rsplit('.', 1)[0]
         #     task_json_folder = task_json_prefix + '_taskfiles'
         #     os.mkdir(task_json_folder)
+        if rebuild_stale_outputs:
+            staleness = fingerprint.StalenessChecker(
+                    os.path.join(os.path.dirname(command_file), 'pb_metadata'),
+                    compare_digests, stat_cache)
+        else:
+            staleness = None
         with open(command_file, 'w') as f:
             f.write('#!/usr/bin/env bash\n')
             f.write('set -e\n\n')
-            for command in cls.all_commands: # loop in order listed
-
-                # if tracker is not None:
-                #     import hashlib
-                #     import base64
-                #     filename = base64.urlsafe_b64encode(hashlib.md5(command.cmd).digest())
-                #     command.task_file = os.path.join(task_json_folder, filename + '.json')
-                #     tracker.write_task_json_file(command)
-                # else:
-                #     command.task_file = '/dev/null'
-                command.task_file = '/dev/null'
-
-                # TODO more consistent naming
-                if command.skip:
-                    f.write('# *** Skipping (due to user instructions) ' + command.comment + '\n'*2)
-
-                elif clobber_existing_outputs or command.clobber or not command.check_outputs():
-                    if len(datasets) > 0 and not command.has_all_valid_inputs(datasets):
-                        f.write('# *** Skipping (due to missing input) ' + command.comment + '\n'*2)
-                        command.invalidate_outputs(datasets)
-                    else:
-                        cmdline_hash = base64.urlsafe_b64encode(hashlib.md5(command.cmd).digest())
-                        f.write('# ' + command.comment + '\n')
-                        st = ''
-                        if tracker is not None:
-                            (cmd_file_path, file_prefix) = os.path.split(command_file[:-3])
-                            wrap_files_path = os.path.join(cmd_file_path, 'pb_metadata', cmdline_hash)
-                            try:
-                                os.makedirs(wrap_files_path)
-                            except OSError as exc: # Python >2.5
-                                if exc.errno == errno.EEXIST and os.path.isdir(wrap_files_path):
-                                    pass
-                                else: raise
-                            wrap_files_prefix = os.path.join(wrap_files_path, file_prefix)
-                            wrap = os.path.join(THIS_DIR, '..', 'scripts', 'wrap_simple.py ')
-                            st += wrap + wrap_files_prefix + ' \\\n\\\n'
-                        f.write(st + command.cmd + '\n'*4)
+            for command in commands: # loop in order listed
+
+                skip_reason = command.get_skip_reason(datasets,
+                        clobber_existing_outputs, staleness)
+                if skip_reason is not None:
+                    f.write('# *** Skipping (due to %s) ' % skip_reason + command.comment + '\n'*2)
                 else:
-                    f.write('# *** Skipping (due to already-present output) ' + command.comment + '\n'*2)
+                    f.write('# ' + command.comment + '\n')
+                    st = ''
+                    if tracker is not None:
+                        (cmd_file_path, file_prefix) = os.path.split(command_file[:-3])
+                        wrap_files_prefix = make_metadata_prefix(
+                                os.path.join(cmd_file_path, 'pb_metadata'),
+                                command, file_prefix)
+                        st += WRAP_SIMPLE + ' ' + wrap_files_prefix + ' \\\n\\\n'
+                    f.write(st + command.get_script_cmd(shared_folder,
+                        compare_digests) + '\n')
+                    if staleness is not None:
+                        staleness.mark_rebuilt(command)
+                        f.write(staleness.get_record_command(command) + '\n')
+                    f.write('\n'*3)
+        if staleness is not None:
+            staleness.cache.save()
         os.chmod(command_file, 0775)
+        # Files may change before the next pass, so start it with a fresh cache
+        stat_cache.clear()
 
     def __init__(self, comment, **kwargs):
         self.clobber = 'clobber' in kwargs and kwargs['clobber']
         self.skip = 'skip' in kwargs and kwargs['skip']
-        self.task_file = ''
+        self.shared = 'shared' in kwargs and kwargs['shared']
         if not hasattr(self, 'outfiles'):
             if 'output' not in kwargs:
                 self.outfiles = []
@@ -372,37 +532,116 @@ class Command(object):
                         RuntimeWarning)
             else:
                 self.outfiles = [kwargs['output']]
+        self.outfiles = [intern_path(to_filename(f)) for f in self.outfiles]
 
+        for (k, v) in kwargs.iteritems():
+            if type(v) is str and has_valid_path(v):
+                kwargs[k] = intern(v)
         self.parameters = kwargs
         self.comment = comment
 
         good_kwargs = dict( ((k, to_filename(v)) for (k, v) in kwargs.iteritems()) )
-        self.cmd_template = self.cmd
         self.cmd = self.cmd % good_kwargs
 
-        self.command_id = len(Command.all_commands)
-        Command.all_commands.append(self) # order is very important here
-
+        if Pipeline.active is not None:
+            Pipeline.active.check_size()
+        registry = Command.get_active_commands()
+        self.command_id = len(registry)
+        registry.append(self) # order is very important here
 
         # Tracking of input/output relationships between commands.
-        inputs = []
-        self.inputs = []
-        # TODO smarter checking of inputs/outputs here
-        for (k, v) in self.parameters.items():
-            if k == 'cmdName':
-                continue
+        if self.input_params is None:
+            # TODO smarter checking of inputs/outputs here
+            params = [k for k in kwargs if k != 'cmdName']
+        else:
+            params = [k for k in self.input_params if k in kwargs]
+        inputs = set()
+        for k in params:
+            v = kwargs[k]
             if type(v) is str:
-                # split on non-escaped spaces (since escaped spaces could be
-                # filenames)
-                inputs.extend(re.split(r'(?<!\\)\s+', v))
+                values = split_paths(v)
             elif type(v) is list or type(v) is tuple:
-                inputs.extend(v)
-        for v in inputs:
-            if (type(v) is str and has_valid_path(v)) or \
-                    hasattr(v, 'filename'):
-                self.inputs.append(v)
+                values = v
+            else:
+                continue
+            for v in values:
+                if (type(v) is str and has_valid_path(v)) or \
+                        hasattr(v, 'filename'):
+                    inputs.add(intern_path(to_filename(v)))
+        self.inputs = inputs.difference(self.outfiles)
+
+    def __getstate__(self):
+        # (classes with slots can only be pickled with protocol 2 otherwise)
+        state = dict((name, getattr(self, name)) for name in Command.__slots__
+                if not name.startswith('__') and hasattr(self, name))
+        state.update(getattr(self, '__dict__', {}))
+        return state
+
+    def __setstate__(self, state):
+        for (name, value) in state.iteritems():
+            setattr(self, name, value)
+
+    def get_python_task(self):
+        """
+        Returns (function, args) such that function(*args) does the same
+        thing as this command's command line, but inside a Python process, or
+        None if the command can only be run as a command line. Used by
+        executor.execute with in_process=True. function must be picklable
+        (i.e., defined at module level).
+        """
+        return None
+
+    def get_batch_key(self):
+        """
+        Returns a key saying which commands can be run together in one batch
+        (see get_batch_task), or None if this command can't be batched.
+        """
+        return None
+
+    def get_batch_task(self, commands, batch_prefix):
+        """
+        Returns (function, args) such that function(*args) runs all the given
+        commands (which have the same batch key as this one) at once, and
+        returns a list with each one's exit status. Files describing the
+        batch can be written to names starting with batch_prefix.
+        """
+        raise NotImplementedError
+
+    def get_script_cmd(self, shared_folder=None, digest=False):
+        """
+        Returns the command line to run this command with. If the command is
+        shared (created with shared=True) and shared_folder is given, it runs
+        through shared.py so that pipelines containing the same command share
+        one result (see shared.py). digest says whether to compare digests of
+        the inputs when checking if a shared result can be reused.
+        """
+        if self.shared and shared_folder is not None:
+            from . import shared
+            return shared.get_shared_command(self, shared_folder, digest)
+        return self.cmd
 
-        self.inputs = set(map(to_filename, self.inputs)).difference(map(to_filename, self.outfiles))
+    def get_skip_reason(self, datasets, clobber_existing_outputs=False,
+            staleness=None):
+        """
+        Decides whether this command should be run. Returns None if it
+        should, or a string saying why it's being skipped. If it's skipped
+        because of a missing input, its outputs are invalidated too.
+
+        staleness : a fingerprint.StalenessChecker, if commands with stale
+        outputs should be rerun
+        """
+        # TODO more consistent naming
+        if self.skip:
+            return 'user instructions'
+        elif clobber_existing_outputs or self.clobber or not self.check_outputs() \
+                or (staleness is not None and staleness.is_stale(self)):
+            if len(datasets) > 0 and not self.has_all_valid_inputs(datasets):
+                self.invalidate_outputs(datasets)
+                return 'missing input'
+            else:
+                return None
+        else:
+            return 'already-present output'
 
     def check_outputs(self):
         """
@@ -414,7 +653,7 @@ class Command(object):
             new_outfiles.append(to_filename(f))
 
         return len(self.outfiles) > 0 and \
-                all([os.path.exists(f) for f in new_outfiles])
+                all([stat_cache.exists(f) for f in new_outfiles])
 
     def has_all_valid_inputs(self, datasets):
         for input in self.inputs:
@@ -432,6 +671,178 @@ class Command(object):
                 # TODO fix this: find the right dataset and only invalidate once
                 dataset.invalidate(output)
 
+class Pipeline(object):
+    """
+    A group of commands (e.g., all the commands for one subject), so that one
+    process can build and generate scripts for many subjects. While a
+    pipeline is active, newly created commands are added to it instead of to
+    Command.all_commands:
+
+        with Pipeline(subj) as pipeline:
+            ... create commands for subj ...
+            pipeline.generate_code_from_datasets(datasets, log_folder)
+
+    See build_cohort for building many pipelines.
+    """
+    active = None # The pipeline that new commands are added to
+
+    def __init__(self, name='', max_commands=None):
+        """
+        max_commands bounds how many commands the pipeline can hold (so a
+        runaway build fails early rather than exhausting memory); by default
+        it's unbounded.
+        """
+        self.name = name
+        self.commands = []
+        self.indexes = {}
+        self.previous = None
+        self.max_commands = max_commands
+
+    def __enter__(self):
+        self.previous = Pipeline.active
+        Pipeline.active = self
+        return self
+
+    def __exit__(self, *exc_info):
+        Pipeline.active = self.previous
+        self.previous = None
+
+    def check_size(self):
+        """ Raises an error if the pipeline can't hold another command """
+        if self.max_commands is not None and len(self.commands) >= self.max_commands:
+            raise RuntimeError("Pipeline '%s' already has %d commands (its max_commands)" %
+                    (self.name, self.max_commands))
+
+    def make_tracker(self, datasets):
+        """ Returns a tracking.Tracker for this pipeline's commands """
+        from . import tracking
+        return tracking.Tracker(self.commands, datasets)
+
+    def generate_code_from_datasets(self, datasets, log_folder, short_id=None,
+            **kwargs):
+        """
+        Writes a script for this pipeline's commands (creating log_folder if
+        needed). short_id defaults to the pipeline's name; see Command.generate_code_from_datasets for the other
+        arguments.
+        """
+        if short_id is None:
+            short_id = self.name
+        util.make_folder(log_folder)
+        return Command.generate_code_from_datasets(datasets, log_folder,
+                short_id, commands=self.commands, **kwargs)
+
+def _build_pipeline(build_function, name):
+    with Pipeline(name) as pipeline:
+        return build_function(pipeline, name)
+
+def build_cohort(build_function, names, processes=1):
+    """
+    Builds a pipeline for each name in names (e.g., for each subject) in a
+    single process, or spread across a pool of processes.
+
+    build_function(pipeline, name) is called with each pipeline active: it
+    should create the commands for that name and generate code (e.g. with
+    pipeline.generate_code_from_datasets). With more than one process, it
+    must be a module-level function (so it can be pickled).
+
+    Returns a list of whatever build_function returns for each name.
+    """
+    if processes == 1:
+        return [_build_pipeline(build_function, name) for name in names]
+    pool = multiprocessing.Pool(processes)
+    try:
+        out = pool.map(functools.partial(_build_pipeline, build_function), names)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return out
+
+def get_cmdline_hash(cmd):
+    """
+    Returns a (filename-safe) hash of a command line. This names the folder
+    that a command's metadata gets stored in.
+    """
+    return base64.urlsafe_b64encode(hashlib.md5(cmd).digest())
+
+def merge_duplicate_commands(commands):
+    """
+    Merges commands that duplicate an earlier command (same command line
+    hash and outputs) into it, so that they only run once. Commands that used
+    a duplicate's outputs depend on the earlier command instead, since it
+    produces the same files. The kept command is clobbered if any of its
+    duplicates were, and skipped only if they all were.
+
+    Returns (unique, merged_into): a new list of the kept commands, and for
+    each command in commands, the index in unique of the command it was
+    merged into (or of itself, if it was kept). The list commands isn't
+    changed, but the kept commands are the same objects, so their clobber
+    and skip flags are updated in place.
+    """
+    kept = {} # maps key -> index in unique
+    unique = []
+    merged_into = []
+    for command in commands:
+        key = (get_cmdline_hash(command.cmd), tuple(sorted(command.outfiles)))
+        if key in kept:
+            original = unique[kept[key]]
+            original.clobber = original.clobber or command.clobber
+            original.skip = original.skip and command.skip
+        else:
+            kept[key] = len(unique)
+            unique.append(command)
+        merged_into.append(kept[key])
+    return (unique, merged_into)
+
+def get_duplicates(commands, unique, merged_into):
+    """ Returns the commands that merge_duplicate_commands left out """
+    return [command for (command, j) in zip(commands, merged_into)
+            if unique[j] is not command]
+
+def describe_duplicates(duplicates, metadata_path=None):
+    """
+    Describes how much work merge_duplicate_commands saved (by leaving out
+    duplicates, see get_duplicates). With
+    metadata_path, uses the duplicates' run times from previous runs (see
+    tracking.Tracker.load_task_timings) to estimate the time saved.
+    """
+    out = 'Merged %d duplicate commands' % len(duplicates)
+    if metadata_path is not None and len(duplicates) > 0:
+        from . import tracking
+        timings = tracking.Tracker(duplicates, []).load_task_timings(metadata_path)
+        known = [t for t in timings if t is not None]
+        if len(known) > 0:
+            out += ' (saving %.1f seconds, based on previous runs of %d of them)' % \
+                    (sum(known), len(known))
+    return out
+
+def make_metadata_prefix(metadata_path, command, file_prefix):
+    """
+    Creates the metadata folder for a command (within metadata_path) and
+    returns the prefix that the wrapper should use for its metadata files.
+    """
+    wrap_files_path = os.path.join(metadata_path, get_cmdline_hash(command.cmd))
+    util.make_folder(wrap_files_path)
+    return os.path.join(wrap_files_path, file_prefix)
+
+def intern_path(filename):
+    """
+    Interns a filename (if it's a plain string), so that every command using
+    the file shares one copy.
+    """
+    return intern(filename) if type(filename) is str else filename
+
+def split_paths(value):
+    """
+    Splits a string of paths on spaces that aren't escaped (since escaped
+    spaces could be in filenames).
+    """
+    if '\\' not in value:
+        return value.split()
+    return re.split(r'(?<!\\)\s+', value)
+
 def has_valid_path(filename):
     #return os.path.isdir(os.path.dirname(filename))
     # what if options start with slashes?
@@ -0,0 +1,406 @@
+"""
+Runs commands directly on the local machine instead of writing them to a
+script. Commands whose inputs are ready run in parallel, using the
+input/output relationships between commands to decide what can run when.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import Queue
+import shutil
+import datetime
+import resource
+import tempfile
+import traceback
+import subprocess
+import collections
+import multiprocessing
+
+from . import core
+from . import util
+from . import fingerprint
+from . import graph
+
+# Statuses that execute() reports for each command
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+ALREADY_DONE = 'already done'           # outputs were already present
+SKIPPED = 'skipped'                     # user asked for it to be skipped
+MISSING_INPUT = 'missing input'         # an input was invalidated
+UPSTREAM_FAILED = 'upstream failed'     # a command it depends on failed
+
+# Statuses after which a command's outputs can't be trusted
+BAD_STATUSES = (FAILED, MISSING_INPUT, UPSTREAM_FAILED)
+
+def run_shell_command(cmd):
+    """
+    Runs a command line with bash (the same way the generated scripts do) and
+    returns its exit status.
+    """
+    return subprocess.call(cmd, shell=True, executable='/bin/bash')
+
+def run_python_task(func, args, wrap_files_prefix=None):
+    """
+    Runs func(*args) in this process and returns an exit status: func's
+    return value if it's an integer (0 if it's None), the code passed to
+    sys.exit, or 1 if it raised an exception.
+
+    If wrap_files_prefix is given, output and metadata are written to the
+    same files as wrap_simple.py writes for command lines (<prefix>_stdout,
+    <prefix>_stderr, <prefix>_summary.json and <prefix>_retcode). Since the
+    process is shared with other tasks, max_rss_kb is the peak for the whole
+    process rather than for this task.
+    """
+    if wrap_files_prefix is None:
+        return _call(func, args)
+
+    start_time = time.time()
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    with open(wrap_files_prefix + '_stdout', 'wb') as stdout_file, \
+            open(wrap_files_prefix + '_stderr', 'wb') as stderr_file:
+        # redirect the file descriptors (not just sys.stdout/sys.stderr) so
+        # that output from compiled libraries is captured too
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = (os.dup(1), os.dup(2))
+        os.dup2(stdout_file.fileno(), 1)
+        os.dup2(stderr_file.fileno(), 2)
+        try:
+            retcode = _call(func, args)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    summary = {'retcode': retcode,
+               'stdout_file': wrap_files_prefix + '_stdout',
+               'stderr_file': wrap_files_prefix + '_stderr',
+               'start_time': start_time,
+               'wall_time': time.time() - start_time,
+               'user_time': usage.ru_utime - start_usage.ru_utime,
+               'sys_time': usage.ru_stime - start_usage.ru_stime,
+               'max_rss_kb': usage.ru_maxrss,
+               'input_blocks': usage.ru_inblock - start_usage.ru_inblock,
+               'output_blocks': usage.ru_oublock - start_usage.ru_oublock}
+    with open(wrap_files_prefix + '_summary.json', 'w') as f:
+        json.dump(summary, f)
+    with open(wrap_files_prefix + '_retcode', 'w') as f:
+        f.write(str(retcode))
+    return retcode
+
+def run_batch_task(func, args, wrap_files_prefixes=None, batch_prefix=None):
+    """
+    Runs a batch of commands with func(*args) (see Command.get_batch_task)
+    and returns the exit status of each one.
+
+    If wrap_files_prefixes (one per command) is given, each command gets the
+    same metadata files as wrap_simple.py writes, so that its status and run
+    time can be tracked like any other command's. A command's output is part
+    of the batch's (in <batch_prefix>_stdout and <batch_prefix>_stderr), and
+    its wall time is its share of the batch's.
+    """
+    if wrap_files_prefixes is None:
+        return func(*args)
+
+    for prefix in wrap_files_prefixes:
+        # (marks the command as running, like the wrapper's output files)
+        with open(prefix + '_stdout', 'w') as f:
+            f.write('Running in batch %s\n' % batch_prefix)
+    start_time = time.time()
+    try:
+        retcodes = func(*args)
+    except Exception:
+        traceback.print_exc()
+        retcodes = [1] * len(wrap_files_prefixes)
+    wall_time = time.time() - start_time
+
+    for (prefix, retcode) in zip(wrap_files_prefixes, retcodes):
+        summary = {'retcode': retcode,
+                   'stdout_file': batch_prefix + '_stdout',
+                   'stderr_file': batch_prefix + '_stderr',
+                   'start_time': start_time,
+                   'wall_time': wall_time / len(wrap_files_prefixes),
+                   'batch_prefix': batch_prefix,
+                   'batch_wall_time': wall_time,
+                   'batch_size': len(wrap_files_prefixes)}
+        with open(prefix + '_summary.json', 'w') as f:
+            json.dump(summary, f)
+        with open(prefix + '_retcode', 'w') as f:
+            f.write(str(retcode))
+    return retcodes
+
+def _call(func, args):
+    try:
+        out = func(*args)
+    except SystemExit as e:
+        out = e.code
+        if out is not None and not isinstance(out, int):
+            print(out, file=sys.stderr)
+            out = 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return out if isinstance(out, int) else 0
+
+def _run_task(index, func, args):
+    """
+    Runs func(*args) in a worker process. Exceptions are reported and turned
+    into a nonzero status since the pool can't pass them back to us.
+    """
+    try:
+        return (index, func(*args))
+    except Exception:
+        traceback.print_exc()
+        return (index, -1)
+
+def compute_dependencies(commands):
+    """
+    Computes which commands depend on which, using the outputs of each
+    command and the inputs of the commands created after it.
+
+    Returns (parents, children): lists of lists of indices into commands.
+    """
+    dependencies = graph.DependencyGraph(commands)
+    parents = []
+    children = []
+    for i in xrange(len(commands)):
+        parents.append([int(p) for p in dependencies.parents(i) if p < i])
+        children.append([int(c) for c in dependencies.children(i) if c > i])
+    return (parents, children)
+
+def group_batches(commands, parents):
+    """
+    Groups commands that can run together as one batch: commands with the
+    same batch key (see Command.get_batch_key) and the same depth in the
+    dependency graph (so none of them depends on another).
+
+    Returns a list of groups (lists of indices into commands); commands that
+    can't be batched are in groups of their own.
+    """
+    depth = []
+    for i in xrange(len(commands)):
+        depth.append(1 + max([depth[p] for p in parents[i]] + [-1]))
+    groups = []
+    group_of_key = {}
+    for (i, command) in enumerate(commands):
+        key = command.get_batch_key()
+        if key is None:
+            groups.append([i])
+        elif (key, depth[i]) in group_of_key:
+            groups[group_of_key[(key, depth[i])]].append(i)
+        else:
+            group_of_key[(key, depth[i])] = len(groups)
+            groups.append([i])
+    return groups
+
+def execute(commands=None, datasets=(), max_workers=None, log_folder=None,
+        short_id='', clobber_existing_outputs=False,
+        rebuild_stale_outputs=False, compare_digests=False, in_process=False,
+        batch=False, merge_duplicates=False, shared_folder=None):
+    """
+    Runs commands in a pool of worker processes. A command is started as
+    soon as all the commands that produce its inputs have finished. If a
+    command fails, every command that depends on it (directly or indirectly)
+    is skipped, but independent commands keep running.
+
+    The same rules as Command.generate_code decide whether to run each
+    command: commands marked skip are skipped, commands whose outputs exist
+    are skipped unless clobbering, and commands with invalidated inputs are
+    skipped (and their outputs invalidated).
+
+    commands : a list of Command objects (defaults to all created commands,
+               or the active Pipeline's commands)
+    datasets : a list of dataset objects to cross-check commands against
+    max_workers : number of commands to run at once (defaults to #cpus)
+    log_folder : if given, commands are run through the wrapper and their
+                 output/metadata is stored under log_folder/pb_metadata
+    short_id : a short name used in the metadata filenames
+    clobber_existing_outputs : whether or not to rerun commands whose
+                               outputs already exist
+    rebuild_stale_outputs, compare_digests : see Command.generate_code
+                                             (requires log_folder, where
+                                             stamps are kept)
+    in_process : whether to run commands that support it (see
+                 Command.get_python_task) inside the worker processes instead
+                 of starting a new program for each one. Workers live for the
+                 whole run, so modules they import are only loaded once.
+    batch : whether to run commands that support it (e.g. MCC commands for
+            the same MATLAB function) as one batch (see group_batches and
+            Command.get_batch_task). A batch starts once all its commands'
+            inputs are ready, and each command gets its own status.
+    merge_duplicates : whether to only run one of each set of duplicate
+                       commands (see core.merge_duplicate_commands). The
+                       commands list isn't changed, and duplicates get the
+                       status of the command they were merged into.
+    shared_folder : see Command.generate_code
+
+    Returns a list with the status of each command (see the module
+    constants SUCCEEDED, FAILED, etc).
+    """
+    if rebuild_stale_outputs and log_folder is None:
+        raise ValueError("rebuild_stale_outputs requires a log_folder to keep stamps in")
+    if commands is None:
+        commands = core.Command.get_active_commands()
+    metadata_path = None
+    if log_folder is not None:
+        timestamp = datetime.datetime.now().strftime('%y%m%d-%H%M%S-%f')
+        metadata_path = os.path.join(log_folder, 'pb_metadata')
+        file_prefix = 'pb_%s.%s' % (short_id, timestamp)
+        batch_folder = os.path.join(metadata_path, 'batches')
+    elif batch:
+        batch_folder = tempfile.mkdtemp(prefix='pb_batches')
+    merged_into = None
+    if merge_duplicates:
+        (unique, merged_into) = core.merge_duplicate_commands(commands)
+        duplicates = core.get_duplicates(commands, unique, merged_into)
+        if len(duplicates) > 0:
+            print(core.describe_duplicates(duplicates, metadata_path))
+        commands = unique
+    (parents, children) = compute_dependencies(commands)
+    if rebuild_stale_outputs:
+        staleness = fingerprint.StalenessChecker(metadata_path, compare_digests,
+                core.stat_cache)
+    else:
+        staleness = None
+
+    # Commands are run in groups: batches, or single commands
+    if batch:
+        groups = group_batches(commands, parents)
+    else:
+        groups = [[i] for i in xrange(len(commands))]
+    group_of = [None] * len(commands)
+    for (g, group) in enumerate(groups):
+        for i in group:
+            group_of[i] = g
+    group_children = []
+    n_waiting = []
+    for group in groups:
+        group_children.append(sorted(set(group_of[c] for i in group for c in children[i])))
+        n_waiting.append(len(set(group_of[p] for i in group for p in parents[i])))
+
+    statuses = [None] * len(commands)
+    upstream_failed = [False] * len(commands)
+    ready = collections.deque(g for (g, n) in enumerate(n_waiting) if n == 0)
+
+    def finish(i, status):
+        statuses[i] = status
+        command = commands[i]
+        for outp in command.outfiles:
+            core.stat_cache.invalidate(outp)
+        if status in BAD_STATUSES:
+            command.invalidate_outputs(datasets)
+            for child in children[i]:
+                upstream_failed[child] = True
+        print('[%s] %s' % (status, command.comment))
+
+    def finish_group(g):
+        for child in group_children[g]:
+            n_waiting[child] -= 1
+            if n_waiting[child] == 0:
+                ready.append(child)
+
+    def decide(i):
+        command = commands[i]
+        if command.skip:
+            return SKIPPED
+        elif upstream_failed[i]:
+            return UPSTREAM_FAILED
+        elif clobber_existing_outputs or command.clobber or not command.check_outputs() \
+                or (staleness is not None and staleness.is_stale(command)):
+            if len(datasets) > 0 and not command.has_all_valid_inputs(datasets):
+                return MISSING_INPUT
+            else:
+                return None
+        else:
+            return ALREADY_DONE
+
+    def make_task(i):
+        command = commands[i]
+        wrap_files_prefix = None
+        if log_folder is not None:
+            wrap_files_prefix = core.make_metadata_prefix(metadata_path,
+                    command, file_prefix)
+        python_task = command.get_python_task() if in_process else None
+        if python_task is not None:
+            (func, args) = python_task
+            return (run_python_task, (func, args, wrap_files_prefix))
+        cmd = command.get_script_cmd(shared_folder, compare_digests)
+        if wrap_files_prefix is not None:
+            cmd = core.WRAP_SIMPLE + ' ' + wrap_files_prefix + ' ' + cmd
+        return (run_shell_command, (cmd,))
+
+    def make_batch_task(g, to_run):
+        util.make_folder(batch_folder)
+        name = file_prefix if log_folder is not None else 'pb_' + short_id
+        batch_prefix = os.path.join(batch_folder, '%s_batch%d' % (name, g))
+        batch_commands = [commands[i] for i in to_run]
+        (func, args) = batch_commands[0].get_batch_task(batch_commands, batch_prefix)
+        wrap_files_prefixes = None
+        if log_folder is not None:
+            wrap_files_prefixes = [core.make_metadata_prefix(metadata_path,
+                command, file_prefix) for command in batch_commands]
+        return (run_batch_task, (func, args, wrap_files_prefixes, batch_prefix))
+
+    results = Queue.Queue()
+    running = {} # maps group -> commands in it that are running
+    pool = multiprocessing.Pool(max_workers)
+    try:
+        while len(ready) > 0 or len(running) > 0:
+            while len(ready) > 0:
+                g = ready.popleft()
+                to_run = []
+                for i in groups[g]:
+                    status = decide(i)
+                    if status is None:
+                        to_run.append(i)
+                    else:
+                        finish(i, status)
+                if len(to_run) == 0:
+                    finish_group(g)
+                    continue
+                if len(to_run) == 1:
+                    task = make_task(to_run[0])
+                else:
+                    task = make_batch_task(g, to_run)
+                for i in to_run:
+                    if staleness is not None:
+                        staleness.mark_rebuilt(commands[i])
+                    print('[started] ' + commands[i].comment)
+                running[g] = to_run
+                pool.apply_async(_run_task, (g,) + task, callback=results.put)
+            if len(running) > 0:
+                # (a timeout keeps the wait interruptible with ctrl-c)
+                while True:
+                    try:
+                        (g, result) = results.get(True, 1)
+                        break
+                    except Queue.Empty:
+                        continue
+                to_run = running.pop(g)
+                retcodes = result if isinstance(result, list) else [result] * len(to_run)
+                for (i, retcode) in zip(to_run, retcodes):
+                    if retcode == 0 and staleness is not None:
+                        staleness.record(commands[i])
+                    finish(i, SUCCEEDED if retcode == 0 else FAILED)
+                finish_group(g)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if staleness is not None:
+            staleness.cache.save()
+        if batch and log_folder is None:
+            shutil.rmtree(batch_folder, ignore_errors=True)
+        core.stat_cache.clear()
+    if merged_into is not None:
+        statuses = [statuses[j] for j in merged_into]
+    return statuses
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Tracks fingerprints of files (modification time and size, and optionally an
+md5 digest of the contents) so that commands can be rerun only when their
+inputs or command lines change, make-style.
+
+When a command finishes, a stamp with its command line hash and the
+fingerprints of its inputs is written for its outputs. A command is stale if
+its command line hash or its inputs no longer match the stamp, or (when its
+outputs don't have a stamp yet) if its outputs are older than its inputs.
+
+This module only uses the standard library so that generated scripts can run
+it directly to record stamps:
+    python fingerprint.py record <stamp file> <cache file> <digest> <hash> <inputs...>
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import errno
+import fcntl
+import hashlib
+import tempfile
+
+# Name of the folder (in the metadata folder) holding stamps
+STAMP_FOLDER = 'stamps'
+# Name of the file (in the metadata folder) caching fingerprints
+CACHE_FILENAME = 'fingerprints.json'
+
+def compute_digest(filename, blocksize=2**20):
+    """ Computes the md5 digest of a file's contents """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+class FingerprintCache(object):
+    """
+    Persistent cache of file fingerprints. Digests are only recomputed when a
+    file's modification time or size changes, so large files aren't rehashed
+    every time.
+    """
+    def __init__(self, filename=None):
+        """
+        filename is a JSON file to load the cache from and save it to. If it's
+        None, the cache isn't persisted.
+        """
+        self.filename = filename
+        self.entries = {}
+        self.modified = False
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def fingerprint(self, filename, digest=False):
+        """
+        Returns the fingerprint of a file: [mtime, size], or
+        [mtime, size, md5 digest] if digest is True. Returns None if the file
+        doesn't exist.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        out = [st.st_mtime, st.st_size]
+        if not digest:
+            return out
+        cached = self.entries.get(filename)
+        if cached is not None and cached[:2] == out:
+            return cached
+        out.append(compute_digest(filename))
+        self.entries[filename] = out
+        self.modified = True
+        return out
+
+    def save(self):
+        """
+        Saves the cache. Entries already saved by other processes are kept
+        (the file is locked while saving).
+        """
+        if self.filename is None or not self.modified:
+            return
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = {}
+            if os.path.exists(self.filename):
+                with open(self.filename) as f:
+                    entries = json.load(f)
+            entries.update(self.entries)
+            (fd, tmp_filename) = tempfile.mkstemp(dir=os.path.dirname(self.filename))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_filename, self.filename)
+        self.modified = False
+
+def same_fingerprint(recorded, current):
+    """
+    Checks a recorded fingerprint against a current one. Files whose times or
+    sizes changed but whose digests didn't are considered unchanged.
+    """
+    if recorded is None or current is None:
+        return recorded == current
+    if recorded[:2] == current[:2]:
+        return True
+    return len(recorded) > 2 and len(current) > 2 and recorded[2] == current[2]
+
+def write_stamp(stamp_file, cache, digest, cmdline_hash, inputs):
+    """ Records the fingerprints of inputs in stamp_file """
+    stamp = {'cmdline_hash': cmdline_hash,
+             'inputs': dict((inp, cache.fingerprint(inp, digest)) for inp in inputs)}
+    try:
+        os.makedirs(os.path.dirname(stamp_file))
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(os.path.dirname(stamp_file)):
+            pass
+        else: raise
+    with open(stamp_file, 'w') as f:
+        json.dump(stamp, f)
+
+class StalenessChecker(object):
+    """
+    Decides which commands have stale outputs, and records stamps when
+    commands finish. Once a command is found stale (and rerun), everything
+    that uses its outputs is stale too.
+    """
+    def __init__(self, metadata_path, digest=False, stat_cache=None):
+        """
+        metadata_path: folder containing each command's metadata folder
+        digest: whether to also compare md5 digests of inputs (so that
+                inputs that were touched but not changed don't cause reruns)
+        stat_cache: a statcache.StatCache to look up modification times with
+        """
+        self.metadata_path = metadata_path
+        self.digest = digest
+        self.stat_cache = stat_cache
+        self.cache = FingerprintCache(os.path.join(metadata_path, CACHE_FILENAME))
+        self.rebuilt_files = set()
+
+    def get_cmdline_hash(self, command):
+        from .core import get_cmdline_hash
+        return get_cmdline_hash(command.cmd)
+
+    def get_stamp_filename(self, command):
+        """ Returns the file holding the stamp for a command's outputs """
+        outputs_hash = hashlib.md5('\n'.join(sorted(command.outfiles))).hexdigest()
+        return os.path.join(self.metadata_path, STAMP_FOLDER, outputs_hash + '.json')
+
+    def is_stale(self, command):
+        """
+        Checks if a command whose outputs exist needs to be rerun.
+        """
+        if not self.rebuilt_files.isdisjoint(command.inputs):
+            return True
+        stamp_file = self.get_stamp_filename(command)
+        if not os.path.exists(stamp_file):
+            # No stamp: fall back to comparing modification times
+            output_times = [self.getmtime(f) for f in command.outfiles]
+            for inp in command.inputs:
+                input_time = self.getmtime(inp)
+                if input_time is not None and input_time > min(output_times):
+                    return True
+            return False
+        with open(stamp_file) as f:
+            stamp = json.load(f)
+        if stamp['cmdline_hash'] != self.get_cmdline_hash(command):
+            return True
+        recorded = stamp['inputs']
+        if set(recorded.keys()) != set(command.inputs):
+            return True
+        for (inp, fingerprint) in recorded.iteritems():
+            use_digest = fingerprint is not None and len(fingerprint) > 2
+            current = self.cache.fingerprint(inp, use_digest)
+            if not same_fingerprint(fingerprint, current):
+                return True
+        return False
+
+    def getmtime(self, filename):
+        """ Returns a file's modification time (None if it doesn't exist) """
+        if self.stat_cache is not None:
+            return self.stat_cache.getmtime(filename)
+        elif os.path.exists(filename):
+            return os.path.getmtime(filename)
+        else:
+            return None
+
+    def mark_rebuilt(self, command):
+        """ Notes that a command will be rerun (so its outputs will change) """
+        self.rebuilt_files.update(command.outfiles)
+
+    def record(self, command):
+        """ Records a stamp for a command that just finished successfully """
+        write_stamp(self.get_stamp_filename(command), self.cache, self.digest,
+                self.get_cmdline_hash(command), command.inputs)
+
+    def get_record_command(self, command):
+        """
+        Returns a command line that records a stamp for command (for running
+        after it in a script)
+        """
+        from .util import shell_join
+        return shell_join([sys.executable,
+            os.path.splitext(os.path.abspath(__file__))[0] + '.py',
+            'record', self.get_stamp_filename(command), self.cache.filename,
+            str(int(self.digest)), self.get_cmdline_hash(command)] +
+            sorted(command.inputs))
+
+def main(argv):
+    USAGE = '{} record <stamp file> <cache file> <digest (0/1)> <cmdline hash> <inputs...>'
+    if len(argv) < 6 or argv[1] != 'record':
+        print(USAGE.format(argv[0]), file=sys.stderr)
+        sys.exit(1)
+    (stamp_file, cache_file, digest, cmdline_hash) = argv[2:6]
+    cache = FingerprintCache(cache_file)
+    write_stamp(stamp_file, cache, digest == '1', cmdline_hash, argv[6:])
+    cache.save()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,114 @@
+"""
+Sparse representation of the dependencies between commands.
+"""
+import collections
+
+import numpy as np
+
+class DependencyGraph(object):
+    """
+    Directed graph of dependencies between commands: there's an edge from
+    command i to command j if one of i's outputs is one of j's inputs.
+
+    Built in time proportional to the total number of input/output files
+    using an index from each output file to the commands that produce it.
+    Edges are stored in compressed sparse row (CSR) form in both directions,
+    so children and parents can both be looked up quickly.
+    """
+    def __init__(self, commands):
+        """
+        commands is a list of Command objects; nodes of the graph are indices
+        into this list.
+        """
+        self.n_nodes = len(commands)
+
+        # index from output file to the commands that produce it
+        self.producers = collections.defaultdict(list)
+        for (i, command) in enumerate(commands):
+            for outp in command.outfiles:
+                self.producers[outp].append(i)
+
+        # maps (i, j) to the list of i's outputs that j depends on
+        self.edge_files = collections.defaultdict(list)
+        for (j, command) in enumerate(commands):
+            for inp in command.inputs:
+                if inp in self.producers:
+                    for i in self.producers[inp]:
+                        self.edge_files[(i, j)].append(inp)
+
+        edges = np.array(sorted(self.edge_files.keys()), dtype=np.int64).reshape(-1, 2)
+        (self.child_indptr, self.child_indices) = _to_csr(edges[:, 0], edges[:, 1], self.n_nodes)
+        (self.parent_indptr, self.parent_indices) = _to_csr(edges[:, 1], edges[:, 0], self.n_nodes)
+
+    @property
+    def n_edges(self):
+        return len(self.child_indices)
+
+    def children(self, i):
+        """ Returns the (sorted) commands that depend on command i """
+        return self.child_indices[self.child_indptr[i]:self.child_indptr[i+1]]
+
+    def parents(self, j):
+        """ Returns the (sorted) commands that command j depends on """
+        return self.parent_indices[self.parent_indptr[j]:self.parent_indptr[j+1]]
+
+    def files(self, i, j):
+        """ Returns the outputs of command i that command j depends on """
+        return self.edge_files.get((i, j), [])
+
+    def weight(self, i, j):
+        """ Returns the number of files that command j needs from command i """
+        return len(self.files(i, j))
+
+    def edges(self):
+        """ Iterates over (i, j, files) for every edge in the graph """
+        for i in xrange(self.n_nodes):
+            for j in self.children(i):
+                j = int(j)
+                yield (i, j, self.edge_files[(i, j)])
+
+    def layers(self, bottom_up=False):
+        """
+        Splits the nodes into layers with Kahn's algorithm: the first layer
+        has the nodes without parents, and each later layer has the nodes
+        whose last parent is in the layer before it. With bottom_up, parents
+        and children swap roles (so the first layer has the nodes without
+        children). Within a layer, nodes are in the order their last parent
+        was reached. Nodes on cycles are left out. Takes O(nodes + edges)
+        time.
+        """
+        if bottom_up:
+            (indptr, indices, in_indptr) = (self.parent_indptr,
+                    self.parent_indices, self.child_indptr)
+        else:
+            (indptr, indices, in_indptr) = (self.child_indptr,
+                    self.child_indices, self.parent_indptr)
+        # (plain lists are much faster than numpy arrays element by element)
+        indptr = indptr.tolist()
+        indices = indices.tolist()
+        remaining = np.diff(in_indptr).tolist() # unvisited parents of each node
+        layer = [i for i in xrange(self.n_nodes) if remaining[i] == 0]
+        layers = []
+        while True:
+            next_layer = []
+            for node in layer:
+                for child in indices[indptr[node]:indptr[node+1]]:
+                    remaining[child] -= 1
+                    if remaining[child] == 0:
+                        next_layer.append(child)
+            layers.append(layer)
+            if next_layer == []:
+                break
+            layer = next_layer
+        return layers
+
+def _to_csr(rows, cols, n):
+    """
+    Converts an edge list to CSR form: the neighbors of node i are
+    indices[indptr[i]:indptr[i+1]], sorted.
+    """
+    order = np.lexsort((cols, rows))
+    indices = cols[order]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return (indptr, indices)
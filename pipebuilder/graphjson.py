@@ -0,0 +1,174 @@
+"""
+Reads and writes pipeline graph JSONs (see Tracker.write_pipeline_to_json),
+and aggregates of them (see tracking.gather_multi_subject_jsons).
+
+Files whose names end with .gz are written in a compact form. Paths and
+other strings are stored once in a string table, fields that can be derived
+from others (such as task_info, which mostly repeats the node, and
+reverse_mapping) are left out, and the result is gzipped. An aggregate
+shares one string table between all of its subjects. load reads either form
+and returns the full graph, so the rest of the code doesn't need to know
+which one a file uses.
+"""
+import os
+import gzip
+import json
+
+from . import core
+
+# Key (in a compact file's top-level object) holding the format's version
+COMPACT_KEY = 'pb_compact'
+COMPACT_VERSION = 1
+
+def is_compact_filename(filename):
+    return filename.endswith('.gz')
+
+def get_metadata_prefix(metadata_path, cmd):
+    """ Returns the metadata folder of a command (as write_pipeline_to_json does) """
+    if isinstance(cmd, unicode): # (when loaded from JSON)
+        cmd = cmd.encode('utf-8')
+    return os.path.join(metadata_path, core.get_cmdline_hash(cmd))
+
+class StringTable(object):
+    """ Assigns each distinct string an index """
+    def __init__(self):
+        self.strings = []
+        self.indices = {}
+
+    def add(self, string):
+        if string not in self.indices:
+            self.indices[string] = len(self.strings)
+            self.strings.append(string)
+        return self.indices[string]
+
+    def add_all(self, strings):
+        return [self.add(string) for string in strings]
+
+def compact_node(node, table):
+    """
+    Returns the compact form of a graph node, with its paths replaced by
+    indices into table. Fields that can't be derived on loading are kept.
+    """
+    out = dict(node)
+    cmd = out.pop('command_line')
+    task_info = out.pop('task_info')
+    # (command lines are stored as indices of their space-separated tokens,
+    # so that the paths in them are shared with the other fields)
+    out['command_line'] = table.add_all(cmd.split(' '))
+    out['outputs'] = table.add_all(node['outputs'])
+    out['named_outfiles'] = dict((param, table.add(filename)) for
+            (param, filename) in node['named_outfiles'].iteritems())
+    del out['id']
+    del out['index']
+    metadata_prefix = out.pop('metadata_prefix')
+    metadata_path = os.path.dirname(metadata_prefix)
+    if get_metadata_prefix(metadata_path, cmd) == metadata_prefix:
+        out['metadata_path'] = table.add(metadata_path)
+    else:
+        out['metadata_prefix'] = table.add(metadata_prefix)
+
+    info = dict(task_info)
+    if info.pop('cmd') != cmd:
+        info['cmd'] = table.add(task_info['cmd'])
+    if info.pop('comment') != node['name']:
+        info['comment'] = task_info['comment']
+    if info.pop('outfiles') != sorted(node['outputs']):
+        info['outfiles'] = table.add_all(task_info['outfiles'])
+    for key in ['original_inputs', 'intermediate_inputs']:
+        info[key] = table.add_all(info[key])
+    all_inputs = info.pop('all_inputs')
+    if all_inputs != sorted(task_info['original_inputs'] + task_info['intermediate_inputs']):
+        info['all_inputs'] = table.add_all(all_inputs)
+    out['task_info'] = info
+    return out
+
+def expand_node(node, index, strings):
+    """ Returns the full form of a node compacted by compact_node """
+    out = dict(node)
+    cmd = ' '.join(strings[i] for i in node['command_line'])
+    out['command_line'] = cmd
+    out['outputs'] = [strings[i] for i in node['outputs']]
+    out['named_outfiles'] = dict((param, strings[i]) for
+            (param, i) in node['named_outfiles'].iteritems())
+    out['id'] = 'subnode' + str(index)
+    out['index'] = index
+    if 'metadata_path' in out:
+        out['metadata_prefix'] = get_metadata_prefix(strings[out.pop('metadata_path')], cmd)
+    else:
+        out['metadata_prefix'] = strings[node['metadata_prefix']]
+
+    info = dict(node['task_info'])
+    info['cmd'] = strings[info['cmd']] if 'cmd' in info else cmd
+    info.setdefault('comment', node['name'])
+    if 'outfiles' in info:
+        info['outfiles'] = [strings[i] for i in info['outfiles']]
+    else:
+        info['outfiles'] = sorted(out['outputs'])
+    for key in ['original_inputs', 'intermediate_inputs']:
+        info[key] = [strings[i] for i in info[key]]
+    if 'all_inputs' in info:
+        info['all_inputs'] = [strings[i] for i in info['all_inputs']]
+    else:
+        info['all_inputs'] = sorted(info['original_inputs'] + info['intermediate_inputs'])
+    out['task_info'] = info
+    return out
+
+def compact_graph(graph, table):
+    out = dict(graph)
+    out['subnodes'] = [compact_node(node, table) for node in graph['subnodes']]
+    # (rebuilt from the nodes' supernodes)
+    out.pop('reverse_mapping', None)
+    return out
+
+def expand_graph(graph, strings):
+    out = dict(graph)
+    out['subnodes'] = [expand_node(node, i, strings) for (i, node) in
+            enumerate(graph['subnodes'])]
+    out['reverse_mapping'] = dict((str(node['index']), node['supernode'])
+            for node in out['subnodes'])
+    return out
+
+def save(obj, filename, aggregate=False):
+    """
+    Writes a graph, or if aggregate is True a dictionary of graphs (e.g. one
+    per subject), to filename: compacted if its name ends with .gz (see
+    above). The file is replaced atomically, so readers never see it
+    half-written.
+    """
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    if is_compact_filename(filename):
+        table = StringTable()
+        out = {COMPACT_KEY: COMPACT_VERSION}
+        if aggregate:
+            out['graphs'] = dict((key, compact_graph(graph, table))
+                    for (key, graph) in obj.iteritems())
+        else:
+            out['graph'] = compact_graph(obj, table)
+        out['strings'] = table.strings
+        with gzip.open(tmp_filename, 'wb') as f:
+            json.dump(out, f, separators=(',', ':'))
+    else:
+        with open(tmp_filename, 'w') as f:
+            json.dump(obj, f)
+    os.rename(tmp_filename, filename)
+
+def load(filename):
+    """
+    Reads a graph or an aggregate of graphs written by save (in either form)
+    or by an older version of write_pipeline_to_json.
+    """
+    with open(filename, 'rb') as f:
+        is_gzipped = (f.read(2) == '\x1f\x8b')
+    if is_gzipped:
+        with gzip.open(filename, 'rb') as f:
+            obj = json.load(f)
+    else:
+        with open(filename) as f:
+            obj = json.load(f)
+    if not isinstance(obj, dict) or COMPACT_KEY not in obj:
+        return obj
+    strings = obj['strings']
+    if 'graphs' in obj:
+        return dict((key, expand_graph(graph, strings))
+                for (key, graph) in obj['graphs'].iteritems())
+    return expand_graph(obj['graph'], strings)
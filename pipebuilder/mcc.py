@@ -1,22 +1,84 @@
 import os
 import sys
+import shlex
+import subprocess
 
+from . import core
 from .core import Command
 from .util import config
 
 MCC_BINARY_PATH = config.get('Binaries', 'MCC_BINARY_PATH')
 MCR = config.get('Binaries', 'MCR_PATH')
 
+def run_mcc_batch(script, arg_lists, batch_prefix):
+    """
+    Runs one MCC-compiled batch binary (so the MCR only starts once) on many
+    sets of arguments, and returns the exit status of each set.
+
+    The batch binary is called as <script> <MCR> <manifest> <status file>.
+    The manifest has one line per item, with that item's arguments separated
+    by tabs. The binary should process every item (even if some fail) and
+    write one line per item to the status file, with the item's exit status
+    (0 for success). Items without a status are considered failed.
+    """
+    manifest_file = batch_prefix + '_manifest.txt'
+    status_file = batch_prefix + '_status.txt'
+    with open(manifest_file, 'w') as f:
+        for args in arg_lists:
+            f.write('\t'.join(args) + '\n')
+    if os.path.exists(status_file):
+        os.remove(status_file)
+    retcode = subprocess.call([core.WRAP_SIMPLE, batch_prefix, script, MCR,
+        manifest_file, status_file])
+
+    statuses = []
+    if os.path.exists(status_file):
+        with open(status_file) as f:
+            for line in f:
+                try:
+                    statuses.append(int(line.strip()))
+                except ValueError:
+                    statuses.append(1)
+    missing_status = retcode if retcode != 0 else 1
+    statuses.extend([missing_status] * (len(arg_lists) - len(statuses)))
+    return statuses[:len(arg_lists)]
+
 ############################################
 # Commands for using MCC-compiled binaries #
 ############################################
 class MCCCommand(Command): # abstract class
     prefix = os.path.join(MCC_BINARY_PATH, 'MCC_%(matlabName)s/run_%(matlabName)s.sh ') + MCR + ' '
+    batch_script = os.path.join(MCC_BINARY_PATH, 'MCC_%(matlabName)s/run_%(matlabName)s_batch.sh')
     def __init__(self, comment, **kwargs):
         """ Arguments: matlabName, ... """
         self.cmd = self.prefix
         raise NotImplementedError # Abstract class
 
+    def get_mcc_args(self):
+        """ Returns the arguments this command passes to the MCC binary """
+        return shlex.split(self.cmd[len(self.prefix % self.parameters):])
+
+    def get_batch_script(self):
+        """ Returns the batch binary for this command's MATLAB function """
+        return self.batch_script % self.parameters
+
+    def get_batch_key(self):
+        """
+        Commands running the same MATLAB function can be batched, if it has
+        a batch binary (otherwise they run one at a time with run_<name>.sh)
+        """
+        if not core.stat_cache.exists(self.get_batch_script()):
+            return None
+        return 'mcc:' + self.parameters['matlabName']
+
+    def get_batch_task(self, commands, batch_prefix):
+        """
+        Runs the commands' MATLAB function once on all their arguments, using
+        run_<matlabName>_batch.sh (see run_mcc_batch)
+        """
+        return (run_mcc_batch, (self.get_batch_script(),
+            [command.get_mcc_args() for command in commands], batch_prefix))
+
 class MCCInputOutputCommand(MCCCommand):
     def __init__(self, comment, **kwargs):
         """ See MCCCommand. Arguments: matlabName, input, output """
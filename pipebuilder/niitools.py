@@ -1,5 +1,6 @@
 import os
 import sys
+import shlex
 
 from .core import Command
 from .util import config
@@ -7,97 +8,146 @@ from .util import config
 PYTHON = sys.executable
 NIITOOLS_PATH = config.get('Binaries', 'NIITOOLS_PATH')
 
-class NiiToolsMaskedThresholdCountCommand(Command):
+# niitools compiled once per process (see run_niitools)
+_niitools_code = None
+
+def run_niitools(args):
+    """
+    Runs niitools with the given command line arguments inside this process
+    (and returns its exit status, or raises SystemExit like niitools does).
+    niitools is only compiled once per process, and the libraries it imports
+    (numpy, nibabel, ...) stay loaded, so repeated calls (e.g. from the
+    executor's worker processes) don't pay for interpreter startup and
+    imports every time.
+    """
+    global _niitools_code
+    if _niitools_code is None:
+        with open(NIITOOLS_PATH) as f:
+            _niitools_code = compile(f.read(), NIITOOLS_PATH, 'exec')
+        niitools_dir = os.path.dirname(os.path.abspath(NIITOOLS_PATH))
+        if niitools_dir not in sys.path:
+            sys.path.insert(0, niitools_dir)
+    old_argv = sys.argv
+    sys.argv = [NIITOOLS_PATH] + list(args)
+    try:
+        exec _niitools_code in {'__name__': '__main__', '__file__': NIITOOLS_PATH}
+    finally:
+        sys.argv = old_argv
+    return 0
+
+class NiiToolsCommand(Command): # abstract class
+    prefix = PYTHON + ' ' + NIITOOLS_PATH + ' '
+    def get_python_task(self):
+        """ Runs the operation with run_niitools instead of a new python """
+        return (run_niitools, (shlex.split(self.cmd[len(self.prefix):]),))
+
+class NiiToolsMaskedThresholdCountCommand(NiiToolsCommand):
+    input_params = ('infile', 'exclude', 'label')
     def __init__(self, comment, **kwargs):
         kwargs['labels'] = ' '.join(map(str, kwargs['labels']))
         kwargs.setdefault('exclude', '-')
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' masked_threshold_count %(infile)s %(threshold)g %(output)s %(exclude)s %(label)s %(direction)s %(units)s %(labels)s'
+        self.cmd = self.prefix + 'masked_threshold_count %(infile)s %(threshold)g %(output)s %(exclude)s %(label)s %(direction)s %(units)s %(labels)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsMaskedThresholdCommand(Command):
+class NiiToolsMaskedThresholdCommand(NiiToolsCommand):
+    input_params = ('infile', 'exclude', 'label')
     def __init__(self, comment, **kwargs):
         kwargs['labels'] = ' '.join(map(str, kwargs['labels']))
         kwargs.setdefault('exclude', '-')
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' masked_threshold %(infile)s %(threshold)g %(output)s %(exclude)s %(label)s %(direction)s %(labels)s'
+        self.cmd = self.prefix + 'masked_threshold %(infile)s %(threshold)g %(output)s %(exclude)s %(label)s %(direction)s %(labels)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsMatchIntensityCommand(Command):
+class NiiToolsMatchIntensityCommand(NiiToolsCommand):
+    input_params = ('inFile', 'maskFile')
     def __init__(self, comment, **kwargs):
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' scale_intensity %(inFile)s %(maskFile)s %(intensity)s %(output)s'
+        self.cmd = self.prefix + 'scale_intensity %(inFile)s %(maskFile)s %(intensity)s %(output)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsPadCommand(Command):
+class NiiToolsPadCommand(NiiToolsCommand):
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
         kwargs.setdefault('padAmount',30)
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' pad %(input)s %(output)s %(outmask)s %(padAmount)g'
+        self.cmd = self.prefix + 'pad %(input)s %(output)s %(outmask)s %(padAmount)g'
         self.outfiles = [kwargs['output'], kwargs['outmask']]
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsTrimCommand(Command):
+class NiiToolsTrimCommand(NiiToolsCommand):
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
         kwargs['bbox'] = ' '.join(map(str, kwargs.pop('bbox')))
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' trim %(input)s %(output)s %(bbox)s'
+        self.cmd = self.prefix + 'trim %(input)s %(output)s %(bbox)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsConvertTypeCommand(Command):
+class NiiToolsConvertTypeCommand(NiiToolsCommand):
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
         kwargs.setdefault('normalization', 'none')
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' convert_type %(input)s %(output)s %(type)s %(normalization)s'
+        self.cmd = self.prefix + 'convert_type %(input)s %(output)s %(type)s %(normalization)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsGaussianBlurCommand(Command):
+class NiiToolsGaussianBlurCommand(NiiToolsCommand):
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' gaussian_blur %(input)s %(output)s %(sigma)g'
+        self.cmd = self.prefix + 'gaussian_blur %(input)s %(output)s %(sigma)g'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsCountLabelCommand(Command):
+class NiiToolsCountLabelCommand(NiiToolsCommand):
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' count_labels %(input)s %(output)s %(labels)s'
+        self.cmd = self.prefix + 'count_labels %(input)s %(output)s %(labels)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsWarpSSDCommand(Command):
+class NiiToolsWarpSSDCommand(NiiToolsCommand):
+    input_params = ('in1', 'in2', 'template')
     def __init__(self, comment, **kwargs):
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' warp_ssd %(in1)s %(in2)s %(template)s %(output)s'
+        self.cmd = self.prefix + 'warp_ssd %(in1)s %(in2)s %(template)s %(output)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsJaccardCommand(Command):
+class NiiToolsJaccardCommand(NiiToolsCommand):
+    input_params = ('in1', 'in2')
     def __init__(self, comment, **kwargs):
         kwargs.setdefault('labels', '2 3 4 41 42 43')
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' jaccard %(in1)s %(in2)s %(output)s %(labels)s'
+        self.cmd = self.prefix + 'jaccard %(in1)s %(in2)s %(output)s %(labels)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsDiceCommand(Command):
+class NiiToolsDiceCommand(NiiToolsCommand):
+    input_params = ('in1', 'in2')
     def __init__(self, comment, **kwargs):
         kwargs.setdefault('labels', '2 3 4 41 42 43')
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' dice %(in1)s %(in2)s %(output)s %(labels)s'
+        self.cmd = self.prefix + 'dice %(in1)s %(in2)s %(output)s %(labels)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsUpsampleCommand(Command):
+class NiiToolsUpsampleCommand(NiiToolsCommand):
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
         kwargs.setdefault('axis', 2)
         kwargs.setdefault('method', 'linear')
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' upsample %(input)s %(output)s %(out_mask)s %(axis)d %(ratio)g %(method)s'
+        self.cmd = self.prefix + 'upsample %(input)s %(output)s %(out_mask)s %(axis)d %(ratio)g %(method)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsMergeWarpCommand(Command):
+class NiiToolsMergeWarpCommand(NiiToolsCommand):
+    input_params = ('in_pattern', 'template_warp')
     def __init__(self, comment, **kwargs):
         kwargs.setdefault('dimension', 3)
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' merge %(dimension)s %(in_pattern)s %(template_warp)s %(output)s'
+        self.cmd = self.prefix + 'merge %(dimension)s %(in_pattern)s %(template_warp)s %(output)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsSplitWarpCommand(Command):
+class NiiToolsSplitWarpCommand(NiiToolsCommand):
+    input_params = ('infile',)
     def __init__(self, comment, **kwargs):
         kwargs.setdefault('dimension', 3)
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' split %(dimension)s %(infile)s %(out_template)s'
+        self.cmd = self.prefix + 'split %(dimension)s %(infile)s %(out_template)s'
         self.outfiles = [kwargs['out_template'] % i for i in xrange(kwargs['dimension'])]
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsMaskCommand(Command):
+class NiiToolsMaskCommand(NiiToolsCommand):
+    input_params = ('input', 'mask')
     def __init__(self, comment, **kwargs):
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' mask %(input)s %(mask)s %(output)s'
+        self.cmd = self.prefix + 'mask %(input)s %(mask)s %(output)s'
         Command.__init__(self, comment, **kwargs)
 
-class NiiToolsSSDCommand(Command):
+class NiiToolsSSDCommand(NiiToolsCommand):
+    input_params = ('in1', 'in2')
     def __init__(self, comment, **kwargs):
-        self.cmd = PYTHON + ' ' + NIITOOLS_PATH + ' ssd %(in1)s %(in2)s %(output)s'
+        self.cmd = self.prefix + 'ssd %(in1)s %(in2)s %(output)s'
         Command.__init__(self, comment, **kwargs)
@@ -1,7 +1,9 @@
 import os
+import hashlib
 import warnings
+import collections
 
-from .core import Command
+from .core import Command, Pipeline, has_valid_path
 from . import util
 from .util import config
 
@@ -376,6 +378,7 @@ def get_warped_filename(moving, reference, reg_sequence, inversion_sequence, out
 class ANTSComposeTransformCommand(Command):
     """
     Command representing Ants's ComposeMultiTransform"""
+    input_params = ('reference', 'transforms')
 
     @classmethod
     def make_from_registration_sequence(cls, comment, reference,
@@ -424,6 +427,18 @@ class ANTSComposeTransformCommand(Command):
 
         Command.__init__(self, comment, **kwargs)
 
+class _ActiveWarpMapping(object):
+    """
+    ANTSWarpCommand.warp_mapping: for compatibility, this reads the warp
+    mapping of the active pipeline's WarpIndex (see ANTSWarpCommand.get_index)
+    instead of a dictionary shared by every pipeline.
+    """
+    def __get__(self, instance, owner):
+        return owner.get_index().warp_mapping
+
+    def __set__(self, instance, value):
+        raise AttributeError("warp_mapping is read-only (it's kept by WarpIndex)")
+
 class ANTSWarpCommand(Command):
     """
     Command representing an ANTS warp. Unlike most other commands, the most
@@ -431,10 +446,13 @@ class ANTSWarpCommand(Command):
     make_from_registration and make_from_registration_sequence.
     """
     descr = "ANTS warp"
+    input_params = ('moving', 'reference', 'transforms')
 
-    # Maps (moving, reference) filename pairs to warped image filenames.
+    # Maps (moving, reference) filename pairs to warped image filenames, for
+    # the active pipeline's warps (the same as get_index().warp_mapping).
     # Warning: not reliable for pairs which have multiple warp paths!
-    warp_mapping = {}
+    warp_mapping = _ActiveWarpMapping()
+
     @classmethod
     def make_from_registration(cls, comment, moving, reference,
             registration, inversion='forward', **kwargs):
@@ -517,17 +535,123 @@ class ANTSWarpCommand(Command):
         """
         if 'dimension' not in kwargs:
             kwargs['dimension'] = 3
-        self.warp_mapping[(kwargs['moving'], kwargs['reference'])] = kwargs['output']
-        self.cmd = ANTSPATH + '/WarpImageMultiTransform %(dimension)d %(moving)s %(output)s -R %(reference)s'
-        self.cmd += ' ' + kwargs['transforms']
+        self.cmd = self.make_cmd(kwargs)
+
+        Command.__init__(self, comment, **kwargs)
+        self.get_index().add(self)
+
+    @classmethod
+    def get_index(cls):
+        """ Returns the WarpIndex of the active pipeline's warps """
+        return cls.get_active_index('ants_warps', WarpIndex)
+
+    @staticmethod
+    def make_cmd(kwargs):
+        cmd = ANTSPATH + '/WarpImageMultiTransform %(dimension)d %(moving)s %(output)s -R %(reference)s'
+        cmd += ' ' + kwargs['transforms']
 
         if 'useNN' in kwargs and kwargs['useNN']:
-            self.cmd += ' --use-NN'
+            cmd += ' --use-NN'
+        return cmd
 
-        Command.__init__(self, comment, **kwargs)
+    def get_chain_key(self):
+        """
+        Returns what determines the transformation this warp applies: the
+        reference, the sequence of transforms, and the dimension.
+        """
+        return (self.parameters['reference'],
+                tuple(self.parameters['transforms'].split()),
+                self.parameters['dimension'])
+
+    def use_transforms(self, transforms):
+        """
+        Changes the transforms this warp applies (e.g. to a composed transform
+        that's equivalent to the old ones), updating its inputs.
+        """
+        old_files = set(f for f in self.parameters['transforms'].split() if has_valid_path(f))
+        new_files = set(f for f in transforms.split() if has_valid_path(f))
+        self.parameters['transforms'] = transforms
+        self.cmd = self.make_cmd(self.parameters) % self.parameters
+        self.inputs = self.inputs.difference(old_files).union(new_files)
+
+class WarpIndex(object):
+    """
+    Index of the ANTS warps in a pipeline: maps (moving, reference) pairs to
+    warped image filenames (warning: not reliable for pairs which have
+    multiple warp paths!), and maps each chain of transforms (see
+    ANTSWarpCommand.get_chain_key) to the warps that apply it. It belongs to
+    the pipeline, so it's freed along with the pipeline's commands.
+    """
+    def __init__(self):
+        self.warp_mapping = {}
+        self.chains = collections.OrderedDict()
+
+    def add(self, warp):
+        self.warp_mapping[(warp.parameters['moving'], warp.parameters['reference'])] = \
+                warp.parameters['output']
+        self.chains.setdefault(warp.get_chain_key(), []).append(warp)
+
+def compose_repeated_warps(commands=None, min_uses=3):
+    """
+    Finds chains of (two or more) transforms that are applied by at least
+    min_uses warps, and composes each one into a single displacement field
+    with an ANTSComposeTransformCommand (inserted into commands before the
+    first warp that uses it). The warps are changed to use the composed
+    field, so the chain only has to be read and composed once. Note that
+    the composed field is resampled onto the reference's grid, so results
+    can differ slightly from applying the chain directly.
+
+    commands is a list of commands that's changed in place (defaults to all
+    created commands, or the active Pipeline's commands). Returns the list
+    of inserted commands.
+    """
+    if commands is None:
+        commands = Command.get_active_commands()
+        index = ANTSWarpCommand.get_index()
+    else:
+        index = WarpIndex()
+        for command in commands:
+            if isinstance(command, ANTSWarpCommand):
+                index.add(command)
+    positions = dict((id(command), i) for (i, command) in enumerate(commands))
+
+    inserted = collections.defaultdict(list) # maps position -> new commands
+    for (key, warps) in index.chains.items():
+        warps = [w for w in warps if id(w) in positions]
+        (reference, transforms, dimension) = key
+        n_transforms = len([t for t in transforms if t != '-i'])
+        if len(warps) < min_uses or n_transforms < 2:
+            continue
+        transforms = ' '.join(transforms)
+        # (the hash covers the whole key, so that chains differing only in
+        # their reference's folder or their dimension get different files)
+        key_hash = hashlib.md5('\n'.join([reference, transforms, str(dimension)]))
+        output = os.path.join(os.path.dirname(warps[0].parameters['output']),
+                '{reference}_COMPOSED_{dimension}D_{hash}_Warp{ext}'.format(
+                    reference=util.get_filebase(reference), dimension=dimension,
+                    hash=key_hash.hexdigest()[:12], ext=ANTS_EXTENSION))
+        # (created in a throwaway pipeline: it's added to commands below)
+        with Pipeline():
+            compose = ANTSComposeTransformCommand(
+                    'Compose transforms shared by %d warps' % len(warps),
+                    reference=reference, output=output,
+                    transforms=' ' + transforms + ' ', dimension=dimension)
+        inserted[min(positions[id(w)] for w in warps)].append(compose)
+        for warp in warps:
+            warp.use_transforms(' ' + output + ' ')
+        del index.chains[key]
+        index.chains.setdefault(warps[0].get_chain_key(), []).extend(warps)
+
+    new_commands = []
+    for (i, command) in enumerate(commands):
+        new_commands.extend(inserted[i])
+        new_commands.append(command)
+    commands[:] = new_commands
+    return [c for i in sorted(inserted) for c in inserted[i]]
 
 class ANTSJacobianCommand(Command):
     descr = "ANTS Jacobian of warp"
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
         """
         Createas a command for ANTS's ANTSJacobian binary.
@@ -548,6 +672,7 @@ class ANTSJacobianCommand(Command):
 
 class N4Command(Command):
     descr = "N4 bias field corr."
+    input_params = ('input',)
     def __init__(self, comment, **kwargs):
         """
         Creates a command for N4 bias field correction. Assumes 3D images.
@@ -1,4 +1,10 @@
 
+import os
+import sys
+import ast
+import pipes
+import importlib
+
 from .core import Command
 from .util import config
 
@@ -6,6 +12,7 @@ from .util import config
 # Commands for simple scripts #
 ###############################
 class InputOutputShellCommand(Command):
+    input_params = ('input', 'extra_args')
     def __init__(self, comment, **kwargs):
         """
         Runs a simple command of the form <cmdName> <input> <output> <extra_args>
@@ -37,29 +44,60 @@ class PyFunctionCommand(Command):
         a string of the form 'module.function', and the module must
         be on the current path.
 
-        args is a list of strings with the arguments to the function (right
-        now only strings are supported). Strings with quotes of any kind in them
-        may not work properly (untested).
+        args is a list with the arguments to the function. In generated
+        scripts, they're written out with repr(), so they must be Python
+        literals: strings, numbers, booleans, None, or lists/tuples/
+        dictionaries/sets of those (anything else raises a ValueError).
+        When run with executor.execute(in_process=True), the function is
+        called in a worker process with the arguments themselves.
 
         output_positions is an optional list of indices into args that
         say which ones are output files.
-
-        All of the function's parameters and all of the arguments must be
-        strings (this limitation will hopefully be removed in a future
-        version).
         """
-        import sys
         (module, funcname) = function.rsplit('.', 1)
         # TODO trim this to where the module is
         path = sys.path + [os.getcwd()]
-        self.cmd =\
-            "python -c \"import sys; sys.path.extend(%(path)s);" \
-            "import %(module)s; %(module)s.%(func)s(%(arg)s)\""
+        for arg in args:
+            if not _is_literal(arg):
+                raise ValueError("Can't write argument %r of %s into a script: "
+                        "its repr() doesn't evaluate back to it (arguments "
+                        "must be strings, numbers, or lists/tuples/"
+                        "dictionaries of those)" % (arg, function))
+        arg_string = ','.join([repr(arg) for arg in args])
+        code = 'import sys; sys.path.extend(%r); import %s; %s.%s(%s)' % \
+                (path, module, module, funcname, arg_string)
+        # (Command.__init__ fills in the command line with %, so any % in the
+        # quoted code has to be escaped)
+        self.cmd = 'python -c ' + pipes.quote(code).replace('%', '%%')
 
         self.outfiles = [args[i] for i in output_positions]
-        newargs = []
-        for arg in args:
-            newargs.append(str(arg))
+        self.module = module
+        self.funcname = funcname
+        self.args = list(args)
         Command.__init__(self, comment, path=path, module=module, func=funcname,
-                arg=','.join(["'"+arg+"'" for arg in newargs]))
+                arg=arg_string)
+
+    def get_python_task(self):
+        """ Calls the function in the worker process (see call_function) """
+        return (call_function, (self.parameters['path'], self.module,
+            self.funcname, self.args))
+
+def _is_literal(value):
+    """ Checks whether repr(value) evaluates (as a literal) back to value """
+    try:
+        return ast.literal_eval(repr(value)) == value
+    except (ValueError, SyntaxError):
+        return False
 
+def call_function(path, module, funcname, args):
+    """
+    Imports module (if it hasn't been imported in this process yet), using
+    path to find it, and calls module.funcname(*args). Returns 0 (like the
+    command line form, the function's return value is ignored).
+    """
+    for folder in path:
+        if folder not in sys.path:
+            sys.path.append(folder)
+    function = getattr(importlib.import_module(module), funcname)
+    function(*args)
+    return 0
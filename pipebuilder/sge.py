@@ -0,0 +1,138 @@
+"""
+Submits commands to SGE as separate jobs (instead of one job per script), so
+that independent commands can run on different nodes at the same time.
+Dependencies between commands become -hold_jid dependencies between jobs.
+"""
+from __future__ import print_function
+
+import os
+import time
+import datetime
+import subprocess
+
+from . import core
+
+# If a job exits with this status, SGE puts it in an error state, and jobs
+# that depend on it stay on hold instead of running with missing inputs.
+SGE_ERROR_STATUS = 100
+
+def group_commands(tracker, to_run, group_chains=False):
+    """
+    Groups the commands in to_run (indices into tracker.commands) into jobs.
+    With group_chains, a command whose only parent (among to_run) has it
+    as its only child is put in the same job as that parent, so linear chains
+    run as one job.
+
+    Returns a list of jobs (lists of indices, each in creation order), a
+    dictionary mapping each command to its job, and a dictionary mapping
+    each command to its parents in to_run.
+    """
+    graph = tracker.dependency_graph
+    running = set(to_run)
+    parents = {}
+    children = {}
+    for i in to_run:
+        parents[i] = [int(p) for p in graph.parents(i) if p in running]
+        children[i] = [int(c) for c in graph.children(i) if c in running]
+
+    jobs = []
+    job_of = {}
+    for i in to_run:
+        if group_chains and len(parents[i]) == 1:
+            (parent,) = parents[i]
+            if children[parent] == [i] and parent in job_of:
+                job_of[i] = job_of[parent]
+                jobs[job_of[i]].append(i)
+                continue
+        job_of[i] = len(jobs)
+        jobs.append([i])
+    return (jobs, job_of, parents)
+
+def write_job_script(filename, commands, metadata_path=None, file_prefix='',
+        shared_folder=None, digest=False):
+    """
+    Writes a script running the given commands (in order). Any failure makes
+    the script exit with SGE_ERROR_STATUS. See Command.get_script_cmd for
+    shared_folder and digest.
+    """
+    with open(filename, 'w') as f:
+        f.write('#!/usr/bin/env bash\n')
+        f.write('set -e\n')
+        f.write("trap 'exit %d' ERR\n\n" % SGE_ERROR_STATUS)
+        for command in commands:
+            f.write('# ' + command.comment + '\n')
+            st = ''
+            if metadata_path is not None:
+                wrap_files_prefix = core.make_metadata_prefix(metadata_path,
+                        command, file_prefix)
+                st += core.WRAP_SIMPLE + ' ' + wrap_files_prefix + ' \\\n\\\n'
+            f.write(st + command.get_script_cmd(shared_folder, digest) + '\n'*4)
+    os.chmod(filename, 0775)
+
+def submit(filename, log_folder, hold_jids=(), queue='main.q'):
+    """
+    Submits a script to SGE (using the qsub-run wrapper), holding it until
+    the jobs in hold_jids are done. Returns the SGE job id.
+    """
+    out_qsub = filename + '.qsub'
+    os.environ['SGE_LOG_PATH'] = log_folder
+    os.environ['SGE_LOG_DIR'] = log_folder
+    with open(out_qsub, 'w') as out_qsub_file:
+        subprocess.call([core.QSUB_RUN, '-c', filename], stdout=out_qsub_file)
+    qsub_cmd = [core.QSUB, '-terse', '-q', queue]
+    if len(hold_jids) > 0:
+        qsub_cmd += ['-hold_jid', ','.join(hold_jids)]
+    output = subprocess.check_output(qsub_cmd + [out_qsub])
+    # -terse prints just the id (or id.range for array jobs)
+    return output.strip().split('.')[0]
+
+def submit_commands(tracker, datasets, log_folder, short_id='',
+        clobber_existing_outputs=False, group_chains=False, queue='main.q',
+        wait_time=0, shared_folder=None, digest=False, file_prefix=None):
+    """
+    Submits each command in tracker.commands that needs to run as its own
+    SGE job (or each linear chain of commands, with group_chains), holding
+    each job until the jobs producing its inputs have finished. Commands are
+    skipped according to the same rules as Command.generate_code. See
+    Command.get_script_cmd for shared_folder and digest.
+
+    Job scripts are written to the folder <log_folder>/<file_prefix>_jobs,
+    and file_prefix also names the commands' metadata files (by default,
+    it's made from short_id and the time).
+
+    Returns the job folder, and a list of (job id, list of commands) pairs.
+    """
+    tracker.compute_dependencies()
+    if file_prefix is None:
+        timestamp = datetime.datetime.now().strftime('%y%m%d-%H%M%S-%f')
+        file_prefix = 'pb_%s.%s' % (short_id, timestamp)
+    job_folder = os.path.join(log_folder, file_prefix + '_jobs')
+    os.mkdir(job_folder)
+    metadata_path = os.path.join(log_folder, 'pb_metadata')
+
+    to_run = []
+    for (i, command) in enumerate(tracker.commands):
+        skip_reason = command.get_skip_reason(datasets, clobber_existing_outputs)
+        if skip_reason is None:
+            to_run.append(i)
+        else:
+            print('*** Skipping (due to %s) ' % skip_reason + command.comment)
+
+    (jobs, job_of, parents) = group_commands(tracker, to_run, group_chains)
+    job_ids = []
+    for (j, job) in enumerate(jobs):
+        hold_jids = []
+        for i in job:
+            for parent in parents[i]:
+                k = job_of[parent]
+                # only hold on jobs that were already submitted
+                if k < j and job_ids[k] not in hold_jids:
+                    hold_jids.append(job_ids[k])
+        commands = [tracker.commands[i] for i in job]
+        script = os.path.join(job_folder, 'job%04d.sh' % j)
+        write_job_script(script, commands, metadata_path, file_prefix,
+                shared_folder, digest)
+        job_ids.append(submit(script, log_folder, hold_jids, queue))
+        print(job_ids[-1] + ': ' + '; '.join(c.comment for c in commands))
+        time.sleep(wait_time) # so that SGE isn't overloaded
+    return (job_folder, zip(job_ids, [[tracker.commands[i] for i in job] for job in jobs]))
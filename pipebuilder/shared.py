@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Shares the results of commands that are the same in many pipelines (e.g.
+atlas preprocessing, which every subject's pipeline contains) through a
+cohort-level folder, so they only run once even when the pipelines run at
+the same time (e.g. as separate SGE jobs).
+
+A shared command is run through this script, which locks a file named
+after the command line's hash in the shared folder. While one job runs the
+command, the others wait on the lock. When the command succeeds, a marker
+with the fingerprints of its inputs is written, and later jobs reuse the
+outputs as long as the inputs still match. The shared folder must be on a
+filesystem where flock works across the machines running the jobs.
+
+Like fingerprint.py, this only uses the standard library so that generated
+scripts can run it directly:
+    python shared.py --inputs <inputs...> --outputs <outputs...> \
+            --command=<command> -- run <shared folder> <cmdline hash> <digest>
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import fcntl
+import argparse
+import tempfile
+import subprocess
+
+try:
+    from . import fingerprint
+except (ValueError, ImportError):
+    # (when run as a script)
+    import fingerprint
+
+def is_reusable(marker_file, cache, inputs, outputs):
+    """
+    Checks whether a shared command's outputs (from a previous run) can be
+    reused: its marker must exist and match the current inputs.
+    """
+    if not os.path.exists(marker_file):
+        return False
+    with open(marker_file) as f:
+        marker = json.load(f)
+    if sorted(marker['outputs']) != sorted(outputs) or \
+            not all(os.path.exists(outp) for outp in outputs):
+        return False
+    recorded = marker['inputs']
+    if set(recorded.keys()) != set(inputs):
+        return False
+    for (inp, fp) in recorded.iteritems():
+        use_digest = fp is not None and len(fp) > 2
+        if not fingerprint.same_fingerprint(fp, cache.fingerprint(inp, use_digest)):
+            return False
+    return True
+
+def run_shared(shared_folder, cmdline_hash, digest, inputs, outputs, cmd):
+    """
+    Runs cmd (a bash command line) unless a previous run's outputs can be
+    reused, holding the command's lock the whole time. Returns the exit
+    status.
+    """
+    try:
+        os.makedirs(shared_folder)
+    except OSError:
+        if not os.path.isdir(shared_folder):
+            raise
+    prefix = os.path.join(shared_folder, cmdline_hash)
+    marker_file = prefix + '.json'
+    cache = fingerprint.FingerprintCache(
+            os.path.join(shared_folder, fingerprint.CACHE_FILENAME))
+    with open(prefix + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if is_reusable(marker_file, cache, inputs, outputs):
+            print('Reusing shared result of: ' + cmd)
+            retcode = None
+        else:
+            if os.path.exists(marker_file):
+                os.remove(marker_file)
+            retcode = subprocess.call(cmd, shell=True, executable='/bin/bash')
+        if retcode == 0:
+            marker = {'cmd': cmd,
+                      'outputs': outputs,
+                      'inputs': dict((inp, cache.fingerprint(inp, digest)) for inp in inputs)}
+            (fd, tmp_filename) = tempfile.mkstemp(dir=shared_folder)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(marker, f)
+            os.rename(tmp_filename, marker_file)
+    cache.save()
+    return retcode or 0
+
+def get_shared_command(command, shared_folder, digest=False):
+    """
+    Returns a command line that runs command through run_shared (for
+    writing to a script)
+    """
+    from .core import get_cmdline_hash
+    from .util import shell_join
+    # (the positional arguments go after --, since the hash can start with -)
+    return shell_join([sys.executable,
+        os.path.splitext(os.path.abspath(__file__))[0] + '.py',
+        '--inputs'] + sorted(command.inputs) + ['--outputs'] +
+        sorted(command.outfiles) + ['--command=' + command.cmd, '--',
+        'run', shared_folder, get_cmdline_hash(command.cmd), str(int(digest))])
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='Runs a command whose results are shared between pipelines')
+    parser.add_argument('action', choices=['run'])
+    parser.add_argument('shared_folder')
+    parser.add_argument('cmdline_hash')
+    parser.add_argument('digest', choices=['0', '1'])
+    parser.add_argument('--inputs', nargs='*', default=[])
+    parser.add_argument('--outputs', nargs='*', default=[])
+    parser.add_argument('--command', required=True)
+    args = parser.parse_args(argv[1:])
+    sys.exit(run_shared(args.shared_folder, args.cmdline_hash,
+        args.digest == '1', args.inputs, args.outputs, args.command))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,111 @@
+"""
+Caches file existence and modification times. Instead of one filesystem call
+per file, each directory is listed once and queries about files in it are
+answered from memory. This matters on network filesystems, where every
+metadata call is a round trip.
+"""
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class StatCache(object):
+    """
+    Cache of directory listings and file stats. The cache isn't updated when
+    files change, so it should be cleared (or the changed files invalidated)
+    whenever that might have happened: Command.generate_code clears the shared
+    cache after each pass.
+    """
+    def __init__(self):
+        self.clear()
+        self.reset_counters()
+
+    def clear(self):
+        """ Forgets everything that's been cached """
+        # maps directory -> {name: DirEntry or None}, or None if it's missing
+        self.listings = {}
+        # maps filename -> os.stat result, or None if it's missing
+        self.stats = {}
+
+    def reset_counters(self):
+        self.queries = 0
+        self.filesystem_calls = 0
+
+    @property
+    def calls_saved(self):
+        """ Number of filesystem calls that were answered from the cache """
+        return self.queries - self.filesystem_calls
+
+    def report(self):
+        return '%d file queries answered with %d filesystem calls (%d saved)' % \
+                (self.queries, self.filesystem_calls, self.calls_saved)
+
+    def _list(self, directory):
+        if directory not in self.listings:
+            self.filesystem_calls += 1
+            try:
+                if scandir is not None:
+                    listing = dict((entry.name, entry) for entry in scandir(directory))
+                else:
+                    listing = dict.fromkeys(os.listdir(directory))
+            except OSError:
+                listing = None
+            self.listings[directory] = listing
+        return self.listings[directory]
+
+    def exists(self, filename):
+        """
+        Like os.path.lexists: answered from a listing of the file's
+        directory alone, so a symlink counts as existing even if it's broken
+        (telling would take a stat of every listed file, which is what the
+        cache avoids).
+        """
+        self.queries += 1
+        filename = os.path.abspath(filename)
+        (directory, name) = os.path.split(filename)
+        if name == '':
+            self.filesystem_calls += 1
+            return os.path.lexists(filename)
+        listing = self._list(directory)
+        return listing is not None and name in listing
+
+    def stat(self, filename):
+        """
+        Like os.stat (following symlinks), but returns None if the file
+        doesn't exist
+        """
+        filename = os.path.abspath(filename)
+        if filename in self.stats:
+            self.queries += 1
+            return self.stats[filename]
+        if not self.exists(filename):
+            st = None
+        else:
+            (directory, name) = os.path.split(filename)
+            entry = self._list(directory)[name] if name != '' else None
+            self.filesystem_calls += 1
+            try:
+                if entry is not None:
+                    st = entry.stat()
+                else:
+                    st = os.stat(filename)
+            except OSError:
+                st = None
+        self.stats[filename] = st
+        return st
+
+    def getmtime(self, filename):
+        """ Like os.path.getmtime, but returns None if the file doesn't exist """
+        st = self.stat(filename)
+        return None if st is None else st.st_mtime
+
+    def invalidate(self, filename):
+        """ Forgets what's cached about a file (e.g., after it's written) """
+        filename = os.path.abspath(filename)
+        self.stats.pop(filename, None)
+        self.listings.pop(os.path.dirname(filename), None)
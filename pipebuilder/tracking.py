@@ -5,14 +5,27 @@ import ast
 import os
 import shutil
 import tempfile
+import warnings
+import threading
 import mimetypes
-import base64
+import multiprocessing.pool
+import zlib
+import time
+import struct
+import StringIO
+import heapq
 import hashlib
 import collections
 
 import cherrypy
+import cherrypy.lib.static
+import cherrypy.process.plugins
 import numpy as np
 
+from . import core
+from . import util
+from . import graph
+from . import graphjson
 from . import registration
 
 
@@ -76,29 +89,8 @@ class Tracker(object):
         """
         Computes a dependency graph for all commands created so far
         """
-        N = len(self.commands)
-
-        # Sparse array of filelists: list at (i, j) has all files that i
-        # outputs that j depends on
-        self.dependency_files = np.empty([N, N], dtype='object')
-
-        for i in xrange(N):
-            for j in xrange(N):
-                self.dependency_files[i, j] = []
-
-        for (i, early_command) in enumerate(self.commands):
-            for (j, late_command) in enumerate(self.commands):
-                # check if any of the early command's outputs are
-                # inputs to the later command
-                for outp in early_command.outfiles:
-                    if outp in late_command.inputs:
-                        self.dependency_files[i, j].append(outp)
-                    # else:
-                    #     if outp.endswith('.txt') and 'arp' in late_command.comment:
-                    #         pass
-
         # directed (acyclic) graph representing what tasks depend on what
-        self.dependency_graph = np.vectorize(len)(self.dependency_files)
+        self.dependency_graph = graph.DependencyGraph(self.commands)
 
     def make_command_metadata(self, command):
         out = {}
@@ -155,7 +147,8 @@ class Tracker(object):
 
     def write_pipeline_to_json(self, filename, metadata_path=''):
         """
-        Writes a graph of this pipeline (nodes, links) to a JSON file
+        Writes a graph of this pipeline (nodes, links) to a JSON file (in the
+        compact form, if filename ends with .gz: see graphjson)
         """
         # TODO compress nodes based on input-output relationships:
         # nodes with the same inputs and the same outputs can be compressed!
@@ -163,8 +156,6 @@ class Tracker(object):
         stages = self.compute_stages_bottomup()
         collapsed = self.collapse_by_stage(stages)
 
-        N = len(self.commands)
-
         reverse_mapping = {} # maps node number to which supernode it's in
         # Set up supernodes (nodes grouped by almost-sameness)
         supernodes = []
@@ -199,8 +190,7 @@ class Tracker(object):
                     named_outfiles[param_name] = outfilename
                     outfiles.remove(outfilename)
             klass = command.__class__.__name__
-            cmdline_hash = base64.urlsafe_b64encode(hashlib.md5(command.cmd).digest())
-            metadata_prefix = os.path.join(metadata_path, cmdline_hash)
+            metadata_prefix = os.path.join(metadata_path, core.get_cmdline_hash(command.cmd))
             nodes.append({'name': command.comment,
                           'class': self.command_classes[command.__class__],
                           'id': 'subnode' + str(k),
@@ -214,10 +204,9 @@ class Tracker(object):
                           'supernode': reverse_mapping[k]})
 
         edges = collections.Counter()
-        for i in xrange(N):
-            for j in xrange(i+1, N):
-                weight = int(self.dependency_graph[i, j])
-                edges[(reverse_mapping[i], reverse_mapping[j])] += weight
+        for (i, j, files) in self.dependency_graph.edges():
+            if j > i:
+                edges[(reverse_mapping[i], reverse_mapping[j])] += len(files)
         links = []
         for ((supersource, supertarget), weight) in edges.iteritems():
             if weight > 0:
@@ -228,37 +217,17 @@ class Tracker(object):
 
         klass_list = [k[:-len('Command')] for k in klass_list]
 
-        s = json.dumps({'supernodes': supernodes, 'klasses': klass_list,
-            'subnodes': nodes, 'links': links, 'reverse_mapping': reverse_mapping})
-        with open(filename, 'w') as f:
-            f.write(s)
+        graphjson.save({'supernodes': supernodes, 'klasses': klass_list,
+            'subnodes': nodes, 'links': links, 'reverse_mapping': reverse_mapping},
+            filename)
 
     def compute_stages_bottomup(self):
-        all_stages = []
-        this_stage_nodes = []
-        completed_nodes = set()
-
-        # Find all nodes without children to initialize
-        for (i, cmd) in enumerate(self.commands):
-            if np.sum(self.dependency_graph[i,:]) == 0:
-                this_stage_nodes.append(i)
-
-        while True:
-            prev_stage_nodes = []
-            for node in this_stage_nodes:
-                completed_nodes.add(node)
-                parents = np.where(self.dependency_graph[:,node])[0]
-                for parent in parents:
-                    if parent not in completed_nodes:
-                        # make sure all its parents have been accounted for
-                        # before adding it
-                        children = np.where(self.dependency_graph[parent,:])[0]
-                        if set(children).issubset(completed_nodes):
-                            prev_stage_nodes.append(int(parent))
-            all_stages.append(this_stage_nodes)
-            if prev_stage_nodes == []:
-                break
-            this_stage_nodes = prev_stage_nodes
+        """
+        Like compute_stages, but builds the stages up from the commands whose
+        outputs nothing uses: each stage only has commands whose outputs are
+        used by later stages.
+        """
+        all_stages = self.dependency_graph.layers(bottom_up=True)
         all_stages.reverse()
         return all_stages
 
@@ -292,11 +261,12 @@ class Tracker(object):
                     input_source = input_nodes[j]
                     nipype_input_name = make_nipype_name(fields)
                     pipeline.connect([(input_source, parent_node, [(nipype_input_name, input_name)])])
-            for j in xrange(i, len(self.commands)):
-
+            for j in self.dependency_graph.children(i):
+                if j < i:
+                    continue
                 (child_node, child_inputs, _) = nodes[j]
 
-                files = self.dependency_files[i,j]
+                files = self.dependency_graph.files(i, j)
                 for file in files:
                     assert file in parent_outputs
                     assert file in child_inputs
@@ -314,6 +284,8 @@ class Tracker(object):
             for inp in inputs:
                 found = False
                 for (j, dataset) in enumerate(self.datasets):
+                    if not dataset.is_original_file(inp):
+                        continue
                     fields = dataset.get_fields(inp)
                     if fields is not None:
                         assert not found
@@ -336,34 +308,151 @@ class Tracker(object):
         Breaks commands down into `stages' for visualization. Each stage only
         depends on events from previous stages.
         """
-        all_stages = []
-        this_stage_nodes = []
-        next_stage_nodes = []
-
-        # find all nodes without parents to start us off
-        completed_nodes = set()
-        for (i, cmd) in enumerate(self.commands):
-            if np.sum(self.dependency_graph[:,i]) == 0:
-                this_stage_nodes.append(i)
-
-        # continue through each stage
-        while True:
-            next_stage_nodes = []
-            for node in this_stage_nodes:
-                completed_nodes.add(node)
-                children = np.where(self.dependency_graph[node,:])[0]
-                for child in children:
-                    if child not in completed_nodes:
-                        # make sure all its parents have been accounted for
-                        # before adding it
-                        parents = np.where(self.dependency_graph[:, child])[0]
-                        if set(parents).issubset(completed_nodes):
-                            next_stage_nodes.append(int(child))
-            all_stages.append(this_stage_nodes)
-            if next_stage_nodes == []:
-                break
-            this_stage_nodes = next_stage_nodes
-        return all_stages
+        return self.dependency_graph.layers()
+
+    def load_task_timings(self, metadata_path):
+        """
+        Reads how long each command took in previous runs from the wrapper
+        summaries in metadata_path (see write_pipeline_to_json). Returns a
+        list with the median wall time (in seconds) of each command's
+        successful runs, or None for commands without any.
+        """
+        timings = []
+        for command in self.commands:
+            folder = os.path.join(metadata_path, core.get_cmdline_hash(command.cmd))
+            times = []
+            try:
+                filenames = os.listdir(folder)
+            except OSError:
+                filenames = []
+            for filename in filenames:
+                if not filename.endswith('_summary.json'):
+                    continue
+                try:
+                    with open(os.path.join(folder, filename)) as f:
+                        summary = json.load(f)
+                except (IOError, ValueError):
+                    continue
+                if summary.get('retcode') == 0 and 'wall_time' in summary:
+                    times.append(summary['wall_time'])
+            timings.append(float(np.median(times)) if len(times) > 0 else None)
+        return timings
+
+    def estimate_durations(self, metadata_path, default_duration=0.0):
+        """
+        Estimates how long each command will take: commands that ran before
+        use their median time (see load_task_timings), and other commands use
+        the median over commands of the same class (e.g. all ANTSCommands),
+        the median over all commands, or default_duration, whichever is
+        available first.
+        """
+        timings = self.load_task_timings(metadata_path)
+        by_class = collections.defaultdict(list)
+        for (command, timing) in zip(self.commands, timings):
+            if timing is not None:
+                by_class[command.__class__].append(timing)
+        class_medians = dict((cls, np.median(times)) for (cls, times) in by_class.iteritems())
+        known = [t for t in timings if t is not None]
+        overall = float(np.median(known)) if len(known) > 0 else default_duration
+
+        durations = []
+        for (command, timing) in zip(self.commands, timings):
+            if timing is None:
+                timing = float(class_medians.get(command.__class__, overall))
+            durations.append(timing)
+        return durations
+
+    def topological_order(self):
+        """ Returns the commands' indices with each command after its parents """
+        if not hasattr(self, 'dependency_graph'):
+            self.compute_dependencies()
+        return [node for stage in self.compute_stages() for node in stage]
+
+    def compute_critical_path(self, durations):
+        """
+        Finds the longest chain of dependent commands, given the duration of
+        each command. Returns (critical path as a list of indices, its length,
+        slack of each command). A command's slack is how much it could be
+        delayed without delaying the whole pipeline (0 on the critical path).
+        """
+        order = self.topological_order()
+        g = self.dependency_graph
+        earliest_finish = [0.0] * len(self.commands)
+        best_parent = [None] * len(self.commands)
+        for node in order:
+            start = 0.0
+            for parent in g.parents(node):
+                if best_parent[node] is None or earliest_finish[parent] > start:
+                    start = earliest_finish[parent]
+                    best_parent[node] = int(parent)
+            earliest_finish[node] = start + durations[node]
+
+        length = max(earliest_finish) if len(order) > 0 else 0.0
+        latest_finish = [length] * len(self.commands)
+        for node in reversed(order):
+            for child in g.children(node):
+                latest_finish[node] = min(latest_finish[node],
+                        latest_finish[child] - durations[child])
+        slack = [lf - ef for (lf, ef) in zip(latest_finish, earliest_finish)]
+
+        path = []
+        if len(order) > 0:
+            node = int(np.argmax(earliest_finish))
+            while node is not None:
+                path.append(node)
+                node = best_parent[node]
+            path.reverse()
+        return (path, length, slack)
+
+    def estimate_makespan(self, durations, n_workers):
+        """
+        Estimates how long the whole pipeline takes on n_workers workers by
+        simulating a list scheduler that always starts the ready command with
+        the longest remaining chain after it.
+        """
+        if n_workers < 1:
+            raise ValueError("Can't schedule on %r workers: need at least 1" % n_workers)
+        order = self.topological_order()
+        g = self.dependency_graph
+        # priority: length of the longest chain starting at each command
+        chain_length = [0.0] * len(self.commands)
+        for node in reversed(order):
+            rest = [chain_length[child] for child in g.children(node)]
+            chain_length[node] = durations[node] + (max(rest) if rest else 0.0)
+
+        n_waiting = [len(g.parents(i)) for i in xrange(len(self.commands))]
+        ready = [(-chain_length[i], i) for i in order if n_waiting[i] == 0]
+        heapq.heapify(ready)
+        running = [] # heap of (finish time, command)
+        now = 0.0
+        while ready or running:
+            while ready and len(running) < n_workers:
+                (_, node) = heapq.heappop(ready)
+                heapq.heappush(running, (now + durations[node], node))
+            (now, node) = heapq.heappop(running)
+            for child in g.children(node):
+                n_waiting[child] -= 1
+                if n_waiting[child] == 0:
+                    heapq.heappush(ready, (-chain_length[child], int(child)))
+        return now
+
+    def estimate_schedule(self, metadata_path, n_workers=1, default_duration=0.0):
+        """
+        Estimates the schedule of this pipeline from the timings of previous
+        runs (see estimate_durations). Returns a dictionary with:
+          durations: estimated duration of each command
+          critical_path: indices of the commands on the critical path
+          critical_path_length: the critical path's duration
+          slack: slack of each command (see compute_critical_path)
+          makespan: estimated total time with n_workers workers
+        """
+        durations = self.estimate_durations(metadata_path, default_duration)
+        (path, length, slack) = self.compute_critical_path(durations)
+        return {'durations': durations,
+                'critical_path': path,
+                'critical_path_length': length,
+                'slack': slack,
+                'makespan': self.estimate_makespan(durations, n_workers)}
 
     def test_is_original_file(self, filename):
         for dataset in self.datasets:
@@ -409,8 +498,19 @@ class Tracker(object):
             out_stages.append(out_stage)
         return out_stages
 
-def gather_multi_subject_jsons(datasets, subject_list, out_location, iterable_key='subj'):
-    all_jsons = {}
+# Key (in each subject's graph in an aggregate JSON) of the [filename,
+# modification time] of the graph JSON it came from
+SOURCE_KEY = 'pb_source'
+
+def gather_multi_subject_jsons(datasets, subject_list, out_location, iterable_key='subj',
+        n_threads=16, incremental=True):
+    """
+    Gathers the graph JSONs of the latest pipelines of many subjects into
+    one aggregate JSON (for SubjServer), which is compact if out_location
+    ends with .json.gz (see graphjson). The JSONs are loaded by a pool of
+    threads. If incremental is True and out_location already exists, only
+    subjects whose latest JSON changed since it was written are reloaded.
+    """
     a_subject = subject_list[0]
     assert a_subject in subject_list
     this_json_list = None
@@ -424,49 +524,507 @@ def gather_multi_subject_jsons(datasets, subject_list, out_location, iterable_ke
     if this_json_list is None:
         raise ValueError("Couldn't find any JSON files in " + log_folder)
     #assert this_subj_json is not None
-    for subject in subject_list:
+    assert out_location.endswith('.json') or out_location.endswith('.json.gz')
+    previous = {}
+    if incremental and os.path.exists(out_location):
+        previous = graphjson.load(out_location)
+
+    def load_subject(subject):
         json_list = this_json_list.replace(a_subject, subject)
         try:
             subj_json = read_last_line(json_list)
-        except IOError:
-            continue
-        with open(subj_json) as f:
-            all_jsons[subject] = json.load(f)
+            source = [subj_json, os.path.getmtime(subj_json)]
+        except (IOError, OSError, IndexError):
+            return None
+        old = previous.get(subject)
+        if old is not None and old.get(SOURCE_KEY) == source:
+            return old
+        graph = graphjson.load(subj_json)
+        graph[SOURCE_KEY] = source
+        return graph
+
+    pool = multiprocessing.pool.ThreadPool(n_threads)
+    try:
+        graphs = pool.map(load_subject, subject_list)
+    finally:
+        pool.close()
+        pool.join()
+    all_jsons = dict((subject, graph) for (subject, graph) in
+            zip(subject_list, graphs) if graph is not None)
 
-    assert out_location.endswith('.json')
-    with open(out_location, 'w') as f:
-        json.dump(all_jsons, f)
+    graphjson.save(all_jsons, out_location, aggregate=True)
 
-def read_last_line(filename):
+def read_last_line(filename, blocksize=4096):
+    """
+    Returns the last line of a file (which should end with a newline),
+    reading backwards from the end a block at a time so that long files
+    aren't read in full.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = ''
+        while position > 0 and data.count('\n') < 3:
+            step = min(blocksize, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    if position > 0:
+        # (the first line in data may be partial, but that's not the one we want)
+        data = data.split('\n', 1)[1]
+    return data.rsplit('\n', 2)[-2]
+
+class FileCache(object):
     """
-    (Naively) reads the whole file in and returns the last line.
+    Thread-safe LRU cache of values computed from files (e.g. parsed JSON),
+    keyed on each file's path and modification time so that files are
+    reloaded when they change.
+    """
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict() # maps (path, mtime) -> value
+        self.keys = {} # maps path -> its current key
+        self.lock = threading.Lock()
+
+    def get(self, filename, load):
+        """
+        Returns load(filename), from the cache if the file hasn't changed
+        since it was last loaded.
+        """
+        key = (filename, os.path.getmtime(filename))
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                return value
+        value = load(filename)
+        with self.lock:
+            old_key = self.keys.pop(filename, None)
+            if old_key is not None:
+                self.entries.pop(old_key, None)
+            self.entries[key] = value
+            self.keys[filename] = key
+            while len(self.entries) > self.max_size:
+                (old_key, _) = self.entries.popitem(last=False)
+                if self.keys.get(old_key[0]) == old_key:
+                    del self.keys[old_key[0]]
+        return value
+
+def load_graph_json(filename):
     """
-    # TODO make this smarter
+    Loads a pipeline graph JSON file, returning both the parsed graph and
+    its serialized form (so it can be served without re-serializing).
+    """
+    if graphjson.is_compact_filename(filename):
+        graph = graphjson.load(filename)
+        return (graph, json.dumps(graph))
     with open(filename) as f:
-        line = f.read().rsplit('\n', 2)[-2]
-    return line
+        serialized = f.read()
+    return (json.loads(serialized), serialized)
+
+# Axes of a (RAS-oriented) volume for each slice orientation
+SLICE_AXES = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+
+def is_nifti(filename):
+    return filename.endswith('.nii') or filename.endswith('.nii.gz')
+
+def encode_png(image):
+    """ Encodes a 2D uint8 array as a grayscale PNG (using only zlib) """
+    (height, width) = image.shape
+    # each row starts with its filter type (0: none)
+    raw = ''.join('\x00' + row.tostring() for row in np.ascontiguousarray(image))
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return '\x89PNG\r\n\x1a\n' + \
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + \
+            chunk('IDAT', zlib.compress(raw)) + chunk('IEND', '')
+
+def get_slice(filename, axis='axial', index=None, size=128):
+    """
+    Reads one slice of a NIfTI volume (by default the middle one), reading
+    only that slice rather than the whole volume where the format allows.
+    The slice is downsampled so that neither side is larger than size,
+    scaled to 0-255 (between the 1st and 99th percentiles), and rotated so
+    that it displays upright. Returns a 2D uint8 array. Requires nibabel.
+    """
+    import nibabel
+    img = nibabel.load(filename)
+    a = SLICE_AXES[axis]
+    if index is None:
+        index = img.shape[a] // 2
+    slicer = [slice(None)] * 3 + [0] * (len(img.shape) - 3)
+    slicer[a] = int(index)
+    data = np.asarray(img.dataobj[tuple(slicer)], dtype=np.float32)
+    step = max(1, int(np.ceil(max(data.shape) / int(size))))
+    data = data[::step, ::step]
+    (low, high) = np.percentile(data, [1, 99])
+    scaled = np.clip((data - low) / ((high - low) or 1), 0, 1) * 255
+    return np.rot90(scaled.astype(np.uint8))
+
+def get_thumbnail(filename, cache_folder, axis='axial', index=None, size=128,
+        format='png'):
+    """
+    Returns a slice of a NIfTI volume (see get_slice) encoded as a PNG, or as
+    a .npy array if format is 'raw'. Thumbnails are cached in cache_folder,
+    keyed on the volume's modification time, so each one is only rendered
+    once per version of the file.
+    """
+    st = os.stat(filename)
+    key = hashlib.md5(repr((os.path.abspath(filename), st.st_mtime, st.st_size,
+        axis, index, int(size)))).hexdigest()
+    extension = '.png' if format == 'png' else '.npy'
+    cached = os.path.join(cache_folder, key + extension)
+    if os.path.exists(cached):
+        with open(cached, 'rb') as f:
+            return f.read()
+    image = get_slice(filename, axis, index, size)
+    if format == 'png':
+        data = encode_png(image)
+    else:
+        buf = StringIO.StringIO()
+        np.save(buf, image)
+        data = buf.getvalue()
+    util.make_folder(cache_folder)
+    (fd, tmp_filename) = tempfile.mkstemp(dir=cache_folder)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_filename, cached)
+    return data
+
+def is_within(filename, folder):
+    """
+    Checks whether filename is inside folder, after resolving symlinks and ..
+    (so e.g. /data/base_dir2/x and /data/base_dir/../x aren't inside
+    /data/base_dir)
+    """
+    folder = os.path.join(os.path.realpath(folder), '')
+    return os.path.realpath(filename).startswith(folder)
+
+def check_etag(etag):
+    """
+    Sets a response's ETag, and responds with 304 Not Modified if the
+    request's If-None-Match matches it. etag can be weak (W/"..."); as
+    If-None-Match requires, tags match whether or not they're weak.
+    """
+    cherrypy.response.headers['ETag'] = etag
+    if_none_match = cherrypy.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [_strip_weak(tag.strip()) for tag in if_none_match.split(',')]
+        if _strip_weak(etag) in tags or '*' in tags:
+            raise cherrypy.HTTPRedirect([], 304)
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+# Statuses of commands in the visualization (see get_node_status)
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+def get_node_status(node):
+    """
+    Determines the status of a node (command) in a pipeline graph from the
+    files that the wrapper writes to its metadata folder: a run that has
+    output files but no exit status is still running. Nodes that never ran
+    through the wrapper are pending, unless their first output exists.
+    """
+    folder = node.get('metadata_prefix')
+    try:
+        files = os.listdir(folder) if folder else []
+    except OSError:
+        files = []
+    runs = collections.defaultdict(set) # maps run prefix -> its files' suffixes
+    for filename in files:
+        (prefix, _, suffix) = filename.rpartition('_')
+        runs[prefix].add(suffix)
+    if len(runs) == 0:
+        if len(node['outputs']) > 0 and os.path.exists(node['outputs'][0]):
+            return SUCCEEDED
+        return PENDING
+    # run prefixes end with a timestamp (see make_metadata_prefix)
+    latest = max(runs, key=lambda prefix: prefix.rsplit('.', 1)[-1])
+    if 'retcode' in runs[latest]:
+        try:
+            with open(os.path.join(folder, latest + '_retcode')) as f:
+                retcode = int(f.read().strip())
+        except (IOError, ValueError):
+            return RUNNING # (being written)
+        return SUCCEEDED if retcode == 0 else FAILED
+    elif 'stdout' in runs[latest]:
+        return RUNNING
+    else:
+        return PENDING
+
+class NodeStatusWatcher(object):
+    """
+    Keeps the statuses of a pipeline graph's nodes up to date. A node's
+    metadata folder is only re-read when the folder's modification time
+    changes (the wrapper adds files to it when a command starts and when it
+    finishes), so updating is cheap enough to run every few seconds. Every
+    update that changes something gets a new version number, so clients can
+    ask for only the statuses that changed since the version they last saw.
+    """
+    # Folders modified this recently are re-read anyway, since files added
+    # within the filesystem's timestamp resolution don't change the mtime
+    SETTLE_TIME = 2
+
+    def __init__(self, graph):
+        self.nodes = graph['subnodes']
+        self.folder_mtimes = [None] * len(self.nodes)
+        self.statuses = [None] * len(self.nodes)
+        self.changed_at = [0] * len(self.nodes) # version of last change
+        self.version = 0
+        self.lock = threading.Lock()
+        self.update()
+
+    def update(self):
+        """
+        Re-reads the metadata of nodes whose folders changed, and returns
+        a list of (node index, new status) pairs
+        """
+        changes = []
+        now = time.time()
+        for (i, node) in enumerate(self.nodes):
+            try:
+                mtime = os.stat(node['metadata_prefix']).st_mtime
+            except (KeyError, OSError):
+                mtime = None
+            if self.statuses[i] is not None and mtime == self.folder_mtimes[i] \
+                    and (mtime is None or now - mtime > self.SETTLE_TIME):
+                continue
+            self.folder_mtimes[i] = mtime
+            status = get_node_status(node)
+            if status != self.statuses[i]:
+                changes.append((i, status))
+        if len(changes) > 0:
+            with self.lock:
+                self.version += 1
+                for (i, status) in changes:
+                    self.statuses[i] = status
+                    self.changed_at[i] = self.version
+        return changes
+
+    def get_changes(self, since=0):
+        """
+        Returns the current version, and a dictionary with the statuses of
+        nodes that changed after version since (all of them if since is 0, or
+        if it's a version this watcher never had, e.g. from before the server
+        restarted).
+        """
+        with self.lock:
+            if since > self.version:
+                since = 0
+            changes = dict((i, status) for (i, status) in enumerate(self.statuses)
+                    if self.changed_at[i] > since)
+            return (self.version, changes)
+
+class OutputAggregate(object):
+    """
+    Aggregates the output info (see SubjServer._computeOutputInfo) of many
+    subjects. Numeric outputs are kept in a subjects x items matrix, so their
+    histograms and outliers are computed for every item in one vectorized
+    pass. Subjects can be added (or replaced) one at a time as their results
+    arrive, and each node's aggregate is only rebuilt when it's next asked for.
+    """
+    def __init__(self):
+        self.subjects = []
+        self.rows = {} # maps subject -> row
+        self.outputs = [] # output info of each row's subject
+        self.columns = {} # maps (node index, item index) -> column
+        self.values = np.empty((0, 0))
+        self.node_specs = {} # maps node index -> aggregate (until it changes)
+        self.stats = None
+        self.lock = threading.RLock()
+
+    def add_subject(self, subj, outputs):
+        """
+        Adds (or replaces) a subject's output info: a list with, for each
+        node, a list of items.
+        """
+        with self.lock:
+            if subj not in self.rows:
+                self.rows[subj] = len(self.subjects)
+                self.subjects.append(subj)
+                self.outputs.append(None)
+            row = self.rows[subj]
+            self.outputs[row] = outputs
+            numeric = [((i, j), item['numeric'])
+                    for (i, node) in enumerate(outputs)
+                    for (j, item) in enumerate(node) if 'numeric' in item]
+            for (key, _) in numeric:
+                if key not in self.columns:
+                    self.columns[key] = len(self.columns)
+            self._reserve(len(self.subjects), len(self.columns))
+            self.values[row, :] = np.nan
+            if numeric:
+                (keys, numbers) = zip(*numeric)
+                self.values[row, [self.columns[key] for key in keys]] = numbers
+            self.node_specs = {}
+            self.stats = None
+
+    def _reserve(self, n_rows, n_columns):
+        """ Grows the matrix (geometrically) to hold at least this many values """
+        (old_rows, old_columns) = self.values.shape
+        if n_rows <= old_rows and n_columns <= old_columns:
+            return
+        if n_rows > old_rows:
+            n_rows = max(n_rows, 2 * old_rows)
+        if n_columns > old_columns:
+            n_columns = max(n_columns, 2 * old_columns)
+        values = np.empty((max(n_rows, old_rows), max(n_columns, old_columns)))
+        values.fill(np.nan)
+        values[:old_rows, :old_columns] = self.values
+        self.values = values
+
+    def compute_stats(self):
+        """
+        Computes histograms and outliers (by the IQR rule) of the log10 of
+        every numeric item at once. Non-positive values are left out.
+        """
+        numbers = self.values[:len(self.subjects), :len(self.columns)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            logs = np.log10(numbers)
+        valid = np.isfinite(logs)
+        logs[~valid] = np.nan
+        counts = valid.sum(axis=0)
+        with warnings.catch_warnings():
+            # (items with no valid values give all-NaN columns)
+            warnings.simplefilter('ignore', RuntimeWarning)
+            (q1, median, q3) = np.nanpercentile(logs, [25, 50, 75], axis=0)
+            (low, high) = (np.nanmin(logs, axis=0), np.nanmax(logs, axis=0))
+        iqr = q3 - q1
+        with np.errstate(invalid='ignore'):
+            low_outliers = valid & (logs < median - 1.5 * iqr)
+            high_outliers = valid & (logs > median + 1.5 * iqr)
+
+        # Histograms: every column gets its own bins, so the counts of all of
+        # them are computed with one bincount over concatenated bins
+        n_bins = np.maximum(np.round(counts / 10).astype(int), 10)
+        flat = (low == high)
+        low[flat] -= 0.5
+        high[flat] += 0.5
+        width = (high - low) / n_bins
+        offsets = np.concatenate([[0], np.cumsum(n_bins)[:-1]])
+        (rows, cols) = np.nonzero(valid)
+        bins = ((logs[rows, cols] - low[cols]) / width[cols]).astype(int)
+        bins = np.minimum(bins, n_bins[cols] - 1)
+        bin_counts = np.bincount(offsets[cols] + bins, minlength=n_bins.sum())
+
+        self.stats = {'n_bins': n_bins, 'offsets': offsets, 'low': low,
+                'width': width, 'bin_counts': bin_counts,
+                'low_outliers': low_outliers, 'high_outliers': high_outliers}
+
+    def get_numeric_stats(self, column):
+        """ Returns the histogram and outlier subjects of a numeric item """
+        if self.stats is None:
+            self.compute_stats()
+        stats = self.stats
+        (start, n_bins) = (stats['offsets'][column], stats['n_bins'][column])
+        edges = stats['low'][column] + stats['width'][column] * np.arange(n_bins)
+        counts = stats['bin_counts'][start:start + n_bins]
+        histogram = [{'x': "%0.2f" % x, 'y': int(y)} for (x, y) in zip(edges, counts)]
+        (low_rows,) = np.nonzero(stats['low_outliers'][:, column])
+        (high_rows,) = np.nonzero(stats['high_outliers'][:, column])
+        outliers = {'low': [self.subjects[r] for r in low_rows],
+                    'high': [self.subjects[r] for r in high_rows]}
+        return (histogram, outliers)
+
+    def get_node(self, index):
+        """
+        Returns the aggregate of a node's items: values that are the same for
+        every subject are given as is, and others as {'aggregate': True,
+        'value': values, 'subjects': subjects}.
+        """
+        with self.lock:
+            if index not in self.node_specs:
+                self.node_specs[index] = self._aggregate_node(index)
+            return self.node_specs[index]
+
+    def _aggregate_node(self, index):
+        nodes = [(subj, outputs[index]) for (subj, outputs) in
+                zip(self.subjects, self.outputs) if index < len(outputs)]
+        n_items = max([len(node) for (_, node) in nodes] or [0])
+        aggregate_node = []
+        for j in xrange(n_items):
+            items = [(subj, node[j]) for (subj, node) in nodes if j < len(node)]
+            keys = set()
+            for (_, item) in items:
+                keys.update(item.keys())
+            out_val = {}
+            fractions = []
+            for key in keys:
+                (subjects, values) = zip(*[(subj, item[key]) for (subj, item)
+                    in items if key in item])
+                first = values[0]
+                if all(value == first for value in values):
+                    out_val[key] = first
+                else:
+                    fractions.append(len(subjects) / len(self.subjects))
+                    out_val[key] = {'aggregate': True, 'value': values, 'subjects': subjects}
+            if fractions:
+                out_val['completion_fraction'] = min(fractions)
+            if isinstance(out_val.get('numeric'), dict):
+                (out_val['histogram'], out_val['outliersubj']) = \
+                        self.get_numeric_stats(self.columns[(index, j)])
+            aggregate_node.append(out_val)
+        return aggregate_node
 
 class SubjServer(object):
 
     def __init__(self, dataset, subject_list, content_path, aggregate_json_file=None,
-            field_to_iterate='subj'):
+            field_to_iterate='subj', cache_size=32, status_interval=2,
+            thumbnail_folder=None, aggregate_interval=60,
+            output_info_folder=None, n_threads=16):
         """
         Creates a new subject server.
 
         Inputs
         ------
         dataset:
+        cache_size: how many subjects' graphs to keep in memory
+        status_interval: how often (in seconds) to check for changes in the
+                         statuses of the subjects' commands
+        thumbnail_folder: where to cache thumbnails of NIfTI outputs
+                          (defaults to pb_thumbnails in the dataset's
+                          base_dir). Thumbnails of a command's outputs are
+                          rendered when it finishes.
+        aggregate_interval: how often (in seconds) to look for subjects with
+                            new pipelines, and add them to the aggregate
+        output_info_folder: where to cache subjects' output info (defaults
+                            to pb_output_info in the dataset's base_dir)
+        n_threads: how many threads to read subjects' output info with
         """
+        if output_info_folder is None:
+            output_info_folder = os.path.join(dataset.base_dir, 'pb_output_info')
+        self.output_info_folder = output_info_folder
+        self.n_threads = n_threads
+        if thumbnail_folder is None:
+            thumbnail_folder = os.path.join(dataset.base_dir, 'pb_thumbnails')
+        self.thumbnail_folder = thumbnail_folder
         self.dataset = dataset
         self.content_path = content_path
-        self.activeJSON = None
+        self.graph_cache = FileCache(2 * cache_size) # graphs and json lists
+        self.cache_size = cache_size
+        # maps graph JSON filename -> NodeStatusWatcher
+        self.status_watchers = collections.OrderedDict()
+        self.status_lock = threading.Lock()
+        # one background thread updates all the watchers, so that requests
+        # don't have to wait or touch the filesystem
+        self.status_monitor = cherrypy.process.plugins.Monitor(cherrypy.engine,
+                self.update_statuses, frequency=status_interval,
+                name='NodeStatusWatcher')
+        self.status_monitor.subscribe()
         self.subject_list = subject_list
         self.precomputed_output_info = None
         self.aggregate_json_file = aggregate_json_file
         self.field_to_iterate = field_to_iterate
+        self.aggregate = OutputAggregate()
+        # maps subject -> graph JSON filename its aggregated info came from
+        self.aggregated_from = {}
         if aggregate_json_file is not None:
-            with open(aggregate_json_file) as f:
-                aggregate_json = json.load(f)
+            aggregate_json = graphjson.load(aggregate_json_file)
             self.aggregate_json = aggregate_json
             self.good_subjects = sorted(aggregate_json.keys())
 
@@ -474,15 +1032,76 @@ class SubjServer(object):
             self.combine_output_info()
         else:
             self.aggregate_json = None
+            self.good_subjects = []
+        self.aggregate_monitor = cherrypy.process.plugins.Monitor(cherrypy.engine,
+                self.update_aggregate, frequency=aggregate_interval,
+                name='AggregateUpdater')
+        self.aggregate_monitor.subscribe()
+
+    def get_active_subject(self):
+        """
+        Returns the subject this client's session is looking at (each
+        browser session has its own), or 'aggregate'.
+        """
+        return cherrypy.session.get('active_subj', 'aggregate')
+
+    def get_json_list_filename(self, subj):
+        """ Returns the file listing the graph JSONs of a subject's pipelines """
+        return os.path.join(self.dataset.get_log_folder(**{self.field_to_iterate: subj}),
+                     'pb_json_list.txt')
+
+    def get_graph_filename(self, subj):
+        """ Returns the filename of the graph JSON of a subject's latest pipeline """
+        return self.graph_cache.get(self.get_json_list_filename(subj), read_last_line)
+
+    def get_graph(self, subj):
+        """
+        Returns the (parsed, serialized) graph JSON of a subject's latest
+        pipeline, from memory unless its files changed.
+        """
+        return self.graph_cache.get(self.get_graph_filename(subj), load_graph_json)
+
+    def get_active_graph_subject(self):
+        """ Returns the subject whose graph this client's session shows """
+        active_subj = self.get_active_subject()
+        if active_subj == 'aggregate':
+            active_subj = self.subject_list[0]
+        return active_subj
+
+    def get_active_graph(self):
+        """ Returns the (parsed, serialized) graph for this client's session """
+        return self.get_graph(self.get_active_graph_subject())
+
+    def get_status_watcher(self, subj):
+        """ Returns the NodeStatusWatcher for a subject's latest pipeline """
+        json_fname = self.get_graph_filename(subj)
+        with self.status_lock:
+            if json_fname in self.status_watchers:
+                return self.status_watchers[json_fname]
+        watcher = NodeStatusWatcher(self.get_graph(subj)[0])
+        with self.status_lock:
+            watcher = self.status_watchers.setdefault(json_fname, watcher)
+            while len(self.status_watchers) > self.cache_size:
+                self.status_watchers.popitem(last=False)
+        return watcher
+
+    def update_statuses(self):
+        """ Updates the status watchers (called by a background thread) """
+        with self.status_lock:
+            watchers = self.status_watchers.values()
+        for watcher in watchers:
+            for (i, status) in watcher.update():
+                if status == SUCCEEDED:
+                    self.prerender_thumbnails(watcher.nodes[i])
 
     @cherrypy.expose
     def getOutputInfo(self, index):
         index = int(index)
         cherrypy.response.headers['Content-Type'] = 'application/json'
-        if (self.is_aggregate):
-            json_dict = {'aggregate': True, 'data': self.aggregated_output_spec[index]}
+        if self.get_active_subject() == 'aggregate':
+            json_dict = {'aggregate': True, 'data': self.aggregate.get_node(index)}
         else:
-            json_dict = self._computeOutputInfo(index, self.activeJSON)
+            json_dict = self._computeOutputInfo(index, self.get_active_graph()[0])
         return json.dumps(json_dict)
 
     def _computeOutputInfo(self, index, json_dict):
@@ -504,18 +1123,28 @@ class SubjServer(object):
                 json_file = None
         else:
             json_file = None
+        # (read into a separate dict, since node may be shared by the cache)
+        extras = {}
         for extra in ['stdout', 'stderr']:
-            if extra not in node:
-                    try:
-                        with open(json_file) as f:
-                            node[extra] = json.load(f)[extra]
-                    # TODO ioerror and json load error only, no key error
-                    except:
-                        node[extra] = ''
+            if extra in node:
+                extras[extra] = node[extra]
+            else:
+                try:
+                    with open(json_file) as f:
+                        summary = json.load(f)
+                    if extra in summary:
+                        extras[extra] = summary[extra]
+                    else:
+                        # newer wrappers stream output to separate files
+                        with open(summary[extra + '_file']) as f:
+                            extras[extra] = f.read()
+                # TODO ioerror and json load error only, no key error
+                except:
+                    extras[extra] = ''
         out = [
                 {'name': 'Command line', 'value': node['task_info']['cmd'], 'type': 'string'},
-                {'name': 'stdout', 'value': node['stdout'], 'type': 'string'},
-                {'name': 'stderr', 'value': node['stderr'], 'type': 'string'},
+                {'name': 'stdout', 'value': extras['stdout'], 'type': 'string'},
+                {'name': 'stderr', 'value': extras['stderr'], 'type': 'string'},
                 ]
 
         for (param_name, filename) in node['named_outfiles'].items():
@@ -535,92 +1164,115 @@ class SubjServer(object):
 
         return out
 
+    def get_metadata_key(self, json_dict):
+        """
+        Returns the modification times of a pipeline's metadata folders.
+        Commands add files to these whenever they run, so output info
+        computed when they had the same times is still current.
+        """
+        key = []
+        for node in json_dict['subnodes']:
+            metadata_prefix = node.get('metadata_prefix')
+            try:
+                mtime = os.path.getmtime(metadata_prefix)
+            except (OSError, TypeError):
+                mtime = None
+            key.append([metadata_prefix, mtime])
+        return key
+
+    def get_output_info(self, subj, json_dict):
+        """
+        Returns the output info (see _computeOutputInfo) of every node in a
+        subject's pipeline: from the on-disk cache in output_info_folder if
+        none of its metadata folders changed since it was cached.
+        """
+        key = self.get_metadata_key(json_dict)
+        cache_file = os.path.join(self.output_info_folder,
+                hashlib.md5(subj).hexdigest() + '.json')
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                return cached['outputs']
+        except (IOError, ValueError, KeyError):
+            pass
+        outputs = [self._computeOutputInfo(index, json_dict)
+                for index in xrange(len(json_dict['subnodes']))]
+        try:
+            util.make_folder(self.output_info_folder)
+            (fd, tmp_filename) = tempfile.mkstemp(dir=self.output_info_folder)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'subj': subj, 'key': key, 'outputs': outputs}, f)
+            os.rename(tmp_filename, cache_file)
+        except (IOError, OSError) as e:
+            print("Warning: couldn't cache output info for %s: %s" % (subj, e))
+        return outputs
+
     def precompute_output_info(self):
-        self.precomputed_output_info = {}
-        for subj in self.good_subjects:
-            json = self.aggregate_json[subj]
-            indices = len(json['subnodes'])
-            outputs = []
-            for index in xrange(indices):
-                outputs.append(self._computeOutputInfo(index, json))
-            self.precomputed_output_info[subj] = outputs
+        """
+        Reads the output info of every subject in the aggregate JSON, using a
+        pool of threads (since it's mostly waiting on the filesystem).
+        """
+        pool = multiprocessing.pool.ThreadPool(self.n_threads)
+        try:
+            outputs = pool.map(
+                    lambda subj: self.get_output_info(subj, self.aggregate_json[subj]),
+                    self.good_subjects)
+        finally:
+            pool.close()
+            pool.join()
+        self.precomputed_output_info = dict(zip(self.good_subjects, outputs))
 
     def combine_output_info(self):
         if self.precomputed_output_info is None:
             self.precompute_output_info()
+        for subj in self.good_subjects:
+            self.aggregate.add_subject(subj, self.precomputed_output_info[subj])
+            source = self.aggregate_json[subj].get(SOURCE_KEY, [None])
+            self.aggregated_from.setdefault(subj, source[0])
 
-        outs = zip(*(self.precomputed_output_info[subj] for subj in self.good_subjects))
-        self.aggregated_output_spec = []
-        for (i, subj_nodes) in enumerate(outs):
-            aggregate_node = []
-            self.aggregated_output_spec.append(aggregate_node)
-            max_count = max((len(subj_node) for subj_node in subj_nodes))
-            for j in xrange(max_count):
-                keys = set()
-                for subj_node in subj_nodes:
-                    keys.update(subj_node[j].keys())
-                out_val = {}
-                completion_fraction = None
-                for key in keys:
-                    all_values = []
-                    for (subj, subj_node) in zip(self.good_subjects, subj_nodes):
-                        if key in subj_node[j]:
-                            all_values.append((subj, subj_node[j][key]))
-                    (subjects, values) = zip(*all_values)
-                    # TODO make out_val[key] a rich structure that stores #subjects, etc
-                    first = values[0]
-                    if values.count(first) == len(values):
-                        out_val[key] = first
-
-                    else:
+    def add_subject(self, subj, json_dict, source=None):
+        """
+        Adds (or updates) a subject's outputs in the aggregate, given its
+        pipeline graph (loaded from the file source).
+        """
+        self.aggregate.add_subject(subj, self.get_output_info(subj, json_dict))
+        self.aggregated_from[subj] = source
+        if subj not in self.good_subjects:
+            self.good_subjects = sorted(self.good_subjects + [subj])
 
-                        completion_fraction = len(subjects)/len(self.good_subjects)
-                        out_dict = {'aggregate': True, 'value': values, 'subjects': subjects}
-                        # if type(first) in (float, int):
-                        #     out_dict['type'] = 'number'
-                        # elif type(first) is str and os.path.exists(first):
-                        #     out_dict['type'] = 'filename'
-                        # elif type(first) is str:
-                        #     out_dict['type'] = 'string'
-                        out_val[key] = out_dict
-
-                if completion_fraction is not None:
-                    out_val['completion_fraction'] = completion_fraction
-
-                if 'numeric' in out_val:
-                    #numbers = np.array(out_val['numeric']['value'])
-                    numbers = np.log10(np.array(out_val['numeric']['value']))
-                    n_bins = int(round(numbers.size / 10))
-                    if n_bins < 10:
-                        n_bins = 10
-                    (counts, bins) = np.histogram(numbers, bins=n_bins)
-                    out_val['histogram'] = [{'x': "%0.2f" % x, 'y': y} for (x,y) in zip(bins, counts)]
-                    # Compute outliers
-                    (q1, median, q3) = np.percentile(numbers, [25, 50, 75])
-                    iqr = q3 - q1
-                    lower = median - 1.5*iqr
-                    upper = median + 1.5*iqr
-                    (low_indices,) = np.where(numbers < lower)
-                    (hi_indices,) = np.where(numbers > upper)
-                    low_subjs = [subjects[i] for i in low_indices]
-                    hi_subjs = [subjects[i] for i in hi_indices]
-                    out_val['outliersubj'] = {'low': low_subjs, 'high': hi_subjs}
-
-                aggregate_node.append(out_val)
+    def update_aggregate(self):
+        """
+        Adds subjects whose latest pipeline changed (or who didn't have one
+        before) to the aggregate (called by a background thread). Subjects
+        loaded from an aggregate JSON that doesn't record where they came
+        from (see gather_multi_subject_jsons) are assumed current until their
+        latest pipeline changes.
+        """
+        for subj in self.subject_list:
+            try:
+                graph_filename = read_last_line(self.get_json_list_filename(subj))
+            except (IOError, IndexError):
+                continue
+            if subj in self.aggregated_from and self.aggregated_from[subj] is None:
+                self.aggregated_from[subj] = graph_filename
+            if self.aggregated_from.get(subj) == graph_filename:
+                continue
+            try:
+                json_dict = graphjson.load(graph_filename)
+            except (IOError, ValueError):
+                continue
+            self.add_subject(subj, json_dict, graph_filename)
 
     @cherrypy.expose
     def index(self):
-        self.active_subj = 'aggregate'
-        self.is_aggregate = True
-        # self.is_aggregate = (subj == 'aggregate')
-        # self.active_subj = subj
+        cherrypy.session['active_subj'] = 'aggregate'
         raise cherrypy.HTTPRedirect("static/index.html")
 
 
     @cherrypy.expose
     def changeSubject(self, subj):
-        self.is_aggregate = (subj == 'aggregate')
-        self.active_subj = subj
+        cherrypy.session['active_subj'] = subj
         raise cherrypy.HTTPRedirect("static/index.html")
 
     @cherrypy.expose
@@ -635,17 +1287,8 @@ class SubjServer(object):
     @cherrypy.expose
     def getGraphJSON(self):
         # TODO intelligently go through the JSONs to find all the actions performed
-        if self.is_aggregate:
-            active_subj = self.subject_list[0]
-        else:
-            active_subj = self.active_subj
-        json_list_file = os.path.join(self.dataset.get_log_folder(**{self.field_to_iterate: active_subj}),
-                     'pb_json_list.txt')
-        json_fname = read_last_line(json_list_file)
-        with open(json_fname) as f:
-            self.activeJSON = json.load(f)
         cherrypy.response.headers['Content-Type'] = 'application/json'
-        return json.dumps(self.activeJSON)
+        return self.get_active_graph()[1]
 
 
     @cherrypy.expose
@@ -655,28 +1298,23 @@ class SubjServer(object):
         return json.dumps(self.good_subjects)
 
     @cherrypy.expose
-    def nodeStatuses(self, timeout):
-        import time
-        assert self.activeJSON is not None
-        # TODO actually retrieve statuses here based on metadata
-        # TODO sleep here
-        time.sleep(int(timeout))
-        statuses = []
-        for node in self.activeJSON['subnodes']:
-            if os.path.exists(node['outputs'][0]):
-                statuses.append(1)
-            else:
-                statuses.append(-1)
-        #statuses = [os.path.exists(node['outfiles'][0]) for node in self.activeJSON['nodes']]
-        #statuses = np.random.randint(-1, 2, len(self.activeJSON['nodes']))
+    def nodeStatuses(self, since=0):
+        """
+        Returns the statuses (see get_node_status) of the nodes whose status
+        changed after version since, and the current version to pass next
+        time. Responds right away with what the background watcher has seen
+        (without touching the filesystem or holding a server thread), so
+        clients should poll this every few seconds.
+        """
+        watcher = self.get_status_watcher(self.get_active_graph_subject())
+        (version, changes) = watcher.get_changes(int(since))
         cherrypy.response.headers['Content-Type'] = 'application/json'
-        #return json.dumps(statuses.aslist())
-        return json.dumps(statuses)
+        return json.dumps({'version': version, 'statuses': changes})
 
     @cherrypy.expose
     def queryFile(self, filename):
         filename = os.path.normpath(filename)
-        if not filename.startswith(self.dataset.base_dir):
+        if not is_within(filename, self.dataset.base_dir):
             print("Warning: invalid file access attempted: you asked for")
             print(filename)
             print("but I can only serve files from " + self.dataset.base_dir)
@@ -693,13 +1331,17 @@ class SubjServer(object):
     @cherrypy.expose
     def retrieveFile(self, filename):
         """
-        Meant for reading of arbitrary files from disk.
+        Meant for reading of arbitrary files from disk. Supports range
+        requests and conditional requests (If-None-Match/If-Modified-Since,
+        answered with 304 Not Modified), and streams the file in chunks
+        instead of loading it into memory, so large volumes are served
+        efficiently and can be cached by the browser.
         """
         # TODO make this secure: currently allows reading of arbitrary
         # files once you've authenticated with the password. integrate w/dataset?
         #filename = os.path.normpath('/' + '/'.join(args))
         filename = os.path.normpath(filename)
-        if not filename.startswith(self.dataset.base_dir):
+        if not is_within(filename, self.dataset.base_dir):
             print("Warning: invalid file access attempted: you asked for")
             print(filename)
             print("but I can only serve files from " + self.dataset.base_dir)
@@ -712,10 +1354,53 @@ class SubjServer(object):
             # mime type enables us to read the file after loading
             (mtype, encoding) = mimetypes.guess_type(filename)
             cherrypy.response.headers["Access-Control-Allow-Origin"] = '*'
-            cherrypy.response.headers["Content-Type"] = mtype
             if encoding is not None:
                 cherrypy.response.headers["Content-Encoding"] = encoding
-            return open(filename, 'r')
+            # weak validator from the file's mtime and size, so that files
+            # don't have to be read to compute it
+            st = os.stat(filename)
+            check_etag('W/"%x-%x"' % (int(st.st_mtime * 1e6), st.st_size))
+            # (serve_file handles Range and If-Modified-Since)
+            return cherrypy.lib.static.serve_file(os.path.abspath(filename), mtype)
+    retrieveFile._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def getThumbnail(self, filename, axis='axial', index=None, size=128,
+            format='png'):
+        """
+        Returns a downsampled slice of a NIfTI file (see get_thumbnail), as a
+        PNG or (with format='raw') a .npy array, so that outputs can be
+        checked without downloading whole volumes.
+        """
+        filename = os.path.normpath(filename)
+        if not is_within(filename, self.dataset.base_dir) or \
+                not os.path.exists(filename) or not is_nifti(filename) or \
+                axis not in SLICE_AXES:
+            raise cherrypy.HTTPError(404)
+        st = os.stat(filename)
+        check_etag('W/"%x-%x-%s-%s-%s-%s"' % (int(st.st_mtime * 1e6), st.st_size,
+            axis, index, size, format))
+        if index is not None:
+            index = int(index)
+        data = get_thumbnail(filename, self.thumbnail_folder, axis, index,
+                int(size), format)
+        if format == 'png':
+            cherrypy.response.headers['Content-Type'] = 'image/png'
+        else:
+            cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        return data
+
+    def prerender_thumbnails(self, node):
+        """ Renders the middle slices of a finished node's NIfTI outputs """
+        for output in node['outputs']:
+            if is_nifti(output) and os.path.exists(output):
+                for axis in SLICE_AXES:
+                    try:
+                        get_thumbnail(output, self.thumbnail_folder, axis)
+                    except ImportError: # no nibabel
+                        return
+                    except Exception as e:
+                        print("Warning: couldn't render thumbnail of %s: %s" % (output, e))
 
 # TODO more secure password checking (salting? reading from file? etc)
 def checkpasshash(realm, user, password):
@@ -759,6 +1444,10 @@ def run_server(subject_list, dataset, aggregate_json=None,
                     }
     cherrypy.config.update(global_config)
     appconfig = {
+            '/': {
+                # each browser session has its own active subject
+                'tools.sessions.on': True,
+            },
             '/viewer': {
                 'tools.auth_basic.on': True,
                  'tools.auth_basic.realm': 'viz',
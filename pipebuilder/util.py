@@ -1,4 +1,7 @@
 import os
+import errno
+import fcntl
+import pipes
 import collections
 import ConfigParser
 
@@ -26,3 +29,34 @@ def add_extension(str):
     else:
         return str + ex
 
+def shell_join(args):
+    """
+    Joins arguments into a command line, quoting each one so that the shell
+    passes it through unchanged (e.g. paths with spaces or quotes in them)
+    """
+    return ' '.join(pipes.quote(arg) for arg in args)
+
+def make_folder(path):
+    """
+    Creates a folder (and its parents). Doesn't complain if it already
+    exists, e.g. because another process just created it.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as exc: # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else: raise
+
+def append_line(filename, line):
+    """
+    Appends a line to a file, locking it so that lines appended by other
+    processes at the same time don't get interleaved.
+    """
+    with open(filename, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line + '\n')
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
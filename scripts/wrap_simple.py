@@ -1,42 +1,89 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
-import sys, os
-import subprocess
+import os
+import sys
 import json
-import tempfile
-import hashlib
-import base64
+import time
+import threading
+import subprocess
+
+# Size of the chunks that output is copied in
+CHUNK_SIZE = 64 * 1024
+
+def tee(pipe, out_file, console):
+    """
+    Copies a process's output to a file and the console as it arrives,
+    a chunk at a time (so memory use doesn't grow with the output size).
+    """
+    while True:
+        chunk = os.read(pipe.fileno(), CHUNK_SIZE)
+        if not chunk:
+            break
+        out_file.write(chunk)
+        # (on python 3, bytes go to the console's underlying buffer)
+        getattr(console, 'buffer', console).write(chunk)
+        console.flush()
+    pipe.close()
 
 def main(argv):
-    USAGE = '{} <args>' \
-        'Runs command line in <args> and writes metadata to task files'
+    USAGE = '{} <prefix> <args>' \
+        'Runs command line in <args> and writes output and metadata to files ' \
+        'starting with <prefix>'
     #(global_json_file, task_json_file) = sys.argv[1:3]
     prefix = argv[1]
-    cmd = ' '.join(argv[2:])
-
-    cmdline_hash = base64.urlsafe_b64encode(hashlib.md5(cmd).digest())
+    cmd = argv[2:]
 
     # TODO input checking
-    print('\n    '.join(argv[2:]))
-    proc = subprocess.Popen(argv[2:], stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-
-    (stdout, stderr) = proc.communicate()
-    retcode = proc.returncode
+    print('\n    '.join(cmd))
+    sys.stdout.flush()
+    start_time = time.time()
+    with open(prefix + '_stdout', 'wb') as stdout_file, \
+            open(prefix + '_stderr', 'wb') as stderr_file:
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, bufsize=0)
+        except OSError as e:
+            stderr_file.write((str(e) + '\n').encode())
+            print(e, file=sys.stderr)
+            proc = None
+        if proc is not None:
+            threads = [threading.Thread(target=tee, args=args) for args in
+                        [(proc.stdout, stdout_file, sys.stdout),
+                         (proc.stderr, stderr_file, sys.stderr)]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # wait4 (rather than proc.wait) also gives us resource usage
+            (_, status, usage) = os.wait4(proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                retcode = -os.WTERMSIG(status)
+            else:
+                retcode = os.WEXITSTATUS(status)
+            proc.returncode = retcode
+        else:
+            retcode = 127
+            usage = None
+    wall_time = time.time() - start_time
 
-    summary = {'stdout': stdout, 'stderr': stderr, 'retcode': retcode}
-    # redundancy for convenience: these shouldn't be THAT big anyway
+    summary = {'retcode': retcode,
+               'stdout_file': prefix + '_stdout',
+               'stderr_file': prefix + '_stderr',
+               'start_time': start_time,
+               'wall_time': wall_time}
+    if usage is not None:
+        summary.update({
+            'user_time': usage.ru_utime,
+            'sys_time': usage.ru_stime,
+            'max_rss_kb': usage.ru_maxrss,
+            'input_blocks': usage.ru_inblock,
+            'output_blocks': usage.ru_oublock,
+        })
     with open(prefix + '_summary.json', 'w') as f:
         json.dump(summary, f)
-    with open(prefix + '_stdout', 'w') as f:
-        f.write(stdout)
-    with open(prefix + '_stderr', 'w') as f:
-        f.write(stderr)
     with open(prefix + '_retcode', 'w') as f:
         f.write(str(retcode))
-    print(stdout)
-    print(stderr, file=sys.stderr)
 
     sys.exit(retcode)
 
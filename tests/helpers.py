@@ -0,0 +1,20 @@
+"""
+Helpers shared by the tests.
+"""
+
+class FakeCommand(object):
+    """
+    Stands in for a Command in code that only looks at its command line,
+    inputs and outputs (e.g. StalenessChecker, get_shared_command and
+    DependencyGraph)
+    """
+    descr = 'fake'
+    def __init__(self, inputs, outfiles, cmd='fake'):
+        self.cmd = cmd
+        self.inputs = set(inputs)
+        self.outfiles = outfiles
+
+def write_args(filename, *args):
+    """ Writes the repr of its arguments to filename (for PyFunctionCommand) """
+    with open(filename, 'w') as f:
+        f.write(repr(args))
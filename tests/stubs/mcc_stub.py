@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Stands in for an MCC-compiled MATLAB function in tests: copy it to
+MCC_<name>/run_<name>.sh and MCC_<name>/run_<name>_batch.sh. The function
+copies its input (first argument) to its output (last argument), and fails
+if the input doesn't exist.
+
+    run_<name>.sh <MCR> <input> ... <output>
+    run_<name>_batch.sh <MCR> <manifest> <status file>
+
+The batch form follows the protocol of mcc.run_mcc_batch. Each time the
+"MCR" starts, a line is appended to the file named by $PB_STUB_MCR_LOG (if
+set), so tests can count startups.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+
+def run(args):
+    (input, output) = (args[0], args[-1])
+    if not os.path.exists(input):
+        print('Missing input: ' + input, file=sys.stderr)
+        return 1
+    shutil.copy(input, output)
+    print('Copied %s to %s' % (input, output))
+    return 0
+
+def main(argv):
+    mcr = argv[1]
+    if 'PB_STUB_MCR_LOG' in os.environ:
+        with open(os.environ['PB_STUB_MCR_LOG'], 'a') as f:
+            f.write(mcr + '\n')
+    if not argv[0].endswith('_batch.sh'):
+        return run(argv[2:])
+    (manifest_file, status_file) = argv[2:4]
+    with open(manifest_file) as f:
+        arg_lists = [line.rstrip('\n').split('\t') for line in f]
+    with open(status_file, 'w') as f:
+        for args in arg_lists:
+            f.write('%d\n' % run(args))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,114 @@
+"""
+Tests the bookkeeping of Command objects and pipelines (see core.py).
+"""
+import re
+import pickle
+import unittest
+
+import pipebuilder as pb
+from pipebuilder import core
+
+def old_find_inputs(command):
+    """
+    The inputs that Command.__init__ found before input_params: every keyword
+    argument was split on unescaped spaces with a regex and searched for
+    paths
+    """
+    inputs = set()
+    for (k, v) in command.parameters.iteritems():
+        if k == 'cmdName':
+            continue
+        if type(v) is str:
+            values = re.split(r'(?<!\\)\s+', v)
+        elif type(v) is list or type(v) is tuple:
+            values = v
+        else:
+            continue
+        for v in values:
+            if (type(v) is str and core.has_valid_path(v)) or hasattr(v, 'filename'):
+                inputs.add(core.to_filename(v))
+    return inputs.difference(command.outfiles)
+
+def make_commands():
+    """
+    Returns (command, extra) pairs, where extra holds the paths that the old
+    search also (wrongly) took for inputs
+    """
+    transforms = ' /data/warp/s0_Warp.nii.gz /data/warp/s0_Affine.txt '
+    return [
+        (pb.N4Command('Correct', input='/data/s0.nii.gz',
+            output='/data/s0_n4.nii.gz'), set()),
+        (pb.ANTSWarpCommand('Warp', moving='/data/s0.nii.gz',
+            reference='/data/template.nii.gz', output='/data/s0_warped.nii.gz',
+            transforms=transforms, dimension=3), set()),
+        (pb.ANTSComposeTransformCommand('Compose',
+            reference='/data/template.nii.gz', output='/data/s0_composed.nii.gz',
+            transforms=transforms), set()),
+        # (out_prefix is where the output goes, not an input)
+        (pb.ANTSJacobianCommand('Jacobian', input='/data/warp/s0_Warp.nii.gz'),
+            set(['/data/warp/s0_Warp'])),
+        (pb.NiiToolsMaskedThresholdCountCommand('Count', infile='/data/s0.nii.gz',
+            threshold=0.5, output='/data/s0_count.txt', label='/data/s0_seg.nii.gz',
+            direction='greater', units='mm', labels=[2, 41]), set()),
+        (pb.NiiToolsMatchIntensityCommand('Match', inFile='/data/s0.nii.gz',
+            maskFile='/data/s0_mask.nii.gz', intensity=100,
+            output='/data/s0_matched.nii.gz'), set()),
+        (pb.NiiToolsPadCommand('Pad', input='/data/s0.nii.gz',
+            output='/data/s0_pad.nii.gz', outmask='/data/s0_padmask.nii.gz'), set()),
+        (pb.NiiToolsWarpSSDCommand('SSD', in1='/data/s0.nii.gz', in2='/data/s1.nii.gz',
+            template='/data/template.nii.gz', output='/data/ssd.txt'), set()),
+        (pb.NiiToolsDiceCommand('Dice', in1='/data/s0_seg.nii.gz',
+            in2='/data/s1_seg.nii.gz', output='/data/dice.txt'), set()),
+        # (out_mask is an output that the command doesn't list in outfiles)
+        (pb.NiiToolsUpsampleCommand('Upsample', input='/data/s0.nii.gz',
+            output='/data/s0_up.nii.gz', out_mask='/data/s0_upmask.nii.gz', ratio=2),
+            set(['/data/s0_upmask.nii.gz'])),
+        # (out_template is a pattern for the outputs)
+        (pb.NiiToolsSplitWarpCommand('Split', infile='/data/warp/s0_Warp.nii.gz',
+            out_template='/data/warp/s0_Warp%d.nii.gz'),
+            set(['/data/warp/s0_Warp%d.nii.gz'])),
+        (pb.NiiToolsMaskCommand('Mask', input='/data/s0.nii.gz',
+            mask='/data/s0_mask.nii.gz', output='/data/s0_masked.nii.gz'), set()),
+    ]
+
+class InputParamsTest(unittest.TestCase):
+    def test_against_old_search(self):
+        with pb.Pipeline('test'):
+            commands = make_commands()
+        for (command, extra) in commands:
+            self.assertIsNotNone(command.input_params)
+            self.assertEqual(command.inputs, old_find_inputs(command) - extra,
+                    command.__class__.__name__)
+
+    def test_split_paths(self):
+        for value in ['/a/b', ' /a/b  /c\t/d\n', '/a/with\\ space /b',
+                '/a/with\\ two\\ spaces  /b ', '', '   ']:
+            expected = [v for v in re.split(r'(?<!\\)\s+', value) if v != '']
+            self.assertEqual([v for v in core.split_paths(value) if v != ''], expected)
+
+class PickleTest(unittest.TestCase):
+    def test_protocols(self):
+        with pb.Pipeline('test'):
+            commands = [command for (command, _) in make_commands()]
+        for protocol in [0, 1, 2]:
+            for command in commands:
+                copy = pickle.loads(pickle.dumps(command, protocol))
+                self.assertIs(copy.__class__, command.__class__)
+                for name in ['comment', 'parameters', 'cmd', 'outfiles', 'inputs',
+                        'clobber', 'skip', 'shared', 'command_id']:
+                    self.assertEqual(getattr(copy, name), getattr(command, name))
+                self.assertEqual(copy.__dict__, command.__dict__)
+
+class MaxCommandsTest(unittest.TestCase):
+    def test_bound(self):
+        with pb.Pipeline('test', max_commands=3) as pipeline:
+            for i in xrange(3):
+                pb.N4Command('Correct', input='/data/s%d.nii.gz' % i,
+                        output='/data/s%d_n4.nii.gz' % i)
+            with self.assertRaises(RuntimeError):
+                pb.N4Command('Correct', input='/data/s3.nii.gz',
+                        output='/data/s3_n4.nii.gz')
+        self.assertEqual(len(pipeline.commands), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Tests running commands with executor.execute.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import pipebuilder as pb
+from pipebuilder import executor
+
+class ExecuteTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_executor')
+        self.input = self.path('in.txt')
+        with open(self.input, 'w') as f:
+            f.write('data\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def copy(self, input, output):
+        return pb.InputOutputShellCommand('Copy %s to %s' % (input, output),
+                cmdName='cp', input=input, output=output)
+
+    def test_dependencies(self):
+        with pb.Pipeline('test') as pipeline:
+            self.copy(self.input, self.path('a.txt'))
+            self.copy(self.path('missing.txt'), self.path('b.txt'))
+            self.copy(self.path('b.txt'), self.path('c.txt'))
+            self.copy(self.path('a.txt'), self.path('d.txt'))
+        statuses = executor.execute(pipeline.commands, max_workers=2)
+        self.assertEqual(statuses, [executor.SUCCEEDED, executor.FAILED,
+            executor.UPSTREAM_FAILED, executor.SUCCEEDED])
+        self.assertTrue(os.path.exists(self.path('d.txt')))
+
+    def test_merge_duplicates(self):
+        with pb.Pipeline('test') as pipeline:
+            self.copy(self.input, self.path('a.txt'))
+            self.copy(self.input, self.path('a.txt'))
+            self.copy(self.path('a.txt'), self.path('b.txt'))
+        commands = list(pipeline.commands)
+        statuses = executor.execute(pipeline.commands, merge_duplicates=True)
+        self.assertEqual(pipeline.commands, commands)
+        self.assertEqual(statuses, [executor.SUCCEEDED] * 3)
+        self.assertTrue(os.path.exists(self.path('b.txt')))
+
+    def test_merge_duplicate_commands(self):
+        with pb.Pipeline('test') as pipeline:
+            self.copy(self.input, self.path('a.txt'))
+            self.copy(self.input, self.path('b.txt'))
+            self.copy(self.input, self.path('a.txt'))
+        commands = pipeline.commands
+        (unique, merged_into) = pb.merge_duplicate_commands(commands)
+        self.assertEqual(unique, commands[:2])
+        self.assertEqual(merged_into, [0, 1, 0])
+        self.assertEqual(pb.get_duplicates(commands, unique, merged_into), [commands[2]])
+        self.assertEqual(len(commands), 3)
+
+    def test_merge_flags(self):
+        with pb.Pipeline('test') as pipeline:
+            for (clobber, skip) in [(False, True), (True, True), (False, False)]:
+                pb.InputOutputShellCommand('Copy', cmdName='cp', input=self.input,
+                        output=self.path('a.txt'), clobber=clobber, skip=skip)
+        (unique, _) = pb.merge_duplicate_commands(pipeline.commands)
+        self.assertEqual(unique, pipeline.commands[:1])
+        self.assertTrue(unique[0].clobber)
+        self.assertFalse(unique[0].skip)
+
+    def test_rebuild_requires_log_folder(self):
+        with pb.Pipeline('test') as pipeline:
+            self.copy(self.input, self.path('a.txt'))
+        self.assertRaises(ValueError, executor.execute, pipeline.commands,
+                rebuild_stale_outputs=True)
+
+if __name__ == '__main__':
+    unittest.main()
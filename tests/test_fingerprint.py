@@ -0,0 +1,81 @@
+"""
+Tests deciding which commands have stale outputs (see fingerprint.py).
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from pipebuilder import fingerprint
+
+from helpers import FakeCommand
+
+class StalenessCheckerTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_fingerprint')
+        self.metadata_path = os.path.join(self.folder, 'pb_metadata')
+        os.mkdir(self.metadata_path)
+        # (the shell would split or interpret these paths if they weren't quoted)
+        self.input = self.write("input file (1).txt", 'data\n')
+        self.output = self.write("output $file's.txt", 'result\n')
+        self.command = FakeCommand([self.input], [self.output], 'process %s' % self.input)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, contents, mtime=None):
+        filename = os.path.join(self.folder, name)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def make_checker(self, digest=False):
+        return fingerprint.StalenessChecker(self.metadata_path, digest)
+
+    def test_without_stamp(self):
+        now = time.time()
+        self.write(self.input, 'data\n', now - 100)
+        self.write(self.output, 'result\n', now)
+        self.assertFalse(self.make_checker().is_stale(self.command))
+        self.write(self.input, 'data\n', now + 100)
+        self.assertTrue(self.make_checker().is_stale(self.command))
+
+    def test_record_command(self):
+        checker = self.make_checker()
+        retcode = subprocess.call(checker.get_record_command(self.command),
+                shell=True, executable='/bin/bash')
+        self.assertEqual(retcode, 0)
+        self.assertTrue(os.path.exists(checker.get_stamp_filename(self.command)))
+        self.assertFalse(self.make_checker().is_stale(self.command))
+
+        self.write(self.input, 'new data\n')
+        self.assertTrue(self.make_checker().is_stale(self.command))
+
+    def test_changed_command_line(self):
+        self.make_checker().record(self.command)
+        self.command.cmd += ' --option'
+        self.assertTrue(self.make_checker().is_stale(self.command))
+
+    def test_digest(self):
+        checker = self.make_checker(digest=True)
+        checker.record(self.command)
+        checker.cache.save()
+        # rewritten with the same contents: only the time changes
+        self.write(self.input, 'data\n', time.time() + 100)
+        self.assertFalse(self.make_checker().is_stale(self.command))
+        self.write(self.input, 'atad\n', time.time() + 200)
+        self.assertTrue(self.make_checker().is_stale(self.command))
+
+    def test_rebuilt_inputs(self):
+        checker = self.make_checker()
+        checker.record(self.command)
+        upstream = FakeCommand([], [self.input], 'make input')
+        checker.mark_rebuilt(upstream)
+        self.assertTrue(checker.is_stale(self.command))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Tests the dependency graph between commands (see graph.py).
+"""
+import random
+import unittest
+
+from pipebuilder import graph
+from pipebuilder import tracking
+
+from helpers import FakeCommand
+
+def make_random_commands(n_nodes, max_inputs=4, seed=0):
+    """ Makes a random pipeline where each command reads earlier commands' outputs """
+    rng = random.Random(seed)
+    commands = []
+    for i in xrange(n_nodes):
+        n_inputs = rng.randint(0, max_inputs) if i > 0 else 0
+        parents = set(rng.randrange(i) for _ in xrange(n_inputs))
+        commands.append(FakeCommand(['/data/out%d' % p for p in parents]
+                                    + ['/data/original%d' % i], ['/data/out%d' % i]))
+    return commands
+
+def old_compute_stages(dependency_graph, bottom_up=False):
+    """
+    The implementation of Tracker.compute_stages(_bottomup) before
+    DependencyGraph.layers, which checked every parent of a command each time
+    one of them finished
+    """
+    if bottom_up:
+        (forward, backward) = (dependency_graph.parents, dependency_graph.children)
+    else:
+        (forward, backward) = (dependency_graph.children, dependency_graph.parents)
+    all_stages = []
+    this_stage_nodes = [i for i in xrange(dependency_graph.n_nodes) if len(backward(i)) == 0]
+    completed_nodes = set()
+    while True:
+        next_stage_nodes = []
+        for node in this_stage_nodes:
+            completed_nodes.add(node)
+            for child in forward(node):
+                if child not in completed_nodes:
+                    if set(backward(child)).issubset(completed_nodes):
+                        next_stage_nodes.append(int(child))
+        all_stages.append(this_stage_nodes)
+        if next_stage_nodes == []:
+            break
+        this_stage_nodes = next_stage_nodes
+    if bottom_up:
+        all_stages.reverse()
+    return all_stages
+
+class DependencyGraphTest(unittest.TestCase):
+    def setUp(self):
+        #   0 -> 1 -> 3
+        #   0 -> 2 -> 3 (through two files)
+        #   4 (independent)
+        self.commands = [
+            FakeCommand(['/in'], ['/a']),
+            FakeCommand(['/a'], ['/b']),
+            FakeCommand(['/a', '/in'], ['/c', '/d']),
+            FakeCommand(['/b', '/c', '/d'], ['/e']),
+            FakeCommand(['/in'], ['/f']),
+        ]
+        self.graph = graph.DependencyGraph(self.commands)
+
+    def test_edges(self):
+        self.assertEqual(self.graph.n_edges, 4)
+        self.assertEqual(list(self.graph.children(0)), [1, 2])
+        self.assertEqual(list(self.graph.parents(3)), [1, 2])
+        self.assertEqual(list(self.graph.parents(4)), [])
+        self.assertEqual(sorted(self.graph.files(2, 3)), ['/c', '/d'])
+        self.assertEqual(self.graph.weight(2, 3), 2)
+        self.assertEqual(self.graph.weight(3, 2), 0)
+        self.assertEqual([(i, j, sorted(files)) for (i, j, files) in self.graph.edges()],
+                [(0, 1, ['/a']), (0, 2, ['/a']), (1, 3, ['/b']), (2, 3, ['/c', '/d'])])
+
+    def test_empty(self):
+        empty = graph.DependencyGraph([])
+        self.assertEqual(empty.n_edges, 0)
+        self.assertEqual(list(empty.edges()), [])
+
+    def test_against_dense(self):
+        """ Checks the graph against a direct comparison of every pair of commands """
+        commands = make_random_commands(300)
+        dependencies = graph.DependencyGraph(commands)
+        for (j, command) in enumerate(commands):
+            expected = [i for (i, other) in enumerate(commands)
+                    if not command.inputs.isdisjoint(other.outfiles)]
+            self.assertEqual(list(dependencies.parents(j)), expected)
+        for (i, command) in enumerate(commands):
+            expected = [j for (j, other) in enumerate(commands)
+                    if not other.inputs.isdisjoint(command.outfiles)]
+            self.assertEqual(list(dependencies.children(i)), expected)
+
+    def test_layers(self):
+        self.assertEqual(self.graph.layers(), [[0, 4], [1, 2], [3]])
+        self.assertEqual(self.graph.layers(bottom_up=True), [[3, 4], [1, 2], [0]])
+
+    def test_layers_against_old_stages(self):
+        for seed in xrange(5):
+            commands = make_random_commands(500, seed=seed)
+            tracker = tracking.Tracker(commands, [])
+            tracker.compute_dependencies()
+            self.assertEqual(tracker.compute_stages(),
+                    old_compute_stages(tracker.dependency_graph))
+            self.assertEqual(tracker.compute_stages_bottomup(),
+                    old_compute_stages(tracker.dependency_graph, bottom_up=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Tests reading and writing pipeline graph JSONs (see graphjson.py).
+"""
+import os
+import json
+import gzip
+import shutil
+import tempfile
+import unittest
+
+import pipebuilder as pb
+from pipebuilder import tracking
+from pipebuilder import graphjson
+
+class GraphJSONTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_graphjson')
+        self.metadata_path = os.path.join(self.folder, 'pb_metadata')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def make_graph(self, subject):
+        """ Returns the graph of a small pipeline, as write_pipeline_to_json writes it """
+        base = '/data/%s/' % subject
+        with pb.Pipeline(subject) as pipeline:
+            n4 = pb.N4Command('Correct bias', input=base + 'flair.nii.gz',
+                    output=base + 'flair_n4.nii.gz')
+            for sigma in [1, 2]:
+                pb.NiiToolsGaussianBlurCommand('Blur %d' % sigma,
+                        input=n4.outfiles[0], sigma=sigma,
+                        output=base + 'flair_blur%d.nii.gz' % sigma)
+            pb.InputOutputShellCommand('Copy', cmdName='cp',
+                    input=base + 'flair blur.nii.gz', output=base + 'copy.nii.gz')
+        filename = self.path(subject + '.json')
+        tracking.Tracker(pipeline.commands, []).write_pipeline_to_json(filename,
+                self.metadata_path)
+        with open(filename) as f:
+            return json.load(f)
+
+    def test_round_trip(self):
+        graph = self.make_graph('subj1')
+        # (fields that compact_node can't derive are kept as they are)
+        graph['subnodes'][0]['metadata_prefix'] = '/elsewhere/metadata'
+        graph['subnodes'][1]['task_info']['comment'] = 'Another comment'
+        for name in ['graph.json', 'graph.json.gz']:
+            filename = self.path(name)
+            graphjson.save(graph, filename)
+            self.assertEqual(graphjson.load(filename), graph)
+        self.assertFalse(any(name.endswith('.tmp') for name in os.listdir(self.folder)))
+
+    def test_compact_form(self):
+        graph = self.make_graph('subj1')
+        filename = self.path('graph.json.gz')
+        graphjson.save(graph, filename)
+        with gzip.open(filename) as f:
+            compact = json.load(f)
+        self.assertEqual(compact[graphjson.COMPACT_KEY], graphjson.COMPACT_VERSION)
+        # each path is stored once
+        self.assertEqual(len(compact['strings']), len(set(compact['strings'])))
+        self.assertIn('/data/subj1/flair_n4.nii.gz', compact['strings'])
+        self.assertLess(os.path.getsize(filename), len(json.dumps(graph)))
+
+    def test_aggregate_round_trip(self):
+        graphs = dict((subject, self.make_graph(subject)) for subject in ['subj1', 'subj2'])
+        for name in ['aggregate.json', 'aggregate.json.gz']:
+            filename = self.path(name)
+            graphjson.save(graphs, filename, aggregate=True)
+            self.assertEqual(graphjson.load(filename), graphs)
+
+    def test_older_files(self):
+        """ Checks that files written with json.dump (as before graphjson) still load """
+        graph = self.make_graph('subj1')
+        filename = self.path('old.json')
+        with open(filename, 'w') as f:
+            json.dump(graph, f)
+        self.assertEqual(graphjson.load(filename), graph)
+
+if __name__ == '__main__':
+    unittest.main()
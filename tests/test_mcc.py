@@ -0,0 +1,87 @@
+"""
+Tests batching MCC commands (see mcc.py and executor.execute), using a stub
+in place of the compiled MATLAB functions (see stubs/mcc_stub.py).
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import pipebuilder as pb
+from pipebuilder import mcc
+from pipebuilder import executor
+from pipebuilder import tracking
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs', 'mcc_stub.py')
+
+class MCCBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_mcc')
+        self.mcc_folder = os.path.join(self.folder, 'MCC_copyNii')
+        os.mkdir(self.mcc_folder)
+        for name in ['run_copyNii.sh', 'run_copyNii_batch.sh']:
+            shutil.copy(STUB, os.path.join(self.mcc_folder, name))
+        self.mcr_log = os.path.join(self.folder, 'mcr_log.txt')
+        os.environ['PB_STUB_MCR_LOG'] = self.mcr_log
+
+        self.saved = (mcc.MCCCommand.prefix, mcc.MCCCommand.batch_script)
+        mcc.MCCCommand.prefix = os.path.join(self.folder,
+                'MCC_%(matlabName)s/run_%(matlabName)s.sh ') + 'MCR '
+        mcc.MCCCommand.batch_script = os.path.join(self.folder,
+                'MCC_%(matlabName)s/run_%(matlabName)s_batch.sh')
+
+    def tearDown(self):
+        (mcc.MCCCommand.prefix, mcc.MCCCommand.batch_script) = self.saved
+        del os.environ['PB_STUB_MCR_LOG']
+        shutil.rmtree(self.folder)
+
+    def make_commands(self, n, missing=()):
+        """ Makes n commands copying in<i> to out<i> (without creating in<i> for i in missing) """
+        with pb.Pipeline('test') as pipeline:
+            for i in xrange(n):
+                input = os.path.join(self.folder, 'in%d.txt' % i)
+                if i not in missing:
+                    with open(input, 'w') as f:
+                        f.write('subject %d\n' % i)
+                pb.MCCInputOutputCommand('Copy %d' % i, matlabName='copyNii',
+                        input=input, output=os.path.join(self.folder, 'out%d.txt' % i))
+        return pipeline.commands
+
+    def count_mcr_starts(self):
+        if not os.path.exists(self.mcr_log):
+            return 0
+        with open(self.mcr_log) as f:
+            return len(f.readlines())
+
+    def test_batch(self):
+        commands = self.make_commands(4, missing=[2])
+        statuses = executor.execute(commands, batch=True, max_workers=2)
+        self.assertEqual(statuses, [executor.SUCCEEDED, executor.SUCCEEDED,
+            executor.FAILED, executor.SUCCEEDED])
+        self.assertEqual(self.count_mcr_starts(), 1)
+        with open(os.path.join(self.folder, 'out3.txt')) as f:
+            self.assertEqual(f.read(), 'subject 3\n')
+
+    def test_batch_metadata(self):
+        commands = self.make_commands(3, missing=[1])
+        log_folder = os.path.join(self.folder, 'log')
+        executor.execute(commands, batch=True, log_folder=log_folder)
+        metadata_path = os.path.join(log_folder, 'pb_metadata')
+        statuses = [tracking.get_node_status({'outputs': command.outfiles,
+            'metadata_prefix': os.path.join(metadata_path, pb.get_cmdline_hash(command.cmd))})
+            for command in commands]
+        self.assertEqual(statuses, [tracking.SUCCEEDED, tracking.FAILED, tracking.SUCCEEDED])
+        timings = tracking.Tracker(commands, []).load_task_timings(metadata_path)
+        self.assertNotEqual(timings[0], None)
+        self.assertEqual(timings[1], None) # (failed runs don't count)
+
+    def test_without_batch_script(self):
+        os.remove(os.path.join(self.mcc_folder, 'run_copyNii_batch.sh'))
+        commands = self.make_commands(3)
+        self.assertEqual(commands[0].get_batch_key(), None)
+        statuses = executor.execute(commands, batch=True, max_workers=2)
+        self.assertEqual(statuses, [executor.SUCCEEDED] * 3)
+        self.assertEqual(self.count_mcr_starts(), 3)
+
+if __name__ == '__main__':
+    unittest.main()
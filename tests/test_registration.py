@@ -0,0 +1,62 @@
+"""
+Tests the ANTS registration commands' bookkeeping (see registration.py).
+"""
+import unittest
+
+import pipebuilder as pb
+
+TRANSFORMS = ' /data/atlas/to_template_Warp.nii.gz /data/atlas/to_template_Affine.txt '
+
+def make_warp(subject, dimension=3, reference='/data/template.nii.gz'):
+    return pb.ANTSWarpCommand('Warp %s' % subject,
+            moving='/data/%s/image.nii.gz' % subject, reference=reference,
+            output='/data/out/%s_%dD.nii.gz' % (subject, dimension),
+            transforms=TRANSFORMS, dimension=dimension)
+
+class ComposeRepeatedWarpsTest(unittest.TestCase):
+    def test_compose(self):
+        with pb.Pipeline('test') as pipeline:
+            pb.N4Command('Correct', input='/data/atlas.nii.gz', output='/data/atlas_n4.nii.gz')
+            warps = [make_warp('s%d' % i) for i in xrange(3)]
+            other = make_warp('other', reference='/data/other_template.nii.gz')
+            inserted = pb.compose_repeated_warps(min_uses=3)
+        self.assertEqual(len(inserted), 1)
+        # (inserted before the first warp that uses it)
+        self.assertTrue(pipeline.commands[1] is inserted[0])
+        composed = inserted[0].outfiles[0]
+        for warp in warps:
+            self.assertEqual(warp.parameters['transforms'].split(), [composed])
+            self.assertIn(composed, warp.inputs)
+        self.assertEqual(other.parameters['transforms'], TRANSFORMS)
+
+    def test_dimensions(self):
+        with pb.Pipeline('test'):
+            for dimension in [2, 3]:
+                for i in xrange(3):
+                    make_warp('s%d' % i, dimension)
+            inserted = pb.compose_repeated_warps(min_uses=3)
+        self.assertEqual(len(inserted), 2)
+        self.assertNotEqual(inserted[0].outfiles, inserted[1].outfiles)
+        self.assertEqual([c.parameters['dimension'] for c in inserted], [2, 3])
+
+class WarpMappingTest(unittest.TestCase):
+    def test_warp_mapping(self):
+        with pb.Pipeline('first'):
+            warp = make_warp('s0')
+            mapping = pb.ANTSWarpCommand.warp_mapping
+            self.assertEqual(mapping[('/data/s0/image.nii.gz', '/data/template.nii.gz')],
+                    warp.parameters['output'])
+            self.assertTrue(mapping is pb.ANTSWarpCommand.get_index().warp_mapping)
+            self.assertTrue(warp.warp_mapping is mapping)
+        # each pipeline has its own
+        with pb.Pipeline('second'):
+            self.assertEqual(pb.ANTSWarpCommand.warp_mapping, {})
+
+    def test_read_only(self):
+        with pb.Pipeline('test'):
+            warp = make_warp('s0')
+            with self.assertRaises(AttributeError):
+                warp.warp_mapping = {}
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Tests estimating a pipeline's schedule from previous runs' timings (see
+Tracker.estimate_schedule).
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from pipebuilder import core
+from pipebuilder import tracking
+
+from helpers import FakeCommand
+
+class Registration(FakeCommand):
+    descr = 'registration'
+
+class Segmentation(FakeCommand):
+    descr = 'segmentation'
+
+class Other(FakeCommand):
+    descr = 'other'
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_schedule')
+        #   0 -> 1 -> 3
+        #   0 -> 2 -> 3
+        #   4 (independent)
+        self.commands = [
+            FakeCommand(['/in'], ['/a'], 'make a'),
+            FakeCommand(['/a'], ['/b'], 'make b'),
+            FakeCommand(['/a'], ['/c'], 'make c'),
+            FakeCommand(['/b', '/c'], ['/d'], 'make d'),
+            FakeCommand(['/in'], ['/e'], 'make e'),
+        ]
+        self.durations = [2.0, 3.0, 1.0, 4.0, 1.0]
+        self.tracker = tracking.Tracker(self.commands, [])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_summary(self, command, run, wall_time, retcode=0):
+        folder = os.path.join(self.folder, core.get_cmdline_hash(command.cmd))
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        with open(os.path.join(folder, 'pb_%d_summary.json' % run), 'w') as f:
+            json.dump({'retcode': retcode, 'wall_time': wall_time}, f)
+
+    def test_critical_path(self):
+        (path, length, slack) = self.tracker.compute_critical_path(self.durations)
+        self.assertEqual(path, [0, 1, 3])
+        self.assertEqual(length, 9.0)
+        self.assertEqual(slack, [0.0, 0.0, 2.0, 0.0, 8.0])
+
+    def test_makespan(self):
+        self.assertEqual(self.tracker.estimate_makespan(self.durations, 1), 11.0)
+        # 4 runs alongside 0 and 2 alongside 1, so the critical path decides
+        self.assertEqual(self.tracker.estimate_makespan(self.durations, 2), 9.0)
+        self.assertEqual(self.tracker.estimate_makespan(self.durations, 10), 9.0)
+        self.assertRaises(ValueError, self.tracker.estimate_makespan, self.durations, 0)
+
+    def test_durations(self):
+        commands = [
+            Registration([], [], 'register 1'),
+            Registration([], [], 'register 2'),
+            Registration([], [], 'register 3'),
+            Segmentation([], [], 'segment 1'),
+            Other([], [], 'other 1'),
+        ]
+        for (run, wall_time) in enumerate([10.0, 20.0, 60.0]):
+            self.write_summary(commands[0], run, wall_time)
+        self.write_summary(commands[1], 0, 50.0)
+        # (failed runs don't count)
+        self.write_summary(commands[1], 1, 1000.0, retcode=1)
+        self.write_summary(commands[3], 0, 2.0)
+
+        tracker = tracking.Tracker(commands, [])
+        self.assertEqual(tracker.load_task_timings(self.folder),
+                [20.0, 50.0, None, 2.0, None])
+        # register 3 falls back on the median of the other registrations,
+        # and other 1 (the only one of its class) on the median of all
+        self.assertEqual(tracker.estimate_durations(self.folder),
+                [20.0, 50.0, 35.0, 2.0, 20.0])
+
+    def test_durations_without_timings(self):
+        self.assertEqual(self.tracker.estimate_durations(self.folder, 5.0), [5.0] * 5)
+        schedule = self.tracker.estimate_schedule(self.folder, 2, 1.0)
+        self.assertEqual(schedule['critical_path'], [0, 1, 3])
+        self.assertEqual(schedule['critical_path_length'], 3.0)
+        self.assertEqual(schedule['makespan'], 3.0)
+
+if __name__ == '__main__':
+    unittest.main()
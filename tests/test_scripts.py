@@ -0,0 +1,44 @@
+"""
+Tests the commands for running simple scripts and Python functions (see
+scripts.py).
+"""
+import os
+import sys
+import shlex
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import pipebuilder as pb
+
+class PyFunctionCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_scripts')
+        self.output = os.path.join(self.folder, 'args.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_script_command(self):
+        args = [self.output, "it's \"quoted\" $HOME `ls` 100%", 3, 2.5,
+                [1, None, True], {'a': (1, 2)}]
+        with pb.Pipeline('test'):
+            command = pb.PyFunctionCommand('Write args', 'helpers.write_args', args)
+        # (the command line runs whichever python is on the PATH, so this
+        # runs its code with this one)
+        argv = shlex.split(command.cmd)
+        self.assertEqual(argv[:2], ['python', '-c'])
+        self.assertEqual(len(argv), 3)
+        self.assertEqual(subprocess.call([sys.executable, '-c', argv[2]]), 0)
+        with open(self.output) as f:
+            self.assertEqual(f.read(), repr(tuple(args[1:])))
+
+    def test_non_literal(self):
+        with pb.Pipeline('test'):
+            for arg in [object(), float('nan'), [self]]:
+                self.assertRaises(ValueError, pb.PyFunctionCommand,
+                        'Write args', 'helpers.write_args', [self.output, arg])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Tests submitting commands as SGE jobs (see sge.py), using a fake qsub (see
+stubs/qsub) that runs each job as it's submitted.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import pipebuilder as pb
+from pipebuilder import tracking
+
+STUBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+class SubmitCommandsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_sge')
+        self.log_folder = os.path.join(self.folder, 'logs')
+        os.mkdir(self.log_folder)
+        self.saved_path = os.environ['PATH']
+        os.environ['PATH'] = STUBS + os.pathsep + self.saved_path
+        os.environ['PB_FAKE_QSUB_DIR'] = self.folder
+        with open(self.path('in.txt'), 'w') as f:
+            f.write('data\n')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.saved_path
+        del os.environ['PB_FAKE_QSUB_DIR']
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def make_pipeline(self):
+        """
+        Makes a pipeline with two chains (a -> b, and c -> d, where c fails),
+        and an independent command e.
+        """
+        with pb.Pipeline('test') as pipeline:
+            for (input, output) in [('in', 'a'), ('a', 'b'), ('missing', 'c'),
+                                    ('c', 'd'), ('in', 'e')]:
+                pb.InputOutputShellCommand('Make ' + output, cmdName='cp',
+                        input=self.path(input + '.txt'), output=self.path(output + '.txt'))
+        return pipeline
+
+    def submit(self, sge_jobs):
+        pipeline = self.make_pipeline()
+        tracker = tracking.Tracker(pipeline.commands, [])
+        out = pipeline.generate_code_from_datasets([], self.log_folder,
+                tracker=tracker, sge=True, sge_jobs=sge_jobs)
+        with open(self.path('jobs.txt')) as f:
+            jobs = [json.loads(line) for line in f]
+        return (out, jobs)
+
+    def get_commands(self, job):
+        """ Returns the outputs (a, b, ...) made by a job's script """
+        with open(job['script'][:-len('.qsub')]) as f:
+            return [line.split()[-1] for line in f if line.startswith('# Make')]
+
+    def test_commands(self):
+        (job_folder, jobs) = self.submit('command')
+        self.assertTrue(os.path.isdir(job_folder))
+        # (only the job scripts are written)
+        self.assertEqual([f for f in os.listdir(self.log_folder) if f.endswith('.sh')], [])
+        self.assertEqual([self.get_commands(job) for job in jobs],
+                [['a'], ['b'], ['c'], ['d'], ['e']])
+        self.assertTrue(all(job['terse'] and job['queue'] == 'main.q' for job in jobs))
+        self.assertEqual([job['hold_jids'] for job in jobs],
+                [[], [jobs[0]['id']], [], [jobs[2]['id']], []])
+        # the failed job is put in the error state, and the one after it is held
+        self.assertEqual([job['status'] for job in jobs], [0, 0, 100, 'held', 0])
+        self.assertTrue(os.path.exists(self.path('b.txt')))
+        self.assertTrue(os.path.exists(self.path('e.txt')))
+        self.assertFalse(os.path.exists(self.path('d.txt')))
+
+    def test_chains(self):
+        (_, jobs) = self.submit('chain')
+        self.assertEqual([self.get_commands(job) for job in jobs],
+                [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual([job['hold_jids'] for job in jobs], [[], [], []])
+        self.assertEqual([job['status'] for job in jobs], [0, 100, 0])
+        self.assertTrue(os.path.exists(self.path('b.txt')))
+        self.assertFalse(os.path.exists(self.path('d.txt')))
+
+if __name__ == '__main__':
+    unittest.main()
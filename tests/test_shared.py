@@ -0,0 +1,63 @@
+"""
+Tests sharing the results of commands between pipelines (see shared.py).
+"""
+import os
+import pipes
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from pipebuilder import shared
+from pipebuilder.core import get_cmdline_hash
+
+from helpers import FakeCommand
+
+class SharedCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_shared')
+        self.shared_folder = os.path.join(self.folder, 'shared results')
+        self.input = os.path.join(self.folder, 'atlas (1).txt')
+        self.output = os.path.join(self.folder, "atlas $processed's.txt")
+        with open(self.input, 'w') as f:
+            f.write('atlas\n')
+        self.log = os.path.join(self.folder, 'runs.txt')
+        self.command = FakeCommand([self.input], [self.output],
+                'cp %s %s && echo run >> %s' %
+                tuple(pipes.quote(path) for path in [self.input, self.output, self.log]))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def run_shared(self):
+        cmd = shared.get_shared_command(self.command, self.shared_folder)
+        return subprocess.call(cmd, shell=True, executable='/bin/bash')
+
+    def count_runs(self):
+        with open(self.log) as f:
+            return len(f.readlines())
+
+    def test_reuse(self):
+        self.assertEqual(self.run_shared(), 0)
+        self.assertTrue(os.path.exists(self.output))
+        self.assertEqual(self.run_shared(), 0)
+        self.assertEqual(self.count_runs(), 1)
+
+        # a changed input makes it run again
+        with open(self.input, 'w') as f:
+            f.write('new atlas\n')
+        self.assertEqual(self.run_shared(), 0)
+        self.assertEqual(self.count_runs(), 2)
+
+    def test_hash_with_dash(self):
+        """ Checks a command whose hash would look like an option """
+        cmd = self.command.cmd
+        suffix = 0
+        while not get_cmdline_hash('%s # %d' % (cmd, suffix)).startswith('-'):
+            suffix += 1
+        self.command.cmd = '%s # %d' % (cmd, suffix)
+        self.assertEqual(self.run_shared(), 0)
+        self.assertEqual(self.count_runs(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
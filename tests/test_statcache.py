@@ -0,0 +1,100 @@
+"""
+Tests answering existence/modification time checks from directory listings
+(see statcache.py).
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from pipebuilder import statcache
+
+class FakeDirEntry(object):
+    """ Stands in for scandir's DirEntry (in case scandir isn't installed) """
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+def fake_scandir(directory):
+    return [FakeDirEntry(directory, name) for name in os.listdir(directory)]
+
+class StatCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_statcache')
+        self.file = self.path('file.txt')
+        with open(self.file, 'w') as f:
+            f.write('data\n')
+        os.symlink(self.file, self.path('link.txt'))
+        os.symlink(self.path('missing.txt'), self.path('broken.txt'))
+        os.mkdir(self.path('folder'))
+        self.saved_scandir = statcache.scandir
+
+    def tearDown(self):
+        statcache.scandir = self.saved_scandir
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def check_like_os(self):
+        cache = statcache.StatCache()
+        for name in ['file.txt', 'link.txt', 'broken.txt', 'missing.txt',
+                     'folder', 'folder/', 'missing_folder/file.txt']:
+            filename = self.path(name)
+            self.assertEqual(cache.exists(filename), os.path.lexists(filename), name)
+            self.assertEqual(cache.exists(filename), os.path.lexists(filename), name)
+            if os.path.exists(filename):
+                self.assertEqual(cache.getmtime(filename), os.path.getmtime(filename), name)
+            else:
+                self.assertEqual(cache.getmtime(filename), None, name)
+        return cache
+
+    def test_listdir(self):
+        statcache.scandir = None
+        self.check_like_os()
+
+    def test_scandir(self):
+        statcache.scandir = fake_scandir
+        cache = self.check_like_os()
+        # (two listings, plus a stat for each listed file whose time was read)
+        self.assertEqual(cache.filesystem_calls, 6)
+
+    def test_exists_without_stats(self):
+        """ Checks that existence is answered from one listing, without scandir """
+        statcache.scandir = None
+        calls = []
+        def counted(func):
+            def wrapper(*args):
+                calls.append(func.__name__)
+                return func(*args)
+            return wrapper
+        saved = (os.stat, os.lstat, os.listdir)
+        (os.stat, os.lstat, os.listdir) = [counted(func) for func in saved]
+        try:
+            cache = statcache.StatCache()
+            for name in ['file.txt', 'link.txt', 'broken.txt', 'missing.txt', 'folder']:
+                cache.exists(self.path(name))
+        finally:
+            (os.stat, os.lstat, os.listdir) = saved
+        self.assertEqual(calls, ['listdir'])
+        self.assertEqual(cache.filesystem_calls, 1)
+        self.assertEqual(cache.calls_saved, 4)
+
+    def test_invalidate(self):
+        cache = statcache.StatCache()
+        new_file = self.path('new.txt')
+        self.assertFalse(cache.exists(new_file))
+        with open(new_file, 'w') as f:
+            f.write('new\n')
+        self.assertFalse(cache.exists(new_file))
+        cache.invalidate(new_file)
+        self.assertTrue(cache.exists(new_file))
+
+if __name__ == '__main__':
+    unittest.main()
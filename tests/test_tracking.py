@@ -0,0 +1,34 @@
+"""
+Tests helpers of the pipeline server (see tracking.py).
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from pipebuilder import tracking
+
+class IsWithinTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='pb_test_tracking')
+        self.base_dir = os.path.join(self.folder, 'data')
+        os.mkdir(self.base_dir)
+        os.mkdir(self.base_dir + '2')
+        os.symlink(self.folder, os.path.join(self.base_dir, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_is_within(self):
+        base_dir = self.base_dir
+        self.assertTrue(tracking.is_within(os.path.join(base_dir, 's1', 'a.nii.gz'), base_dir))
+        self.assertTrue(tracking.is_within(os.path.join(base_dir, 's1', '..', 'a'), base_dir))
+        self.assertTrue(tracking.is_within(os.path.join(base_dir, 'a'), base_dir + '/'))
+        # (a sibling folder whose name starts with the same characters)
+        self.assertFalse(tracking.is_within(os.path.join(base_dir + '2', 'a'), base_dir))
+        self.assertFalse(tracking.is_within(os.path.join(base_dir, '..', 'a'), base_dir))
+        self.assertFalse(tracking.is_within(os.path.join(base_dir, 'link', 'a'), base_dir))
+        self.assertFalse(tracking.is_within(base_dir, base_dir))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -143,41 +143,59 @@ function graphDraw(graph) {
     /**
      * Polls the status of each node (across all expansions) and adjusts the
      * visual representation accordingly.
-     * Assumes the server will respond after a long delay (long polling).
+     * The server responds right away with only the statuses that changed
+     * since the version we last saw, so we ask again every few seconds.
      */
-    function pollNodeStatuses(timeout) {
-        $.get('/nodeStatuses', {"timeout": timeout}, function(result) {
-            // assumes server will sleep before responding for a "long poll"
+    // (pending nodes have no outline)
+    var STATUS_CODES = {"pending": null, "running": 0, "succeeded": 1, "failed": -1};
+    var STATUS_POLL_INTERVAL = 3000;
+    function pollNodeStatuses(since) {
+        $.get('/nodeStatuses', {"since": since}, function(result) {
+            var changed = false;
             subnode_text_shadow
-                .style("stroke", function(d, i) {
-                    d.completionStatus = result[i];
-                    if (result[i] === 0) {
-                        return IN_PROGRESS_COLOR;
-                    } else if (result[i] === 1) {
-                        return COMPLETED_COLOR;
-                    } else if (result[i] === -1) {
-                        return FAILURE_COLOR;
+                .each(function(d, i) {
+                    if (i in result.statuses) {
+                        d.completionStatus = STATUS_CODES[result.statuses[i]];
+                        changed = true;
                     }
                 });
-            supernode_text_shadow
-                .each(function(d_super) {
-                    var foundProgress = false;
-                    var foundCompleted = false;
-                    var foundFailure = false;
-                    d3.selectAll(d_super.subnode_elements)
-                        .each(function(d_sub) {
-                            if (d_sub.completionStatus === 0) {
-                                foundProgress = true;
-                            } else if (d_sub.completionStatus === 1) {
-                                foundCompleted = true;
-                            } else if (d_sub.completionStatus === -1) {
-                                foundFailure = true;
-                            }
-                        });
-                    d_super.strokeStyle = gradientMap[[foundProgress, foundCompleted, foundFailure]];
-                })
-                .style("stroke", function(d_super) { return d_super.strokeStyle; });
-            pollNodeStatuses(3); // keep polling forever
+            if (changed) {
+                subnode_text_shadow
+                    .style("stroke", function(d, i) {
+                        if (d.completionStatus === 0) {
+                            return IN_PROGRESS_COLOR;
+                        } else if (d.completionStatus === 1) {
+                            return COMPLETED_COLOR;
+                        } else if (d.completionStatus === -1) {
+                            return FAILURE_COLOR;
+                        }
+                        return null;
+                    });
+                supernode_text_shadow
+                    .each(function(d_super) {
+                        var foundProgress = false;
+                        var foundCompleted = false;
+                        var foundFailure = false;
+                        d3.selectAll(d_super.subnode_elements)
+                            .each(function(d_sub) {
+                                if (d_sub.completionStatus === 0) {
+                                    foundProgress = true;
+                                } else if (d_sub.completionStatus === 1) {
+                                    foundCompleted = true;
+                                } else if (d_sub.completionStatus === -1) {
+                                    foundFailure = true;
+                                }
+                            });
+                        d_super.strokeStyle = gradientMap[[foundProgress, foundCompleted, foundFailure]];
+                    })
+                    .style("stroke", function(d_super) { return d_super.strokeStyle; });
+            }
+            // keep polling forever
+            setTimeout(function() { pollNodeStatuses(result.version); },
+                       STATUS_POLL_INTERVAL);
+        }).fail(function() {
+            setTimeout(function() { pollNodeStatuses(since); },
+                       STATUS_POLL_INTERVAL);
         });
 
     }
@@ -785,6 +803,15 @@ function graphDraw(graph) {
                                             var url = 'http://slicedrop.com/?' + server + '/retrieveFile?filename=' + filename;
                                             //var url = server + '/queryFileType?filename=' + filename;
                                             console.log("Displaying file:\n" + filename);
+                                            // quick-look slices, rendered by the server
+                                            var thumbnails = popupdiv.append('div')
+                                                .attr('class', 'thumbnails')
+                                                .style('text-align', 'center');
+                                            ['sagittal', 'coronal', 'axial'].forEach(function(axis) {
+                                                thumbnails.append('img')
+                                                    .attr('src', '/getThumbnail?filename=' +
+                                                          encodeURIComponent(filename) + '&axis=' + axis);
+                                            });
                                             var sdFrame = popupdiv.append('iframe')
                                                 .attr('id', 'vizFrame')
                                                 .attr('width', '86%')
@@ -975,7 +1002,7 @@ function graphDraw(graph) {
         .style('height', legendHeight);
     legend.attr('transform', 'translate(' + (LEGEND_PAD-fullLegendBox.x) + ',' + (LEGEND_PAD-fullLegendBox.y) + ')');
     moveSubnodesToSupernodes();
-    //pollNodeStatuses(0); // keep polling forever
+    pollNodeStatuses(0); // keep polling forever
 };
 $(document).ready(function() {
     $.post('/getGraphJSON', graphDraw);